@@ -1,21 +1,19 @@
 """ init file for the app module: mainly initializes the webserver component """
 
 import logging
-import time
-from logging.handlers import RotatingFileHandler
+import os
 
 from flask import Flask
-from app.data_ingestor import DataIngestor
-from app.task_runner import ThreadPool
+from app.data_ingestor import create_ingestor
+from app.dataset_registry import create_dataset_registry
+from app.dataset_reloader import DatasetReloader
+from app.log_pipeline import configure_logging
+from app.profiler import SamplingProfiler
+from app.task_runner import create_pool
 
-# Create logger with a circular handler
+# Create logger with a circular handler, written from a queue thread with LOG_ASYNC=1
 LOGGER = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO)
-HANDLER = RotatingFileHandler('webserver.log', mode='a', maxBytes=60000, backupCount=10)
-FORMATTER = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-FORMATTER.converter = time.gmtime
-HANDLER.setFormatter(FORMATTER)
-LOGGER.addHandler(HANDLER)
+LOG_PIPELINE = configure_logging(LOGGER)
 
 # initialize server
 webserver = Flask(__name__)
@@ -23,9 +21,30 @@ webserver = Flask(__name__)
 # set the data ingestor to non-existent to prevent some premature access
 webserver.data_ingestor = None
 webserver.logger = LOGGER
-webserver.tasks_runner = ThreadPool()
+webserver.log_pipeline = LOG_PIPELINE
+webserver.tasks_runner = create_pool()
+# started and stopped through /api/admin/profiler, samples the workers on a job
+webserver.profiler = SamplingProfiler(webserver.tasks_runner.busy_workers)
 
-# now actually set the data ingestor
-webserver.data_ingestor = DataIngestor("./nutrition_activity_obesity_usa_subset.csv")
+def publish_ingestor(ingestor):
+    """ A reloaded dataset becomes the one merge_ingestor hands to the pool """
+    webserver.data_ingestor = ingestor
+
+# loads and reloads (/api/admin/reload, csv changes with DATASET_WATCH_INTERVAL > 0)
+DATASET_PATH = os.environ.get('DATASET_PATH', './nutrition_activity_obesity_usa_subset.csv')
+webserver.dataset_reloader = DatasetReloader(DATASET_PATH, webserver.tasks_runner,
+                                             create_ingestor, publish_ingestor)
+
+# now actually set the data ingestor, INGESTOR_ENGINE=columnar selects the NumPy engine.
+# DATASET_LOAD_ASYNC=1 serves right away and queues the jobs until /api/ready says so
+if os.environ.get('DATASET_LOAD_ASYNC', '0') == '1':
+    webserver.dataset_reloader.reload()
+else:
+    webserver.data_ingestor = webserver.dataset_reloader.load()
+
+# the named datasets of DATASETS_CONFIG, loaded when a job asks for one
+webserver.datasets = create_dataset_registry(webserver.tasks_runner)
+if float(os.environ.get('DATASET_WATCH_INTERVAL', '0')) > 0:
+    webserver.dataset_reloader.watch(float(os.environ['DATASET_WATCH_INTERVAL']))
 
 from app import routes
@@ -0,0 +1,103 @@
+""" Admission control: refuse jobs early instead of queueing until we run out of memory """
+
+from collections import OrderedDict
+from threading import Lock
+import math
+import time
+
+class TokenBucket:
+    """ Per-client rate limiter: rate jobs per second on average, bursts up to burst """
+    def __init__(self, rate, burst, max_clients=10000):
+        """ rate = 0 disables the limiter """
+
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_clients = max_clients
+
+        # client -> [tokens, time of the last refill], least recently used first
+        self.buckets = OrderedDict()
+        self.lock = Lock()
+
+    def acquire(self, client):
+        """ Take a token for client: 0 if allowed, else the seconds until one is available """
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(client)
+            if bucket is None:
+                if len(self.buckets) >= self.max_clients:
+                    self.prune(now)
+                bucket = self.buckets[client] = [self.burst, now]
+            else:
+                self.buckets.move_to_end(client)
+
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            return (1 - bucket[0]) / self.rate
+
+    def prune(self, now):
+        """ Make room for a new client, called with the lock held
+
+        The clients whose bucket has refilled are forgotten first; if that is not
+        enough the least recently used ones go too, so the map stays under max_clients.
+        """
+        full = [client for client, (tokens, last) in self.buckets.items()
+                if tokens + (now - last) * self.rate >= self.burst]
+        for client in full:
+            del self.buckets[client]
+        while self.buckets and len(self.buckets) >= self.max_clients:
+            self.buckets.popitem(last=False)
+
+class AdmissionController:
+    """ High/low watermarks on the queue depth, plus the per-client token bucket
+
+    Above the high watermark every new job is refused until the queue drains
+    below the low watermark, so the server doesn't flap around a single limit.
+    """
+    def __init__(self, depth_fn, high, low, rate, burst, retry_after):
+        """ high = 0 disables the watermarks """
+
+        self.depth_fn = depth_fn
+        self.high = high
+        self.low = min(low, high)
+        self.retry_after = retry_after
+        self.limiter = TokenBucket(rate, burst)
+
+        self.overloaded = False
+        self.lock = Lock()
+
+        # counters for the stats endpoint
+        self.rejected_overload = 0
+        self.rejected_rate = 0
+
+    def admit(self, client):
+        """ None if the job can go on, else (http status, reason, Retry-After seconds) """
+        if self.high:
+            depth = self.depth_fn()
+            with self.lock:
+                if self.overloaded and depth <= self.low:
+                    self.overloaded = False
+                elif not self.overloaded and depth >= self.high:
+                    self.overloaded = True
+                if self.overloaded:
+                    self.rejected_overload += 1
+                    return 503, "overloaded", self.retry_after
+
+        wait = self.limiter.acquire(client)
+        if wait:
+            with self.lock:
+                self.rejected_rate += 1
+            return 429, "rate limited", max(1, math.ceil(wait))
+        return None
+
+    def stats(self):
+        """ Watermarks, state and rejection counters """
+        with self.lock:
+            return {"overloaded": self.overloaded, "high_watermark": self.high,
+                    "low_watermark": self.low, "rate": self.limiter.rate,
+                    "burst": self.limiter.burst, "rejected_overload": self.rejected_overload,
+                    "rejected_rate": self.rejected_rate}
@@ -1,115 +1,597 @@
 """ Process and store the data, providing methods to compute means """
 
+import copy
 import csv
+import hashlib
+import io
+import json
+import math
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+# numpy is only needed by the columnar engine
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+QUESTIONS_BEST_IS_MIN = [
+    'Percent of adults aged 18 years and older who have an overweight classification',
+    'Percent of adults aged 18 years and older who have obesity',
+    'Percent of adults who engage in no leisure-time physical activity',
+    'Percent of adults who report consuming fruit less than one time daily',
+    'Percent of adults who report consuming vegetables less than one time daily'
+]
+
+QUESTIONS_BEST_IS_MAX = [
+    'Percent of adults who achieve at least 150 minutes a week of moderate-intensity aerobic physical activity or 75 minutes a week of vigorous-intensity aerobic activity (or an equivalent combination)',
+    'Percent of adults who achieve at least 150 minutes a week of moderate-intensity aerobic physical activity or 75 minutes a week of vigorous-intensity aerobic physical activity and engage in muscle-strengthening activities on 2 or more days a week',
+    'Percent of adults who achieve at least 300 minutes a week of moderate-intensity aerobic physical activity or 150 minutes a week of vigorous-intensity aerobic activity (or an equivalent combination)',
+    'Percent of adults who engage in muscle-strengthening activities on 2 or more days a week',
+]
+
+# the columns of the csv we keep, in the order parse_csv_chunk gets their indices
+CSV_COLUMNS = ("Question", "LocationDesc", "Data_Value", "Stratification1",
+               "StratificationCategory1")
+
+class IngestProgress:
+    """ How far the ingestion of a csv got, read by the readiness endpoint while it runs
+
+    Only the ingesting thread writes, the readers get a consistent enough picture.
+    """
+    def __init__(self):
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.chunks_total = 0
+        self.chunks_done = 0
+        self.rows = 0
+        self.skipped_rows = 0
+        self.from_snapshot = False
+        self.done = False
+        self.started = time.monotonic()
+        self.duration = None
+
+    def finish(self):
+        """ The ingestor is built, index included """
+        self.duration = time.monotonic() - self.started
+        self.done = True
+
+    def as_dict(self):
+        """ Counters for the readiness endpoint """
+        return {"bytes_total": self.bytes_total, "bytes_done": self.bytes_done,
+                "chunks_total": self.chunks_total, "chunks_done": self.chunks_done,
+                "rows": self.rows, "skipped_rows": self.skipped_rows,
+                "from_snapshot": self.from_snapshot, "done": self.done,
+                "elapsed": (self.duration if self.done
+                            else time.monotonic() - self.started)}
+
+def csv_column_indices(csv_path):
+    """ Byte offset of the first data row and the indices of CSV_COLUMNS in the header """
+    with open(csv_path, "rb") as f:
+        header = f.readline()
+    headers = next(csv.reader([header.decode("utf-8")]))
+    return len(header), tuple(headers.index(name) for name in CSV_COLUMNS)
+
+def split_csv(csv_path, data_start, chunk_bytes):
+    """ [start, end) byte ranges of about chunk_bytes, each one cut right after a newline
+
+    Rows must not contain quoted newlines, which the CDC extracts never do.
+    """
+    size = os.path.getsize(csv_path)
+    ranges = []
+    with open(csv_path, "rb") as f:
+        start = data_start
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            f.readline()
+            end = f.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+def parse_csv_chunk(csv_path, start, end, indices):
+    """ Parse the rows in [start, end) of the csv into chunk-local encoded columns
+
+    Returns (tables, columns, skipped) in the snapshot layout, in file order, with
+    codes local to the chunk. Rows with a missing or non-numeric Data_Value (or too
+    few fields) are skipped and counted. Runs in the ingestion worker processes.
+    """
+    with open(csv_path, "rb") as f:
+        f.seek(start)
+        text = f.read(end - start).decode("utf-8")
+
+    question_idx, location_idx, value_idx, strat1_idx, strat_cat1_idx = indices
+    width = max(indices)
+    questions, locations, stratifs, categories = {}, {}, {}, {}
+    columns = {name: array(typecode) for name, typecode in SNAPSHOT_COLUMNS}
+    values, question_codes = columns["values"], columns["question"]
+    location_codes, stratif_codes = columns["location"], columns["stratif"]
+    category_codes = columns["category"]
+    skipped = 0
+
+    for entry in csv.reader(io.StringIO(text, newline="")):
+        if len(entry) <= width:
+            skipped += bool(entry)
+            continue
+        try:
+            val = float(entry[value_idx])
+        except ValueError:
+            skipped += 1
+            continue
+        if not math.isfinite(val):
+            skipped += 1
+            continue
+        values.append(val)
+        question_codes.append(questions.setdefault(entry[question_idx], len(questions)))
+        location_codes.append(locations.setdefault(entry[location_idx], len(locations)))
+        stratif_codes.append(stratifs.setdefault(entry[strat1_idx], len(stratifs)))
+        category_codes.append(categories.setdefault(entry[strat_cat1_idx], len(categories)))
+
+    tables = {"questions": list(questions), "locations": list(locations),
+              "stratifs": list(stratifs), "categories": list(categories)}
+    return tables, columns, skipped
+
+# chunk table -> the code column it encodes
+CODE_COLUMNS = {"questions": "question", "locations": "location",
+                "stratifs": "stratif", "categories": "category"}
+
+def parse_csv(csv_path, progress=None, workers=None, chunk_bytes=None):
+    """ Parse the csv into (tables, columns, skipped rows), in the snapshot layout and file order
+
+    The file is split on row boundaries into chunks of INGESTOR_CHUNK_BYTES (default
+    32 MiB) parsed by INGESTOR_WORKERS forked processes (default: one per cpu); a
+    single chunk or a single worker stays in this process. The chunks are merged in
+    file order as they come back, remapping their local codes to the global tables,
+    so at most the chunks in flight are held besides the result.
+    """
+    if workers is None:
+        workers = int(os.environ.get('INGESTOR_WORKERS', str(os.cpu_count() or 1)))
+    if chunk_bytes is None:
+        chunk_bytes = int(os.environ.get('INGESTOR_CHUNK_BYTES', str(32 << 20)))
+    if progress is None:
+        progress = IngestProgress()
+
+    data_start, indices = csv_column_indices(csv_path)
+    ranges = split_csv(csv_path, data_start, max(chunk_bytes, 1))
+    progress.bytes_total = os.path.getsize(csv_path)
+    progress.bytes_done = data_start
+    progress.chunks_total = len(ranges)
+
+    encodings = {table: {} for table in CODE_COLUMNS}
+    columns = {name: array(typecode) for name, typecode in SNAPSHOT_COLUMNS}
+    skipped = 0
+
+    def merge(byte_range, chunk):
+        nonlocal skipped
+        chunk_tables, chunk_columns, chunk_skipped = chunk
+        columns["values"].extend(chunk_columns["values"])
+        for table, column in CODE_COLUMNS.items():
+            encoding = encodings[table]
+            remap = [encoding.setdefault(name, len(encoding)) for name in chunk_tables[table]]
+            codes = chunk_columns[column]
+            if remap == list(range(len(remap))):
+                columns[column].extend(codes)
+            elif np is not None:
+                mapped = np.asarray(remap, dtype=np.int32)[np.frombuffer(codes, dtype=np.int32)]
+                columns[column].frombytes(mapped.tobytes())
+            else:
+                columns[column].extend(remap[code] for code in codes)
+        skipped += chunk_skipped
+        progress.bytes_done += byte_range[1] - byte_range[0]
+        progress.chunks_done += 1
+        progress.rows = len(columns["values"])
+        progress.skipped_rows = skipped
+
+    if workers <= 1 or len(ranges) <= 1:
+        for start, end in ranges:
+            merge((start, end), parse_csv_chunk(csv_path, start, end, indices))
+    else:
+        # forked like the process pool: the workers only need this module's functions
+        with ProcessPoolExecutor(max_workers=min(workers, len(ranges)),
+                                 mp_context=multiprocessing.get_context("fork")) as executor:
+            futures = deque((byte_range, executor.submit(parse_csv_chunk, csv_path, *byte_range,
+                                                         indices))
+                            for byte_range in ranges)
+            while futures:
+                # popped, so a chunk is let go as soon as it is merged
+                byte_range, future = futures.popleft()
+                merge(byte_range, future.result())
+
+    tables = {table: list(encoding) for table, encoding in encodings.items()}
+    return tables, columns, skipped
+
+def rows_from_entries(entries, indices):
+    """ (rows, skipped) out of csv-like entries, rows as (question, location, value, stratif, category)
+
+    Same rules as the csv parsing: a missing or non-numeric Data_Value skips the row.
+    """
+    question_idx, location_idx, value_idx, strat1_idx, strat_cat1_idx = indices
+    width = max(indices)
+    rows = []
+    skipped = 0
+    for entry in entries:
+        if len(entry) <= width:
+            skipped += bool(entry)
+            continue
+        try:
+            val = float(entry[value_idx])
+        except (TypeError, ValueError):
+            skipped += 1
+            continue
+        if not math.isfinite(val):
+            skipped += 1
+            continue
+        rows.append((entry[question_idx], entry[location_idx], val,
+                     entry[strat1_idx], entry[strat_cat1_idx]))
+    return rows, skipped
+
+def rows_from_csv_text(text):
+    """ (rows, skipped) of csv text starting with a header line, ValueError without our columns """
+    reader = csv.reader(io.StringIO(text, newline=""))
+    headers = next(reader, None)
+    if headers is None:
+        return [], 0
+    return rows_from_entries(reader, tuple(headers.index(name) for name in CSV_COLUMNS))
+
+def rows_from_records(records):
+    """ (rows, skipped) of json objects keyed by the csv column names """
+    entries = (["" if record.get(name) is None else str(record[name]) for name in CSV_COLUMNS]
+               for record in records)
+    return rows_from_entries(entries, tuple(range(len(CSV_COLUMNS))))
+
+# Binary snapshot: magic, format version, header length, json header, 8-byte aligned columns
+SNAPSHOT_MAGIC = b"FSNAPSHT"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_PREAMBLE = struct.Struct("<8sII")
+# (column name, array typecode), in the order they are written
+SNAPSHOT_COLUMNS = (("values", "d"), ("question", "i"), ("location", "i"),
+                    ("stratif", "i"), ("category", "i"))
+
+def snapshot_path(csv_path):
+    """ The snapshot lives next to the csv """
+    return csv_path + ".snapshot"
+
+def csv_fingerprint(csv_path):
+    """ Key a snapshot on the csv size, mtime and content hash """
+    stat = os.stat(csv_path)
+    digest = hashlib.sha256()
+    with open(csv_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest.hexdigest()}
+
+def write_snapshot(csv_path, tables, columns, skipped=0):
+    """ Dump the dictionary tables and the columns, rows grouped by question code
+
+    tables: {"questions"/"locations"/"stratifs"/"categories": list of strings, code = position}
+    columns: {column name: array or buffer}, see SNAPSHOT_COLUMNS
+    skipped: csv rows left out for a bad Data_Value
+    Best effort, a read-only directory only means we parse the csv next time as well.
+    """
+    header = {"version": SNAPSHOT_VERSION, "byteorder": sys.byteorder,
+              "csv": csv_fingerprint(csv_path), "tables": tables,
+              "rows": len(columns["values"]), "skipped_rows": skipped, "columns": {}}
+
+    blobs = []
+    offset = 0
+    for name, typecode in SNAPSHOT_COLUMNS:
+        blob = memoryview(columns[name]).cast("B")
+        header["columns"][name] = [offset, array(typecode).itemsize]
+        blobs.append(blob)
+        offset += (len(blob) + 7) // 8 * 8
+
+    raw_header = json.dumps(header).encode("utf-8")
+    raw_header += b" " * (-(SNAPSHOT_PREAMBLE.size + len(raw_header)) % 8)
+
+    path = snapshot_path(csv_path)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(SNAPSHOT_PREAMBLE.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(raw_header)))
+            f.write(raw_header)
+            for blob in blobs:
+                f.write(blob)
+                f.write(b"\0" * (-len(blob) % 8))
+        # readers never see a half written snapshot
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def load_snapshot(csv_path):
+    """ Memory-map a valid snapshot: (tables, {column name: memoryview}, skipped rows), None if stale """
+    try:
+        with open(snapshot_path(csv_path), "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    try:
+        magic, version, header_len = SNAPSHOT_PREAMBLE.unpack_from(mapped)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            return None
+        start = SNAPSHOT_PREAMBLE.size + header_len
+        header = json.loads(bytes(mapped[SNAPSHOT_PREAMBLE.size:start]))
+        if header["byteorder"] != sys.byteorder or header["csv"] != csv_fingerprint(csv_path):
+            return None
+
+        columns = {}
+        for name, typecode in SNAPSHOT_COLUMNS:
+            offset, itemsize = header["columns"][name]
+            if itemsize != array(typecode).itemsize:
+                return None
+            begin = start + offset
+            view = memoryview(mapped)[begin:begin + header["rows"] * itemsize]
+            columns[name] = view.cast(typecode)
+    except (struct.error, ValueError, KeyError, TypeError):
+        return None
+    return header["tables"], columns, header.get("skipped_rows", 0)
+
+def create_ingestor(csv_path, engine=None, progress=None, best_is_min=None, best_is_max=None):
+    """ Build the ingestor selected by engine or INGESTOR_ENGINE (dict by default)
+
+    best_is_min / best_is_max: the questions whose best states have the lowest / highest
+    means, the nutrition survey lists by default.
+    """
+    if engine is None:
+        engine = os.environ.get('INGESTOR_ENGINE', 'dict')
+    if engine == 'columnar':
+        return ColumnarIngestor(csv_path, progress=progress, best_is_min=best_is_min,
+                                best_is_max=best_is_max)
+    if engine == 'dict':
+        return DataIngestor(csv_path, progress=progress, best_is_min=best_is_min,
+                            best_is_max=best_is_max)
+    raise ValueError(f"Unknown ingestor engine {engine}")
 
 class DataIngestor:
     """ Parse the csv and provide necessary methods """
 
-    def __init__(self, csv_path: str):
-        # Read csv from csv_path
+    def __init__(self, csv_path: str, use_snapshot=None, progress=None,
+                 best_is_min=None, best_is_max=None):
+        # Read csv from csv_path, progress (an IngestProgress) follows the parsing
 
         # Format like: keys=question, having as value a sub-dictionary
         # Subdictionary: keys=location, values: list of tuples (value, stratif, category)
+        # Only the rows of the csv: the statistics read the index built from it
         self.all_questions = {}
-
-        with open(csv_path, "r", newline="", encoding="utf-8") as f:
-            reader = csv.reader(f)
-
-            # Read the headers from the first line and save the relevant ones
-            headers = next(reader)
-            self.__QUESTION = headers.index("Question")
-            self.__LOCATION = headers.index("LocationDesc")
-            self.__VALUE = headers.index("Data_Value")
-            self.__STRAT1 = headers.index("Stratification1")
-            self.__STRAT_CAT1 = headers.index("StratificationCategory1")
-
-            # Read the data per se
-            for entry in reader:
-                question = entry[self.__QUESTION]
-                location = entry[self.__LOCATION]
-                val = entry[self.__VALUE]
-                strat1 = entry[self.__STRAT1]
-                strat_cat1 = entry[self.__STRAT_CAT1]
-
-                # convert to float
-                val = float(val)
-
-                # check new question
-                if question not in self.all_questions:
-                    self.all_questions[question] = {}
-                    self.all_questions[question][location] = []
-
-                # check new location for an existent question
-                elif location not in self.all_questions[question]:
-                    self.all_questions[question][location] = []
-
-                # add the (value, stratif, category) to list for that <question, location> pair
-                self.all_questions[question][location].append((val, strat1, strat_cat1))
-
-
-        self.questions_best_is_min = [
-            'Percent of adults aged 18 years and older who have an overweight classification',
-            'Percent of adults aged 18 years and older who have obesity',
-            'Percent of adults who engage in no leisure-time physical activity',
-            'Percent of adults who report consuming fruit less than one time daily',
-            'Percent of adults who report consuming vegetables less than one time daily'
-        ]
-
-        self.questions_best_is_max = [
-            'Percent of adults who achieve at least 150 minutes a week of moderate-intensity aerobic physical activity or 75 minutes a week of vigorous-intensity aerobic activity (or an equivalent combination)',
-            'Percent of adults who achieve at least 150 minutes a week of moderate-intensity aerobic physical activity or 75 minutes a week of vigorous-intensity aerobic physical activity and engage in muscle-strengthening activities on 2 or more days a week',
-            'Percent of adults who achieve at least 300 minutes a week of moderate-intensity aerobic physical activity or 150 minutes a week of vigorous-intensity aerobic activity (or an equivalent combination)',
-            'Percent of adults who engage in muscle-strengthening activities on 2 or more days a week',
-        ]
+        # rows added by appended(), one tuple per append, shared by the later versions
+        self.appended_rows = ()
+
+        # dataset version, assigned by the pool when the ingestor is published
+        self.version = 0
+
+        # a valid snapshot spares us the csv parsing and the float() calls
+        if use_snapshot is None:
+            use_snapshot = os.environ.get('INGESTOR_SNAPSHOT', '1') != '0'
+        if progress is None:
+            progress = IngestProgress()
+        snapshot = load_snapshot(csv_path) if use_snapshot else None
+        self.loaded_from_snapshot = progress.from_snapshot = snapshot is not None
+        if snapshot:
+            tables, columns, self.skipped_rows = snapshot
+        else:
+            # parallel chunked parse, rows with a bad Data_Value are left out
+            tables, columns, self.skipped_rows = parse_csv(csv_path, progress)
+        self.rows = len(columns["values"])
+        progress.rows, progress.skipped_rows = self.rows, self.skipped_rows
+        rows = self.__snapshot_rows(tables, columns)
+
+        for question, location, val, strat1, strat_cat1 in rows:
+            # check new question
+            if question not in self.all_questions:
+                self.all_questions[question] = {}
+                self.all_questions[question][location] = []
+
+            # check new location for an existent question
+            elif location not in self.all_questions[question]:
+                self.all_questions[question][location] = []
+
+            # add the (value, stratif, category) to list for that <question, location> pair
+            self.all_questions[question][location].append((val, strat1, strat_cat1))
+
+        if use_snapshot and not snapshot:
+            write_snapshot(csv_path, *self.__snapshot_columns(), self.skipped_rows)
+
+        # direction of best/worst, per dataset
+        self.questions_best_is_min = list(QUESTIONS_BEST_IS_MIN if best_is_min is None
+                                          else best_is_min)
+        self.questions_best_is_max = list(QUESTIONS_BEST_IS_MAX if best_is_max is None
+                                          else best_is_max)
+
+        # The data never changes after load, so aggregate everything once
+        self.__build_index()
+        progress.finish()
+
+    @staticmethod
+    def __snapshot_rows(tables, columns):
+        """ Decode the snapshot (or parsed) columns back into csv-like rows """
+        questions, locations = tables["questions"], tables["locations"]
+        stratifs, categories = tables["stratifs"], tables["categories"]
+        for val, question, location, strat1, strat_cat1 in zip(
+                columns["values"], columns["question"], columns["location"],
+                columns["stratif"], columns["category"]):
+            yield (questions[question], locations[location], val,
+                   stratifs[strat1], categories[strat_cat1])
+
+    def __snapshot_columns(self):
+        """ Encode all_questions as snapshot tables and columns, grouped by question """
+        encodings = {"questions": {}, "locations": {}, "stratifs": {}, "categories": {}}
+        columns = {name: array(typecode) for name, typecode in SNAPSHOT_COLUMNS}
+
+        def encode(table, name):
+            return encodings[table].setdefault(name, len(encodings[table]))
+
+        for question, states in self.all_questions.items():
+            question_code = encode("questions", question)
+            for state, val_list in states.items():
+                location_code = encode("locations", state)
+                for val in val_list:
+                    columns["values"].append(val[0])
+                    columns["question"].append(question_code)
+                    columns["location"].append(location_code)
+                    columns["stratif"].append(encode("stratifs", val[1]))
+                    columns["category"].append(encode("categories", val[2]))
+
+        tables = {table: list(encoding) for table, encoding in encodings.items()}
+        return tables, columns
+
+    def __build_index(self):
+        """ Precompute (sum, count, min, max) per question, state and category """
+
+        # keys=question, values: (sum, count, min, max) over all the states
+        self.question_index = {}
+        # keys=question, values: {state: (sum, count, min, max)}
+        self.state_index = {}
+        # keys=question, values: {state: {(category, stratif): (sum, count, min, max)}}
+        self.category_index = {}
+        # keys=question, values: tuple of (state, mean) sorted ascending by mean
+        self.state_rankings = {}
+
+        for question, states in self.all_questions.items():
+            glob = None
+            per_state = {}
+            per_category = {}
+
+            # walk the values in the same order as a full scan would, so the sums are identical
+            for state, val_list in states.items():
+                agg = None
+                categories = {}
+                for val in val_list:
+                    agg = self.__accumulate(agg, val[0])
+                    glob = self.__accumulate(glob, val[0])
+
+                    # avoid NaN values for stratification
+                    if val[2] == "" or val[1] == "":
+                        continue
+                    tup = (val[2], val[1])
+                    categories[tup] = self.__accumulate(categories.get(tup), val[0])
+
+                per_state[state] = agg
+                per_category[state] = categories
+
+            self.question_index[question] = glob
+            self.state_index[question] = per_state
+            self.category_index[question] = per_category
+
+            # sort once here, best5/worst5/states_mean only have to slice it
+            means = [(state, agg[0] / agg[1]) for state, agg in per_state.items()]
+            self.state_rankings[question] = tuple(sorted(means, key=lambda entry: entry[1]))
+
+    @staticmethod
+    def __accumulate(agg, val):
+        """ Fold a value into a (sum, count, min, max) tuple """
+        if agg is None:
+            return (val, 1, val, val)
+        return (agg[0] + val, agg[1] + 1, min(agg[2], val), max(agg[3], val))
+
+    def appended(self, rows):
+        """ A new version of the ingestor with rows added, this one stays unchanged
+
+        rows: (question, location, value, stratif, category) tuples. Copy-on-write:
+        the index dicts are copied one level deep, and only the entries of the
+        questions, states and categories the rows touch are copied again and
+        updated by folding the new values in, so the cost is O(new rows) plus a
+        re-sort of the states of each touched question. The raw rows are not merged
+        into all_questions, which stays the one of the csv: they are kept as one more
+        immutable chunk in appended_rows. Jobs running on this version never see the
+        new rows. Appends must be serialized by the caller.
+        """
+        rows = tuple(rows)
+        new = copy.copy(self)
+        new.version = 0
+        new.appended_rows = self.appended_rows + (rows,)
+        new.question_index = dict(self.question_index)
+        new.state_index = dict(self.state_index)
+        new.category_index = dict(self.category_index)
+        new.state_rankings = dict(self.state_rankings)
+
+        touched_questions = set()
+        touched_states = set()
+        for question, location, val, strat1, strat_cat1 in rows:
+            if question not in touched_questions:
+                touched_questions.add(question)
+                new.state_index[question] = dict(self.state_index.get(question, {}))
+                new.category_index[question] = dict(self.category_index.get(question, {}))
+            if (question, location) not in touched_states:
+                touched_states.add((question, location))
+                new.category_index[question][location] = dict(
+                    new.category_index[question].get(location, {}))
+
+            new.question_index[question] = self.__accumulate(new.question_index.get(question), val)
+            new.state_index[question][location] = self.__accumulate(
+                new.state_index[question].get(location), val)
+            if strat_cat1 != "" and strat1 != "":
+                categories = new.category_index[question][location]
+                categories[(strat_cat1, strat1)] = self.__accumulate(
+                    categories.get((strat_cat1, strat1)), val)
+
+        for question in touched_questions:
+            means = [(state, agg[0] / agg[1]) for state, agg in new.state_index[question].items()]
+            new.state_rankings[question] = tuple(sorted(means, key=lambda entry: entry[1]))
+        new.rows = self.rows + len(rows)
+        return new
+
+    def memory_bytes(self):
+        """ Rough size of the dataset in memory, for the memory budget of the datasets
+
+        A row costs its (value, stratif, category) tuple, the float and a list slot;
+        the strings are shared between rows.
+        """
+        return self.rows * 96
+
+    def estimate_cost(self, request_type, question, state=None):
+        """ Index entries a request has to touch, inf for a question we don't have """
+        if question not in self.state_index:
+            return float("inf")
+        if request_type in ("global_mean_request", "state_mean_request",
+                            "state_diff_from_mean_request"):
+            return 1
+        if request_type == "state_mean_by_category_request":
+            return len(self.category_index[question].get(state, ()))
+        if request_type == "mean_by_category_request":
+            return sum(len(categories) for categories in self.category_index[question].values())
+        return len(self.state_index[question])
 
     def get_global_mean(self, question):
-        """ Iterate through all possible Data_Values and compute mean """
-        count = 0
-        total_sum = 0
-        for val_list in self.all_questions[question].values():
-            for val in val_list:
-                val = val[0]
-                count += 1
-                total_sum += val
+        """ Get the mean of all possible Data_Values from the index """
+        total_sum, count = self.question_index[question][:2]
         return total_sum / count
 
     def get_state_mean(self, question, state):
-        """ Iterate through all possible Data_Values for that state and compute mean """
-        count = 0
-        total_sum = 0
-        for val in self.all_questions[question][state]:
-            val = val[0]
-            count += 1
-            total_sum += val
+        """ Get the mean of all possible Data_Values for that state from the index """
+        total_sum, count = self.state_index[question][state][:2]
         return total_sum / count
 
     def get_states_mean(self, question):
         """ Compute Data_Value mean for all the states separately """
-        ret = {}
-        for state in self.all_questions[question]:
-            ret[state] = self.get_state_mean(question, state)
 
-        # generate a sorted dictionary
-        ret = dict(sorted(ret.items(), key=lambda entry: entry[1]))
-        return ret
+        # the ranking is already sorted, just hand out a fresh dictionary
+        return dict(self.state_rankings[question])
 
     def get_best5(self, question):
         """ Get the best 5 states as mean for that question """
 
-        # Since we already have a sorted dictionary/list, we can just get the first/last elements
-        all_states = self.get_states_mean(question)
+        # Since we already have a sorted list, we can just get the first/last elements
+        all_states = self.state_rankings[question]
         if question in self.questions_best_is_min:
-            return dict(list(all_states.items())[:5])
-        return dict(list(all_states.items())[-5:])
+            return dict(all_states[:5])
+        return dict(all_states[-5:])
 
     def get_worst5(self, question):
         """ Get the worst 5 states as mean for that question """
 
-        # Since we already have a sorted dictionary/list, we can just get the first/last elements
-        all_states = self.get_states_mean(question)
+        # Since we already have a sorted list, we can just get the first/last elements
+        all_states = self.state_rankings[question]
         if question in self.questions_best_is_max:
-            return dict(list(all_states.items())[:5])
-        return dict(list(all_states.items())[-5:])
+            return dict(all_states[:5])
+        return dict(all_states[-5:])
 
     def get_diff_from_mean(self, question):
         """ Compute difference from mean for all the states separately """
@@ -119,8 +601,8 @@ class DataIngestor:
         glob_mean = self.get_global_mean(question)
 
         # compute difference per se
-        for state in self.all_questions[question].keys():
-            ret[state] = glob_mean - self.get_state_mean(question, state)
+        for state, agg in self.state_index[question].items():
+            ret[state] = glob_mean - agg[0] / agg[1]
         return ret
 
     def get_state_diff_from_mean(self, question, state):
@@ -130,48 +612,263 @@ class DataIngestor:
     def get_mean_by_category(self, question):
         """ Compute all tuples (state, category, stratification_category) for all states """
         total_values = {}
-        total_count = {}
-        for state in self.all_questions[question].keys():
-            for val in self.all_questions[question][state]:
-
-                # avoid NaN values for stratification
-                if val[2] == "" or val[1] == "":
-                    continue
-                tup = str((state, val[2], val[1]))
-
-                # check whether it is the first time encountering a tuple
-                if tup not in total_values:
-                    total_values[tup] = val[0]
-                    total_count[tup] = 1
-                else:
-                    total_values[tup] += val[0]
-                    total_count[tup] += 1
-
-        for tup in total_values:
-            total_values[tup] = total_values[tup] / total_count[tup]
-
+        for state, categories in self.category_index[question].items():
+            for tup, agg in categories.items():
+                total_values[str((state,) + tup)] = agg[0] / agg[1]
         return total_values
 
     def get_state_mean_by_category(self, question, state):
         """ Compute all tuples (state, category, stratification_category) for a state """
         total_values = {}
-        total_count = {}
-
-        for val in self.all_questions[question][state]:
-            # avoid NaN values for stratification
-            if val[2] == "" or val[1] == "":
-                continue
-            tup = str((val[2], val[1]))
-
-            # check whether it is the first time encountering a tuple
-            if tup not in total_values:
-                total_values[tup] = val[0]
-                total_count[tup] = 1
-            else:
-                total_values[tup] += val[0]
-                total_count[tup] += 1
+        for tup, agg in self.category_index[question][state].items():
+            total_values[str(tup)] = agg[0] / agg[1]
+        return {state: total_values}
 
-        for tup in total_values:
-            total_values[tup] = total_values[tup] / total_count[tup]
 
-        return {state: total_values}
+class ColumnarIngestor:
+    """ Same statistics as DataIngestor, computed over NumPy column arrays """
+
+    def __init__(self, csv_path: str, use_snapshot=None, progress=None,
+                 best_is_min=None, best_is_max=None):
+        if np is None:
+            raise ImportError("the columnar ingestor engine needs numpy")
+
+        # dataset version, assigned by the pool when the ingestor is published
+        self.version = 0
+
+        if use_snapshot is None:
+            use_snapshot = os.environ.get('INGESTOR_SNAPSHOT', '1') != '0'
+        if progress is None:
+            progress = IngestProgress()
+        snapshot = load_snapshot(csv_path) if use_snapshot else None
+        self.loaded_from_snapshot = progress.from_snapshot = snapshot is not None
+
+        if snapshot:
+            # the snapshot is already grouped by question: zero-copy views over the mapping
+            tables, columns, self.skipped_rows = snapshot
+            self.questions = {name: code for code, name in enumerate(tables["questions"])}
+            self.locations = {name: code for code, name in enumerate(tables["locations"])}
+            self.stratifs = {name: code for code, name in enumerate(tables["stratifs"])}
+            self.categories = {name: code for code, name in enumerate(tables["categories"])}
+            self.values = np.frombuffer(columns["values"], dtype=np.float64)
+            self.question_codes = np.frombuffer(columns["question"], dtype=np.int32)
+            self.location_codes = np.frombuffer(columns["location"], dtype=np.int32)
+            self.stratif_codes = np.frombuffer(columns["stratif"], dtype=np.int32)
+            self.category_codes = np.frombuffer(columns["category"], dtype=np.int32)
+        else:
+            self.__parse_csv(csv_path, progress)
+        progress.rows, progress.skipped_rows = len(self.values), self.skipped_rows
+
+        self.__derive_tables()
+
+        # direction of best/worst, per dataset
+        self.questions_best_is_min = list(QUESTIONS_BEST_IS_MIN if best_is_min is None
+                                          else best_is_min)
+        self.questions_best_is_max = list(QUESTIONS_BEST_IS_MAX if best_is_max is None
+                                          else best_is_max)
+
+        if use_snapshot and not snapshot:
+            tables = {"questions": list(self.questions), "locations": list(self.locations),
+                      "stratifs": list(self.stratifs), "categories": list(self.categories)}
+            write_snapshot(csv_path, tables, {
+                "values": self.values, "question": self.question_codes,
+                "location": self.location_codes, "stratif": self.stratif_codes,
+                "category": self.category_codes}, self.skipped_rows)
+        progress.finish()
+
+    def __derive_tables(self):
+        """ Question slices and decoding tables, from the sorted columns """
+
+        # question code -> [start, end) of its slice
+        bounds = np.searchsorted(self.question_codes, np.arange(len(self.questions) + 1))
+        self.question_slices = {code: (int(bounds[code]), int(bounds[code + 1]))
+                                for code in range(len(self.questions))}
+
+        # decoding tables, code -> string
+        self.location_names = list(self.locations)
+        self.stratif_names = list(self.stratifs)
+        self.category_names = list(self.categories)
+
+    def appended(self, rows):
+        """ A new version of the ingestor with rows added, this one stays unchanged
+
+        The new rows are encoded with copies of the dictionaries and merged into
+        new columns: one vectorized concatenation and a stable sort of an already
+        sorted run, with no aggregate to maintain since the statistics are computed
+        from the columns. Jobs running on this version keep the old arrays.
+        """
+        new = copy.copy(self)
+        new.version = 0
+        new.questions = dict(self.questions)
+        new.locations = dict(self.locations)
+        new.stratifs = dict(self.stratifs)
+        new.categories = dict(self.categories)
+
+        values = array('d')
+        codes = {name: array('i') for name in ("question", "location", "stratif", "category")}
+        for question, location, val, strat1, strat_cat1 in rows:
+            values.append(val)
+            codes["question"].append(new.questions.setdefault(question, len(new.questions)))
+            codes["location"].append(new.locations.setdefault(location, len(new.locations)))
+            codes["stratif"].append(new.stratifs.setdefault(strat1, len(new.stratifs)))
+            codes["category"].append(new.categories.setdefault(strat_cat1, len(new.categories)))
+
+        question_codes = np.concatenate([self.question_codes,
+                                         np.frombuffer(codes["question"], dtype=np.int32)])
+        # the old rows are sorted already, the new ones land after theirs (file order)
+        order = np.argsort(question_codes, kind="stable")
+        new.question_codes = question_codes[order]
+        new.values = np.concatenate([self.values, np.frombuffer(values, dtype=np.float64)])[order]
+        for name in ("location", "stratif", "category"):
+            column = np.concatenate([getattr(self, name + "_codes"),
+                                     np.frombuffer(codes[name], dtype=np.int32)])
+            setattr(new, name + "_codes", column[order])
+        new.__derive_tables()
+        return new
+
+    def __parse_csv(self, csv_path, progress):
+        """ Read the csv into dictionary-encoded columns, rows grouped by question """
+
+        # parallel chunked parse, string -> int32 code with the position in the list as code
+        tables, columns, self.skipped_rows = parse_csv(csv_path, progress)
+        self.questions = {name: code for code, name in enumerate(tables["questions"])}
+        self.locations = {name: code for code, name in enumerate(tables["locations"])}
+        self.stratifs = {name: code for code, name in enumerate(tables["stratifs"])}
+        self.categories = {name: code for code, name in enumerate(tables["categories"])}
+
+        question_codes = np.frombuffer(columns["question"], dtype=np.int32)
+
+        # Stable sort by question, so every question is a contiguous slice in file order
+        order = np.argsort(question_codes, kind="stable")
+        self.values = np.frombuffer(columns["values"], dtype=np.float64)[order]
+        self.question_codes = question_codes[order]
+        self.location_codes = np.frombuffer(columns["location"], dtype=np.int32)[order]
+        self.stratif_codes = np.frombuffer(columns["stratif"], dtype=np.int32)[order]
+        self.category_codes = np.frombuffer(columns["category"], dtype=np.int32)[order]
+
+    def __question_columns(self, question):
+        """ Get the (values, locations) slices for a question """
+        start, end = self.question_slices[self.questions[question]]
+        return self.values[start:end], self.location_codes[start:end], start, end
+
+    def __states_aggregate(self, question):
+        """ Grouped (sum, count) per location, locations in order of first appearance """
+        values, locations, _, _ = self.__question_columns(question)
+        sums = np.bincount(locations, weights=values, minlength=len(self.locations))
+        counts = np.bincount(locations, minlength=len(self.locations))
+
+        # keep the state order of the dict engine: the order they appear in the csv
+        present, first = np.unique(locations, return_index=True)
+        present = present[np.argsort(first, kind="stable")]
+        return present, sums[present], counts[present]
+
+    def memory_bytes(self):
+        """ Size of the columns, for the memory budget of the datasets """
+        return (self.values.nbytes + self.question_codes.nbytes + self.location_codes.nbytes
+                + self.stratif_codes.nbytes + self.category_codes.nbytes)
+
+    def estimate_cost(self, request_type, question, state=None):
+        """ Rows a request has to reduce, inf for a question we don't have """
+        # every statistic reduces the whole question slice
+        del request_type, state
+        if question not in self.questions:
+            return float("inf")
+        start, end = self.question_slices[self.questions[question]]
+        return end - start
+
+    def get_global_mean(self, question):
+        """ Mean of the question slice """
+        values = self.__question_columns(question)[0]
+        return float(values.sum() / len(values))
+
+    def get_state_mean(self, question, state):
+        """ Mean of the values of one location inside the question slice """
+        values, locations, _, _ = self.__question_columns(question)
+        mask = locations == self.locations.get(state, -1)
+        if not mask.any():
+            raise KeyError(state)
+        return float(values[mask].sum() / np.count_nonzero(mask))
+
+    def get_states_mean(self, question):
+        """ Compute Data_Value mean for all the states separately """
+        present, sums, counts = self.__states_aggregate(question)
+        means = sums / counts
+
+        # generate a sorted dictionary, stable like sorted() on the dict engine
+        order = np.argsort(means, kind="stable")
+        return {self.location_names[code]: mean
+                for code, mean in zip(present[order].tolist(), means[order].tolist())}
+
+    def get_best5(self, question):
+        """ Get the best 5 states as mean for that question """
+        all_states = list(self.get_states_mean(question).items())
+        if question in self.questions_best_is_min:
+            return dict(all_states[:5])
+        return dict(all_states[-5:])
+
+    def get_worst5(self, question):
+        """ Get the worst 5 states as mean for that question """
+        all_states = list(self.get_states_mean(question).items())
+        if question in self.questions_best_is_max:
+            return dict(all_states[:5])
+        return dict(all_states[-5:])
+
+    def get_diff_from_mean(self, question):
+        """ Compute difference from mean for all the states separately """
+        present, sums, counts = self.__states_aggregate(question)
+        diffs = self.get_global_mean(question) - sums / counts
+        return {self.location_names[code]: diff
+                for code, diff in zip(present.tolist(), diffs.tolist())}
+
+    def get_state_diff_from_mean(self, question, state):
+        """ Compute difference from mean for only one state """
+        return {state: self.get_global_mean(question) - self.get_state_mean(question, state)}
+
+    def __category_means(self, question, state=None):
+        """ Grouped means per (location, category, stratif), in order of first appearance """
+        values, locations, start, end = self.__question_columns(question)
+        categories = self.category_codes[start:end]
+        stratifs = self.stratif_codes[start:end]
+
+        # avoid NaN values for stratification
+        mask = np.ones(len(values), dtype=bool)
+        if "" in self.categories:
+            mask &= categories != self.categories[""]
+        if "" in self.stratifs:
+            mask &= stratifs != self.stratifs[""]
+        if state is not None:
+            mask &= locations == self.locations.get(state, -1)
+
+        # one combined group key per (location, category, stratif)
+        keys = ((locations[mask].astype(np.int64) * len(self.categories) + categories[mask])
+                * len(self.stratifs) + stratifs[mask])
+        groups, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        means = (np.bincount(inverse, weights=values[mask], minlength=len(groups))
+                 / np.bincount(inverse, minlength=len(groups)))
+
+        # order the groups like the dict engine: by state appearance, then by tuple appearance
+        present, state_first = np.unique(locations, return_index=True)
+        state_rank = np.zeros(len(self.locations), dtype=np.int64)
+        state_rank[present] = state_first
+        stride = len(self.categories) * len(self.stratifs)
+        order = np.lexsort((first, state_rank[groups // stride]))
+
+        ret = []
+        for group, mean in zip(groups[order].tolist(), means[order].tolist()):
+            tup = (self.location_names[group // stride],
+                   self.category_names[group // len(self.stratifs) % len(self.categories)],
+                   self.stratif_names[group % len(self.stratifs)])
+            ret.append((tup, mean))
+        return ret
+
+    def get_mean_by_category(self, question):
+        """ Compute all tuples (state, category, stratification_category) for all states """
+        return {str(tup): mean for tup, mean in self.__category_means(question)}
+
+    def get_state_mean_by_category(self, question, state):
+        """ Compute all tuples (state, category, stratification_category) for a state """
+        _, locations, _, _ = self.__question_columns(question)
+        if not (locations == self.locations.get(state, -1)).any():
+            raise KeyError(state)
+        return {state: {str(tup[1:]): mean
+                        for tup, mean in self.__category_means(question, state)}}
@@ -0,0 +1,139 @@
+""" Several datasets served side by side, loaded on demand within a memory budget """
+
+from threading import Lock
+import json
+import os
+import time
+
+from app.data_ingestor import create_ingestor
+from app.dataset_reloader import DatasetReloader
+
+def load_dataset_specs(config_path):
+    """ Read the DATASETS_CONFIG file: {"datasets": {name: spec}}
+
+    A spec is {"path": csv, "engine": "dict"/"columnar" (optional),
+    "best_is_min": [questions], "best_is_max": [questions]}, the two lists
+    defaulting to the nutrition survey ones.
+    """
+    with open(config_path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    specs = config.get("datasets", {})
+    for name, spec in specs.items():
+        if "path" not in spec:
+            raise ValueError(f"Dataset {name} has no path")
+    return specs
+
+class DatasetRegistry:
+    """ Named datasets next to the default one, each with its own ingestor and metadata
+
+    The default dataset is loaded at startup as before and is never unloaded; jobs
+    without a "dataset" field use it. A named dataset is loaded the first time a
+    job needs it. When the loaded datasets are estimated above memory_budget bytes,
+    the least recently used ones idle for more than idle_seconds are unloaded; a
+    job still running on one keeps its reference, a later job loads it again.
+    """
+    def __init__(self, t_pool, specs, memory_budget=0, idle_seconds=60):
+        """ memory_budget = 0 means no limit """
+
+        self.t_pool = t_pool
+        self.specs = specs
+        self.memory_budget = memory_budget
+        self.idle_seconds = idle_seconds
+
+        # one reloader per named dataset, for the lazy loads and the admin reloads
+        self.reloaders = {name: DatasetReloader(spec["path"], t_pool, self.builder(spec),
+                                                dataset=name)
+                          for name, spec in specs.items()}
+        self.load_locks = {name: Lock() for name in specs}
+        self.last_used = {}
+        self.lock = Lock()
+
+        # counters for the datasets endpoint
+        self.loads = 0
+        self.unloads = 0
+
+    @staticmethod
+    def builder(spec):
+        """ build(csv_path, progress=...) for the reloader, with the dataset's metadata """
+        def build(csv_path, progress=None):
+            return create_ingestor(csv_path, spec.get("engine"), progress,
+                                   spec.get("best_is_min"), spec.get("best_is_max"))
+        return build
+
+    def __contains__(self, name):
+        return name in self.specs
+
+    def get(self, name):
+        """ Ingestor of a named dataset, loaded on the calling thread if needed
+
+        KeyError for a dataset that is not registered.
+        """
+        if name not in self.specs:
+            raise KeyError(name)
+        ingestor = self.t_pool.ingestors.get(name)
+        if ingestor is None:
+            # concurrent jobs of a dataset being loaded wait for that one load
+            with self.load_locks[name]:
+                ingestor = self.t_pool.ingestors.get(name)
+                if ingestor is None:
+                    ingestor = self.reloaders[name].load()
+                    with self.t_pool.csv_access_lock:
+                        self.t_pool.set_ingestor(ingestor, name)
+                    with self.lock:
+                        self.loads += 1
+        with self.lock:
+            self.last_used[name] = time.monotonic()
+        self.enforce_budget(keep=name)
+        return ingestor
+
+    def memory_used(self):
+        """ Estimated bytes of the loaded datasets, the default one included """
+        total = sum(ingestor.memory_bytes() for ingestor in list(self.t_pool.ingestors.values()))
+        if self.t_pool.ingestor is not None:
+            total += self.t_pool.ingestor.memory_bytes()
+        return total
+
+    def enforce_budget(self, keep=None):
+        """ Unload idle datasets, least recently used first, until the budget is met """
+        if not self.memory_budget:
+            return
+        now = time.monotonic()
+        while self.memory_used() > self.memory_budget:
+            with self.lock:
+                idle = [(used, name) for name, used in self.last_used.items()
+                        if name != keep and name in self.t_pool.ingestors
+                        and now - used > self.idle_seconds]
+            if not idle:
+                return
+            _, name = min(idle)
+            with self.t_pool.csv_access_lock:
+                self.t_pool.drop_ingestor(name)
+            with self.lock:
+                self.unloads += 1
+
+    def stats(self):
+        """ Every registered dataset with its state, and the budget """
+        now = time.monotonic()
+        with self.lock:
+            last_used = dict(self.last_used)
+            counters = {"loads": self.loads, "unloads": self.unloads}
+        datasets = {}
+        for name, spec in self.specs.items():
+            ingestor = self.t_pool.ingestors.get(name)
+            datasets[name] = {"path": spec["path"], "loaded": ingestor is not None,
+                              "memory_bytes": ingestor.memory_bytes() if ingestor else 0,
+                              "idle_seconds": (now - last_used[name]
+                                               if name in last_used else None),
+                              "reload": self.reloaders[name].status()}
+        return {"datasets": datasets, "memory_used": self.memory_used(),
+                "memory_budget": self.memory_budget, **counters}
+
+def create_dataset_registry(t_pool):
+    """ Registry of the datasets in DATASETS_CONFIG (none if unset), attached to the pool """
+    config_path = os.environ.get('DATASETS_CONFIG')
+    specs = load_dataset_specs(config_path) if config_path else {}
+    registry = DatasetRegistry(t_pool, specs,
+                               int(os.environ.get('DATASETS_MEMORY_BYTES', '0')),
+                               float(os.environ.get('DATASETS_IDLE_SECONDS', '60')))
+    t_pool.datasets = registry
+    return registry
@@ -0,0 +1,166 @@
+""" Hot reload of the dataset: build a new ingestor in the background and swap it in """
+
+from threading import Lock, Thread
+import csv
+import os
+import time
+
+from app.data_ingestor import IngestProgress
+
+class DatasetReloader:
+    """ Rebuilds the ingestor on demand (admin endpoint) or when the csv changes (watch)
+
+    The new ingestor is built on a background thread while the current one keeps
+    answering; only then is it published with t_pool.set_ingestor, under the same
+    lock as the first merge. The job ids, the queue and the jobs in flight are
+    untouched, a job that started on the previous dataset finishes on it.
+    """
+    def __init__(self, csv_path, t_pool, build, publish=None, dataset=None):
+        """ build(csv_path, progress=...) -> ingestor, publish(ingestor) makes it the webserver's one
+
+        dataset names a dataset other than the default one, see DatasetRegistry.
+        """
+
+        self.csv_path = csv_path
+        # a reload path must lie in here, DATASET_DIR or the directory of the first csv
+        self.dataset_dir = os.path.realpath(os.environ.get('DATASET_DIR')
+                                            or os.path.dirname(os.path.abspath(csv_path)))
+        self.t_pool = t_pool
+        self.build = build
+        self.publish = publish
+        self.dataset = dataset
+
+        self.lock = Lock()
+        self.loading = False
+        # appends build on the current version one after the other
+        self.append_lock = Lock()
+        # parsing progress of the latest build, the first load included
+        self.progress = IngestProgress()
+
+        # status for the admin endpoint
+        self.reloads = 0
+        self.failures = 0
+        self.appends = 0
+        self.appended_rows = 0
+        self.last_error = None
+        self.last_duration = 0.0
+        self.loaded_at = time.time()
+
+    def reload(self, csv_path=None):
+        """ Start rebuilding from csv_path (default: the current one), False if one is running """
+        with self.lock:
+            if self.loading:
+                return False
+            self.loading = True
+            self.progress = IngestProgress()
+        Thread(target=self.run_reload, args=(csv_path or self.csv_path,), daemon=True).start()
+        return True
+
+    def path_allowed(self, path):
+        """ Whether a reload may read path: a file under dataset_dir, symlinks resolved """
+        if not isinstance(path, str) or not path:
+            return False
+        return os.path.commonpath([self.dataset_dir, os.path.realpath(path)]) == self.dataset_dir
+
+    def load(self):
+        """ First load, on the calling thread: errors propagate, there is no dataset to keep """
+        try:
+            ingestor = self.build(self.csv_path, progress=self.progress)
+        except (OSError, ValueError, KeyError, IndexError, csv.Error) as e:
+            with self.lock:
+                self.failures += 1
+                self.last_error = f"{self.csv_path}: {e}"
+            raise
+        self.loaded_at = time.time()
+        return ingestor
+
+    def run_reload(self, csv_path):
+        """ Build the ingestor, then swap it in; on error the current dataset stays """
+        start = time.monotonic()
+        try:
+            ingestor = self.build(csv_path, progress=self.progress)
+        except (OSError, ValueError, KeyError, IndexError, csv.Error) as e:
+            with self.lock:
+                self.loading = False
+                self.failures += 1
+                self.last_error = f"{csv_path}: {e}"
+            return
+
+        with self.t_pool.csv_access_lock:
+            if self.publish:
+                self.publish(ingestor)
+            self.t_pool.set_ingestor(ingestor, self.dataset)
+            # a background first load: the jobs queued meanwhile can start
+            self.t_pool.merging_csv.set()
+
+        with self.lock:
+            self.loading = False
+            self.csv_path = csv_path
+            self.reloads += 1
+            self.last_error = None
+            self.last_duration = time.monotonic() - start
+            self.loaded_at = time.time()
+
+    def append(self, rows):
+        """ Publish a new version of the loaded dataset with rows added, None during a reload
+
+        Returns the new version. The dataset must be loaded (merged into the pool).
+        The rows only live in memory: a reload rebuilds from the csv.
+        """
+        with self.append_lock:
+            with self.lock:
+                if self.loading:
+                    return None
+            if self.dataset is None:
+                current = self.t_pool.ingestor
+            else:
+                current = self.t_pool.ingestors[self.dataset]
+            ingestor = current.appended(rows)
+
+            with self.t_pool.csv_access_lock:
+                if self.publish:
+                    self.publish(ingestor)
+                self.t_pool.set_ingestor(ingestor, self.dataset)
+            with self.lock:
+                self.appends += 1
+                self.appended_rows += len(rows)
+            return ingestor.version
+
+    def watch(self, interval):
+        """ Reload whenever the csv changes, checking its size and mtime every interval seconds """
+        Thread(target=self.run_watch, args=(interval,), daemon=True).start()
+
+    def run_watch(self, interval):
+        """ Body of the watch thread, a change must hold for one interval (the copy is over) """
+        last = self.file_state()
+        seen = last
+        while not self.t_pool.shutdown_event.wait(interval):
+            current = self.file_state()
+            if current != seen:
+                # still being written, look again next time
+                seen = current
+                continue
+            if current != last and current is not None and self.reload():
+                last = current
+
+    def file_state(self):
+        """ (size, mtime) of the csv, None while it is missing """
+        try:
+            stat = os.stat(self.csv_path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def status(self):
+        """ Dataset version, path and the outcome of the last reloads """
+        if self.dataset is None:
+            ingestor = self.t_pool.ingestor
+        else:
+            ingestor = self.t_pool.ingestors.get(self.dataset)
+        with self.lock:
+            return {"version": getattr(ingestor, "version", None), "path": self.csv_path,
+                    "loading": self.loading, "reloads": self.reloads,
+                    "failures": self.failures, "last_error": self.last_error,
+                    "appends": self.appends, "appended_rows": self.appended_rows,
+                    "last_duration": self.last_duration, "loaded_at": self.loaded_at,
+                    "progress": self.progress.as_dict()}
@@ -0,0 +1,50 @@
+""" Job completion events, so clients can wait for results instead of polling """
+
+from collections import deque
+from threading import Condition, Event, Lock
+
+class JobEvents:
+    """ Published by build_answer every time a job is marked as done """
+    def __init__(self, history=4096):
+        """ Keep the last history completions for the event streams to catch up on """
+
+        # (sequence number, job_id) of the latest completions
+        self.log = deque(maxlen=history)
+        self.seq = 0
+        self.log_cond = Condition()
+
+        # job_id -> event set when that job is done, only for jobs somebody waits on
+        self.waiters = {}
+        self.waiters_lock = Lock()
+
+    def publish(self, job_id):
+        """ Announce that job_id is done, its status must already be "done" """
+        with self.waiters_lock:
+            event = self.waiters.pop(job_id, None)
+        if event is not None:
+            event.set()
+
+        with self.log_cond:
+            self.seq += 1
+            self.log.append((self.seq, job_id))
+            self.log_cond.notify_all()
+
+    def wait_job(self, job_id, is_running, timeout):
+        """ Block until job_id is done or timeout passes, is_running() checks the status """
+        with self.waiters_lock:
+            # checked under the lock, so publish can't slip between the check and the wait
+            if not is_running():
+                return
+            event = self.waiters.setdefault(job_id, Event())
+        event.wait(timeout)
+
+    def wait_since(self, seq, timeout):
+        """ Completions after seq, waiting up to timeout for at least one """
+        with self.log_cond:
+            self.log_cond.wait_for(lambda: self.seq > seq, timeout)
+            return [entry for entry in self.log if entry[0] > seq]
+
+    def last_seq(self):
+        """ Sequence number of the latest completion """
+        with self.log_cond:
+            return self.seq
@@ -0,0 +1,222 @@
+""" Statuses of the job ids, compact and with a bounded lifetime """
+
+from array import array
+from threading import Lock
+import time
+
+# status codes, one byte per job
+UNKNOWN = 0
+RUNNING = 1
+DONE = 2
+STATUS_NAMES = {RUNNING: "running", DONE: "done"}
+
+class JobRegistry:
+    """ job_id_N -> status, stored as a byte per job in a window of consecutive ids
+
+    Ids are handed out in increasing order, so the statuses live in a bytearray
+    indexed by id - first_id, and times in a parallel array (creation while running,
+    finish once done). Retention drops jobs from the front of the window once there
+    are more than max_count jobs or they are more than max_age seconds old;
+    on_evict(job_id) is called for each done one so its result can go as well. A
+    job still running at the front leaves the window for the stragglers dict, so a
+    stuck job never holds back the retention; it is evicted in turn once done and
+    too old, or more than max_count ids behind the window.
+    """
+    def __init__(self, max_count=0, max_age=0, on_evict=None):
+        """ max_count / max_age = 0 means no limit """
+
+        self.max_count = max_count
+        self.max_age = max_age
+        self.on_evict = on_evict
+
+        # statuses[i] and stamps[i] belong to job first_id + i - head
+        self.statuses = bytearray()
+        self.stamps = array('d')
+        # job number -> [status, stamp] of the jobs still running when they left the window
+        self.stragglers = {}
+        self.head = 0
+        self.first_id = 1
+        self.next_id = 1
+
+        # O(1) answers for num_jobs
+        self.running = 0
+        self.done = 0
+        self.evicted = 0
+
+        self.lock = Lock()
+
+    @staticmethod
+    def job_number(job_id):
+        """ "job_id_N" -> N, None for anything else """
+        prefix, _, number = str(job_id).rpartition("_")
+        if prefix != "job_id" or not number.isdigit():
+            return None
+        return int(number)
+
+    def create(self):
+        """ Allocate the next job_id, with status running """
+        with self.lock:
+            number = self.next_id
+            self.next_id += 1
+            self.statuses.append(RUNNING)
+            self.stamps.append(time.monotonic())
+            self.running += 1
+            evicted = self.collect()
+        self.notify_evicted(evicted)
+        return "job_id_" + str(number)
+
+    def restore(self, job_ids):
+        """ Register saved job ids as running again, before any create
+
+        The ids in between stay unknown (invalid), the next new job comes after them.
+        """
+        numbers = [number for number in map(self.job_number, job_ids) if number is not None]
+        if not numbers:
+            return
+        with self.lock:
+            self.first_id = min(numbers)
+            self.next_id = max(numbers) + 1
+            self.head = 0
+            self.statuses = bytearray(self.next_id - self.first_id)
+            self.stamps = array('d', [time.monotonic()]) * len(self.statuses)
+            self.stragglers = {}
+            for number in numbers:
+                self.statuses[number - self.first_id] = RUNNING
+            self.running = len(set(numbers))
+
+    def mark_done(self, job_id):
+        """ The job has its result stored """
+        number = self.job_number(job_id)
+        with self.lock:
+            pos = self.position(number)
+            if pos is not None and self.statuses[pos] == RUNNING:
+                self.statuses[pos] = DONE
+                self.stamps[pos] = time.monotonic()
+            elif self.stragglers.get(number, [None])[0] == RUNNING:
+                self.stragglers[number] = [DONE, time.monotonic()]
+            else:
+                return
+            self.running -= 1
+            self.done += 1
+            evicted = self.collect()
+        self.notify_evicted(evicted)
+
+    def get(self, job_id):
+        """ "running", "done" or None for ids that never existed or were evicted """
+        number = self.job_number(job_id)
+        with self.lock:
+            pos = self.position(number)
+            if pos is None:
+                return STATUS_NAMES.get(self.stragglers.get(number, [None])[0])
+            return STATUS_NAMES.get(self.statuses[pos])
+
+    def position(self, number):
+        """ Index of a job number in the arrays, None if outside the window """
+        if number is None or number < self.first_id or number >= self.next_id:
+            return None
+        return number - self.first_id + self.head
+
+    def snapshot(self, start=1, locked=False):
+        """ (first job number, bytes of statuses) from job number start to the newest job
+
+        Only a byte copy happens under the lock, the caller decodes it at leisure;
+        locked=True when the caller already holds it.
+        """
+        if not locked:
+            with self.lock:
+                return self.snapshot(start, locked=True)
+        start = max(start, self.first_id)
+        pos = self.position(start)
+        if pos is None:
+            return start, b""
+        return start, bytes(self.statuses[pos:])
+
+    def items(self, start=1):
+        """ Iterate (job_id, status) over a consistent snapshot, oldest first """
+        # one lock for both: a job moving to the stragglers in between would be in neither
+        with self.lock:
+            stragglers = sorted((number, entry[0]) for number, entry in self.stragglers.items()
+                                if number >= start)
+            first_id, statuses = self.snapshot(start, locked=True)
+        for number, code in stragglers:
+            yield "job_id_" + str(number), STATUS_NAMES[code]
+        for i, code in enumerate(statuses):
+            if code in STATUS_NAMES:
+                yield "job_id_" + str(first_id + i), STATUS_NAMES[code]
+
+    def page(self, start=1, status=None, limit=0):
+        """ Iterate (job_id, status) from job number start on, only status if given
+
+        At most limit items (0 = no limit); when more jobs match, a last
+        (None, cursor) item gives the job number the next page starts from.
+        """
+        count = 0
+        for job_id, job_status in self.items(start):
+            if status and job_status != status:
+                continue
+            if limit and count == limit:
+                yield None, self.job_number(job_id)
+                return
+            yield job_id, job_status
+            count += 1
+
+    def collect(self):
+        """ Evict jobs from the front of the window, called with the lock held """
+        evicted = []
+        now = time.monotonic()
+        while self.head < len(self.statuses):
+            status = self.statuses[self.head]
+            size = len(self.statuses) - self.head
+            too_many = self.max_count and size > self.max_count
+            too_old = self.max_age and now - self.stamps[self.head] > self.max_age
+            if not (too_many or too_old or status == UNKNOWN):
+                break
+            if status == RUNNING:
+                # still running (or stuck): out of the window, tracked aside
+                self.stragglers[self.first_id] = [RUNNING, self.stamps[self.head]]
+            else:
+                if status == DONE:
+                    self.done -= 1
+                    evicted.append("job_id_" + str(self.first_id))
+                self.evicted += 1
+            self.head += 1
+            self.first_id += 1
+
+        if self.stragglers:
+            evicted += self.collect_stragglers(now)
+
+        # compact once the dead prefix is the bigger half, amortized O(1) per job
+        if self.head and self.head * 2 >= len(self.statuses):
+            del self.statuses[:self.head]
+            del self.stamps[:self.head]
+            self.head = 0
+        return evicted
+
+    def collect_stragglers(self, now):
+        """ Evict the finished stragglers that are too old or too far behind, lock held """
+        evicted = []
+        for number, (status, stamp) in list(self.stragglers.items()):
+            if status != DONE:
+                continue
+            too_old = self.max_age and now - stamp > self.max_age
+            too_far = self.max_count and self.first_id - number > self.max_count
+            if too_old or too_far:
+                del self.stragglers[number]
+                self.done -= 1
+                self.evicted += 1
+                evicted.append("job_id_" + str(number))
+        return evicted
+
+    def notify_evicted(self, evicted):
+        """ Let the owner drop what belongs to the evicted jobs, outside the lock """
+        if self.on_evict:
+            for job_id in evicted:
+                self.on_evict(job_id)
+
+    def stats(self):
+        """ Counters for num_jobs and the stats endpoint """
+        with self.lock:
+            return {"running": self.running, "done": self.done, "evicted": self.evicted,
+                    "window": len(self.statuses) - self.head,
+                    "stragglers": len(self.stragglers),
+                    "max_count": self.max_count, "max_age": self.max_age}
@@ -0,0 +1,135 @@
+""" Logging of the webserver: rotating file, optional queue thread, sampling and JSON lines """
+
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import Queue, Full
+from threading import Lock
+import atexit
+import json
+import logging
+import os
+import random
+import time
+
+from flask import g, has_request_context
+
+class JsonFormatter(logging.Formatter):
+    """ One json object per line: time (UTC), level, logger, thread, message, exception """
+    def format(self, record):
+        entry = {"time": datetime.fromtimestamp(record.created, timezone.utc)
+                         .isoformat(timespec="milliseconds"),
+                 "level": record.levelname, "logger": record.name,
+                 "thread": record.threadName, "message": record.getMessage()}
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class SampledInfoFilter(logging.Filter):
+    """ Keep a rate of the INFO (and lower) records; warnings and errors always pass
+
+    Inside a request the choice is made once, so a request keeps all its lines or
+    none of them; outside (workers, reloads) every record is drawn on its own.
+    """
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.lock = Lock()
+        self.dropped = 0
+
+    def filter(self, record):
+        if record.levelno > logging.INFO or self.rate >= 1:
+            return True
+        if has_request_context():
+            if "log_sampled" not in g:
+                g.log_sampled = random.random() < self.rate
+            keep = g.log_sampled
+        else:
+            keep = random.random() < self.rate
+        if not keep:
+            with self.lock:
+                self.dropped += 1
+        return keep
+
+class DroppingQueueHandler(QueueHandler):
+    """ Enqueue the record as it is, dropping it (counted) when the queue is full
+
+    The queue stays in the process, so nothing is formatted or pickled on the
+    calling thread: the message is built by the listener thread. The arguments of
+    a log call must not be changed after it.
+    """
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.lock = Lock()
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            with self.lock:
+                self.dropped += 1
+
+class LogPipeline:
+    """ The handlers attached to the app logger, and their counters for the stats endpoint """
+    def __init__(self, sampler, queue_handler=None, listener=None):
+        self.sampler = sampler
+        self.queue_handler = queue_handler
+        self.listener = listener
+
+    def stop(self):
+        """ Write out what is still queued, the listener thread exits """
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def stats(self):
+        """ Mode, sampling and drop counters """
+        stats = {"async": self.queue_handler is not None, "sample_rate": self.sampler.rate,
+                 "sampled_out": self.sampler.dropped}
+        if self.queue_handler is not None:
+            stats["queued"] = self.queue_handler.queue.qsize()
+            stats["dropped"] = self.queue_handler.dropped
+        return stats
+
+def configure_logging(logger):
+    """ Attach the handlers chosen by the LOG_* variables to logger
+
+    LOG_FILE (webserver.log) rotates at LOG_MAX_BYTES into LOG_BACKUP_COUNT files,
+    LOG_FORMAT=json writes json lines instead of text, LOG_SAMPLE_RATE keeps that
+    fraction of the INFO lines. With LOG_ASYNC=1 the calling threads only put the
+    records in a queue of LOG_QUEUE_SIZE; a listener thread formats and writes
+    them to the file and to the console handlers of basicConfig.
+    """
+    logging.basicConfig(level=logging.INFO)
+
+    file_handler = RotatingFileHandler(os.environ.get('LOG_FILE', 'webserver.log'), mode='a',
+                                       maxBytes=int(os.environ.get('LOG_MAX_BYTES', '60000')),
+                                       backupCount=int(os.environ.get('LOG_BACKUP_COUNT', '10')))
+    if os.environ.get('LOG_FORMAT', 'text') == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+        formatter.converter = time.gmtime
+    file_handler.setFormatter(formatter)
+
+    sampler = SampledInfoFilter(float(os.environ.get('LOG_SAMPLE_RATE', '1')))
+    logger.addFilter(sampler)
+
+    if os.environ.get('LOG_ASYNC', '0') != '1':
+        logger.addHandler(file_handler)
+        return LogPipeline(sampler)
+
+    queue_handler = DroppingQueueHandler(Queue(int(os.environ.get('LOG_QUEUE_SIZE', '10000'))))
+    # the console output moves to the listener thread as well, same handlers and levels
+    listener = QueueListener(queue_handler.queue, file_handler, *logging.getLogger().handlers,
+                             respect_handler_level=True)
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+    listener.start()
+
+    pipeline = LogPipeline(sampler, queue_handler, listener)
+    atexit.register(pipeline.stop)
+    return pipeline
@@ -0,0 +1,166 @@
+""" Prometheus text exposition of the server internals, with per-stage latency histograms """
+
+from threading import Lock
+import bisect
+
+# upper bounds in seconds, from the microsecond statistics to the slow disk writes
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PREFIX = "webserver_"
+
+HELP = {
+    "job_stage_seconds": "Time of a job in each stage: submit (the POST handler), "
+                         "queue_wait, compute and result_write",
+    "jobs_submitted_total": "Jobs received by how they were answered: queued, cached, "
+                            "inline or rejected",
+}
+
+def escape(value):
+    """ A label value as the text format wants it """
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(labels):
+    """ {a="x",b="y"} from a tuple of (name, value) pairs, empty without labels """
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+class Histogram:
+    """ Bucket counts (the last one is +Inf), sum and count of one labelled series """
+    def __init__(self, size):
+        self.counts = [0] * (size + 1)
+        self.sum = 0.0
+        self.count = 0
+
+class Metrics:
+    """ Histograms and counters recorded by the request handlers and the workers
+
+    Recording takes one short lock. The gauges (queue depth, jobs, cache, datasets)
+    are not recorded, they are read from the pool when /metrics is scraped.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # (name, sorted label pairs) -> Histogram / value
+        self.histograms = {}
+        self.counters = {}
+        self.lock = Lock()
+
+    def observe(self, name, seconds, **labels):
+        """ Add a duration to the histogram series of name and labels """
+        key = (name, tuple(sorted(labels.items())))
+        # le is inclusive: the first bound >= seconds
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(len(self.buckets))
+            histogram.counts[index] += 1
+            histogram.sum += seconds
+            histogram.count += 1
+
+    def inc(self, name, amount=1, **labels):
+        """ Add amount to the counter series of name and labels """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def render(self):
+        """ The recorded series in the text format, grouped by metric """
+        with self.lock:
+            histograms = {key: (list(h.counts), h.sum, h.count)
+                          for key, h in self.histograms.items()}
+            counters = dict(self.counters)
+
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines += header(name, "counter")
+            for (series, labels), value in sorted(counters.items()):
+                if series == name:
+                    lines.append(f"{PREFIX}{name}{format_labels(labels)} {value}")
+        for name in sorted({name for name, _ in histograms}):
+            lines += header(name, "histogram")
+            for (series, labels), (counts, total, count) in sorted(histograms.items()):
+                if series != name:
+                    continue
+                cumulative = 0
+                for bound, bucket in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += bucket
+                    lines.append(f"{PREFIX}{name}_bucket"
+                                 f"{format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{PREFIX}{name}_sum{format_labels(labels)} {total}")
+                lines.append(f"{PREFIX}{name}_count{format_labels(labels)} {count}")
+        return lines
+
+def header(name, kind, text=None):
+    """ The HELP and TYPE lines of a metric """
+    return [f"# HELP {PREFIX}{name} {text or HELP.get(name, name)}",
+            f"# TYPE {PREFIX}{name} {kind}"]
+
+def sample_lines(name, kind, text, samples):
+    """ A whole metric from [(labels dict, value)] read at scrape time """
+    lines = header(name, kind, text)
+    for labels, value in samples:
+        lines.append(f"{PREFIX}{name}{format_labels(tuple(labels.items()))} {value}")
+    return lines
+
+def pool_lines(t_pool):
+    """ Gauges and counters kept by the pool itself: queue, jobs, workers, cache, admission """
+    jobs = t_pool.jobs.stats()
+    cache = t_pool.result_cache.stats()
+    admission = t_pool.admission.stats()
+    workers = t_pool.worker_stats()
+    lines = sample_lines("queue_depth", "gauge", "Jobs waiting in the queue, per priority class",
+                         [({"class": name}, entry["depth"])
+                          for name, entry in t_pool.scheduler_stats().items()])
+    lines += sample_lines("jobs", "gauge", "Jobs retained in the registry, by status",
+                          [({"status": "running"}, jobs["running"]),
+                           ({"status": "done"}, jobs["done"])])
+    lines += sample_lines("jobs_evicted_total", "counter", "Job ids dropped by the retention",
+                          [({}, jobs["evicted"])])
+    lines += sample_lines("jobs_coalesced_total", "counter",
+                          "Jobs answered with the result of an identical job in flight",
+                          [({}, t_pool.coalescing_stats()["coalesced_jobs"])])
+    lines += sample_lines("workers", "gauge", "Active workers", [({}, workers["active"])])
+    lines += sample_lines("worker_busy_seconds_total", "counter",
+                          "Time the workers spent on jobs; utilization is its rate over workers",
+                          [({}, t_pool.utilization_sample()[0])])
+    lines += sample_lines("result_cache_requests_total", "counter", "Result cache lookups",
+                          [({"result": "hit"}, cache["hits"]),
+                           ({"result": "miss"}, cache["misses"])])
+    lines += sample_lines("result_cache_hit_ratio", "gauge", "Result cache hits over lookups",
+                          [({}, cache["hit_rate"])])
+    lines += sample_lines("result_cache_entries", "gauge", "Results in the cache",
+                          [({}, cache["size"])])
+    lines += sample_lines("admission_rejected_total", "counter", "Jobs refused at submission",
+                          [({"reason": "overload"}, admission["rejected_overload"]),
+                           ({"reason": "rate"}, admission["rejected_rate"])])
+    return lines
+
+def dataset_lines(reloaders):
+    """ Ingestion time, size and reloads of every dataset, from {name: DatasetReloader} """
+    statuses = {name: reloader.status() for name, reloader in reloaders.items()}
+    lines = sample_lines("dataset_ingest_seconds", "gauge",
+                         "Duration of the latest completed ingestion of the dataset",
+                         [({"dataset": name}, status["progress"]["elapsed"])
+                          for name, status in statuses.items() if status["progress"]["done"]])
+    lines += sample_lines("dataset_rows", "gauge", "Rows read by the latest ingestion",
+                          [({"dataset": name}, status["progress"]["rows"])
+                           for name, status in statuses.items()])
+    lines += sample_lines("dataset_skipped_rows", "gauge",
+                          "Rows without a usable Data_Value in the latest ingestion",
+                          [({"dataset": name}, status["progress"]["skipped_rows"])
+                           for name, status in statuses.items()])
+    lines += sample_lines("dataset_loaded", "gauge", "1 when the dataset is in memory",
+                          [({"dataset": name}, int(status["version"] is not None))
+                           for name, status in statuses.items()])
+    lines += sample_lines("dataset_reloads_total", "counter", "Reloads, by outcome",
+                          [({"dataset": name, "outcome": outcome}, status[key])
+                           for name, status in statuses.items()
+                           for outcome, key in (("success", "reloads"), ("failure", "failures"))])
+    return lines
+
+def exposition(t_pool, reloaders):
+    """ The whole /metrics page """
+    lines = t_pool.metrics.render() + pool_lines(t_pool) + dataset_lines(reloaders)
+    return "\n".join(lines) + "\n"
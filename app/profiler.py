@@ -0,0 +1,113 @@
+""" Sampling profiler of the worker threads, aggregated as folded stacks for flamegraphs """
+
+from collections import Counter
+from threading import Event, Lock, Thread
+import math
+import os
+import sys
+import time
+
+def frame_label(frame):
+    """ file:function of a frame, as it shows in the flamegraph """
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}"
+
+class SamplingProfiler:
+    """ Every interval, the stack of each thread given by threads() is counted
+
+    threads() returns {thread ident: root label}; the pool gives the workers busy
+    on a job, so idle waits on the queue do not drown the profile. Only this thread
+    walks the frames, the workers are never interrupted. A run stops by itself
+    after max_seconds, in case nobody calls stop.
+    """
+    def __init__(self, threads):
+        self.threads = threads
+        self.lock = Lock()
+        self.stop_event = None
+        self.stacks = Counter()
+        self.samples = 0
+        self.interval = 0.0
+        self.started = None
+        self.stopped = None
+
+    def start(self, interval=0.01, max_seconds=300.0):
+        """ Start a new profile, False if one is running
+
+        ValueError unless both durations are positive and finite: a zero interval
+        would spin the sampling thread.
+        """
+        if not (0 < interval < math.inf and 0 < max_seconds < math.inf):
+            raise ValueError("interval and max_seconds must be positive seconds")
+        with self.lock:
+            if self.stop_event is not None:
+                return False
+            self.stop_event = Event()
+            self.stacks = Counter()
+            self.samples = 0
+            self.interval = interval
+            self.started = time.monotonic()
+            self.stopped = None
+        Thread(target=self.run, args=(self.stop_event, interval, max_seconds),
+               daemon=True).start()
+        return True
+
+    def stop(self):
+        """ End the profile and return its report (also after max_seconds), None if none started """
+        with self.lock:
+            if self.started is None:
+                return None
+            if self.stop_event is not None:
+                self.stop_event.set()
+                self.stop_event = None
+                self.stopped = time.monotonic()
+        return self.report()
+
+    def run(self, stop_event, interval, max_seconds):
+        """ Body of the sampling thread """
+        deadline = time.monotonic() + max_seconds
+        while not stop_event.wait(interval):
+            if time.monotonic() > deadline:
+                with self.lock:
+                    if self.stop_event is stop_event:
+                        self.stop_event = None
+                        self.stopped = time.monotonic()
+                return
+            self.sample()
+
+    def sample(self):
+        """ Count the current stack of every thread to profile, root first """
+        frames = sys._current_frames()
+        stacks = []
+        for ident, root in self.threads().items():
+            frame = frames.get(ident)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            stack.append(root)
+            stacks.append(";".join(reversed(stack)))
+        with self.lock:
+            self.samples += 1
+            self.stacks.update(stacks)
+
+    def report(self, top=20):
+        """ Folded stacks ("root;caller;callee count" lines) and the frames with the most self samples """
+        with self.lock:
+            stacks = Counter(self.stacks)
+            running = self.stop_event is not None
+            end = self.stopped if self.stopped is not None else time.monotonic()
+            duration = end - self.started if self.started is not None else 0.0
+            samples, interval = self.samples, self.interval
+        leaves = Counter()
+        for stack, count in stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        return {"running": running, "duration": duration, "interval": interval,
+                "samples": samples, "stack_samples": sum(stacks.values()),
+                "top": leaves.most_common(top), "folded": self.folded(stacks)}
+
+    @staticmethod
+    def folded(stacks):
+        """ The input format of flamegraph.pl and speedscope, most sampled first """
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
@@ -0,0 +1,98 @@
+""" Bounded LRU cache for job results, valid as long as the dataset version does not change """
+
+from collections import OrderedDict
+from threading import Lock
+import time
+
+class ResultCache:
+    """ LRU cache with a time to live, keyed on the normalized job parameters """
+    def __init__(self, max_size, ttl):
+        """ max_size = 0 disables the cache, ttl is in seconds (0 = never expires) """
+
+        self.max_size = max_size
+        self.ttl = ttl
+
+        # dataset name (None: the default one) -> version the entries were computed on
+        self.versions = {}
+
+        # key -> (expiry time, result), the most recently used entry is at the end
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+        # counters for the stats endpoint
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.stale_puts = 0
+
+    @staticmethod
+    def job_key(job):
+        """ Normalize a job to the parameters that determine its result, the dataset last """
+        if job["request_type"] == "batch_request":
+            return (job["request_type"], tuple(ResultCache.job_key(item) for item in job["jobs"]),
+                    job.get("dataset"))
+        return (job["request_type"], job["question"], job.get("state"), job.get("dataset"))
+
+    def get(self, key):
+        """ Get a cached result or None, refreshing its position in the LRU order """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            if self.ttl and entry[0] < time.monotonic():
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, result, version=None):
+        """ Save a result, evicting the least recently used entries above max_size
+
+        version is the dataset version the result was computed on: a result of an
+        older dataset (a job that started before a reload) is not cached.
+        """
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            if version is not None and version != self.versions.get(key[-1]):
+                self.stale_puts += 1
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def set_version(self, version, dataset=None):
+        """ A new version of dataset is live: drop its entries, only results of version are cached
+
+        version None (the dataset was unloaded) caches nothing more for it.
+        """
+        with self.lock:
+            self.versions[dataset] = version
+            for key in [key for key in self.entries if key[-1] == dataset]:
+                del self.entries[key]
+
+    def clear(self):
+        """ Drop every entry, the counters are kept """
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """ Snapshot of the counters """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self.entries), "max_size": self.max_size, "ttl": self.ttl,
+                    "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "evictions": self.evictions, "expirations": self.expirations,
+                    "versions": {("<default>" if name is None else name): version
+                                 for name, version in self.versions.items()},
+                    "stale_puts": self.stale_puts}
@@ -0,0 +1,226 @@
+""" Where the job results live between build_answer and get_results """
+
+from collections import OrderedDict
+from threading import Lock
+import glob
+import json
+import os
+
+def create_result_store():
+    """ Build the store selected by RESULT_STORE: file (default), memory or segment """
+    kind = os.environ.get('RESULT_STORE', 'file')
+    directory = os.environ.get('RESULT_STORE_DIR', 'results')
+    if kind == 'file':
+        return FileResultStore(directory)
+    if kind == 'memory':
+        return MemoryResultStore(int(os.environ.get('RESULT_STORE_MEMORY_BYTES', str(64 << 20))),
+                                 FileResultStore(directory))
+    if kind == 'segment':
+        return SegmentLogResultStore(directory,
+                                     int(os.environ.get('RESULT_STORE_SEGMENT_BYTES',
+                                                        str(64 << 20))))
+    raise ValueError(f"Unknown result store {kind}")
+
+class ResultStore:
+    """ Interface of the stores
+
+    put must only return once get can read the result: build_answer marks the
+    job as "done" right after put, so "done" always means "readable".
+    """
+    def put(self, job_id, content):
+        """ Save the result of job_id """
+        raise NotImplementedError
+
+    def get(self, job_id):
+        """ Read the result of job_id, KeyError if there is none """
+        raise NotImplementedError
+
+    def delete(self, job_id):
+        """ Forget the result of job_id, if any """
+        raise NotImplementedError
+
+    def stats(self):
+        """ Counters for the stats endpoint """
+        return {"kind": type(self).__name__}
+
+class FileResultStore(ResultStore):
+    """ One results/<job_id>.json file per job, the original layout """
+    def __init__(self, directory):
+        # Create the directory once, not for every job
+        self.directory = os.path.abspath(directory)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, job_id):
+        """ File of a job """
+        return os.path.join(self.directory, job_id + ".json")
+
+    def put(self, job_id, content):
+        # Write content to the file
+        try:
+            with open(self.path(job_id), "w", encoding="utf-8") as file:
+                json.dump(content, file)
+        except FileNotFoundError as e:
+            print(e)
+
+    def get(self, job_id):
+        try:
+            with open(self.path(job_id), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError as e:
+            raise KeyError(job_id) from e
+
+    def delete(self, job_id):
+        try:
+            os.remove(self.path(job_id))
+        except FileNotFoundError:
+            pass
+
+class MemoryResultStore(ResultStore):
+    """ Serialized results kept in RAM up to a byte budget, the oldest spill to another store
+
+    The spill store is written outside the lock: meanwhile the spilling results
+    stay readable from a dict of their own, so neither a get nor a put of another
+    job waits on the disk.
+    """
+    def __init__(self, byte_budget, spill_store):
+        self.byte_budget = byte_budget
+        self.spill_store = spill_store
+
+        # job_id -> json bytes, oldest first
+        self.entries = OrderedDict()
+        # job_id -> json bytes being written to the spill store
+        self.spilling = {}
+        self.bytes_used = 0
+        self.spilled = 0
+        self.lock = Lock()
+
+    def put(self, job_id, content):
+        raw = json.dumps(content).encode("utf-8")
+        spill = []
+        with self.lock:
+            self.entries[job_id] = raw
+            self.bytes_used += len(raw)
+            while self.bytes_used > self.byte_budget and self.entries:
+                old_id, old_raw = self.entries.popitem(last=False)
+                self.bytes_used -= len(old_raw)
+                self.spilling[old_id] = old_raw
+                spill.append((old_id, old_raw))
+
+        for old_id, old_raw in spill:
+            self.spill_store.put(old_id, json.loads(old_raw))
+            with self.lock:
+                # deleted meanwhile: the file must go as well
+                deleted = self.spilling.pop(old_id, None) is None
+                self.spilled += 1
+            if deleted:
+                self.spill_store.delete(old_id)
+
+    def get(self, job_id):
+        with self.lock:
+            raw = self.entries.get(job_id) or self.spilling.get(job_id)
+        if raw is None:
+            return self.spill_store.get(job_id)
+        return json.loads(raw)
+
+    def delete(self, job_id):
+        with self.lock:
+            raw = self.entries.pop(job_id, None)
+            if raw is not None:
+                self.bytes_used -= len(raw)
+                return
+            if self.spilling.pop(job_id, None) is not None:
+                # the spilling put deletes the file once written
+                return
+        self.spill_store.delete(job_id)
+
+    def stats(self):
+        with self.lock:
+            return {"kind": type(self).__name__, "entries": len(self.entries),
+                    "bytes_used": self.bytes_used, "byte_budget": self.byte_budget,
+                    "spilling": len(self.spilling), "spilled": self.spilled}
+
+class SegmentLogResultStore(ResultStore):
+    """ Results appended to a few large segment files, with an in-memory offset index
+
+    Segments of a previous run are removed at startup: job ids start again from 1,
+    so their results could only be mistaken for new ones. A segment is deleted
+    once none of its results is referenced anymore.
+    """
+    def __init__(self, directory, segment_bytes):
+        self.directory = os.path.abspath(directory)
+        self.segment_bytes = segment_bytes
+        os.makedirs(self.directory, exist_ok=True)
+        for old in glob.glob(os.path.join(self.directory, "segment_*.log")):
+            os.remove(old)
+
+        # job_id -> (segment number, offset, length)
+        self.index = {}
+        # segment number -> [read fd, live results]
+        self.segments = {}
+        self.lock = Lock()
+
+        self.segment_no = 0
+        self.write_fd = None
+        self.write_offset = 0
+        self.roll_segment()
+
+    def segment_path(self, segment_no):
+        """ File of a segment """
+        return os.path.join(self.directory, f"segment_{segment_no:06d}.log")
+
+    def roll_segment(self):
+        """ Start appending to a fresh segment, called with the lock held """
+        if self.write_fd is not None:
+            os.close(self.write_fd)
+            # everything in the previous segment may already be gone
+            if self.segments[self.segment_no][1] == 0:
+                self.drop_segment(self.segment_no)
+        self.segment_no += 1
+        path = self.segment_path(self.segment_no)
+        self.write_fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.segments[self.segment_no] = [os.open(path, os.O_RDONLY), 0]
+        self.write_offset = 0
+
+    def put(self, job_id, content):
+        raw = json.dumps(content).encode("utf-8") + b"\n"
+        with self.lock:
+            if self.write_offset and self.write_offset + len(raw) > self.segment_bytes:
+                self.roll_segment()
+            written = 0
+            while written < len(raw):
+                written += os.write(self.write_fd, raw[written:])
+            self.forget(job_id)
+            self.index[job_id] = (self.segment_no, self.write_offset, len(raw))
+            self.segments[self.segment_no][1] += 1
+            self.write_offset += len(raw)
+
+    def get(self, job_id):
+        with self.lock:
+            segment_no, offset, length = self.index[job_id]
+            # pread does not move a shared file position, one read fd serves every reader
+            raw = os.pread(self.segments[segment_no][0], length, offset)
+        return json.loads(raw)
+
+    def delete(self, job_id):
+        with self.lock:
+            self.forget(job_id)
+
+    def forget(self, job_id):
+        """ Drop job_id from the index and the dead segments, called with the lock held """
+        entry = self.index.pop(job_id, None)
+        if entry is None:
+            return
+        segment = self.segments[entry[0]]
+        segment[1] -= 1
+        if segment[1] == 0 and entry[0] != self.segment_no:
+            self.drop_segment(entry[0])
+
+    def drop_segment(self, segment_no):
+        """ Remove a segment without live results, called with the lock held """
+        os.close(self.segments.pop(segment_no)[0])
+        os.remove(self.segment_path(segment_no))
+
+    def stats(self):
+        with self.lock:
+            return {"kind": type(self).__name__, "entries": len(self.index),
+                    "segments": len(self.segments), "segment_bytes": self.segment_bytes}
@@ -1,8 +1,15 @@
 """ Server architecture """
 
+import hmac
 import json
-from flask import request, jsonify
+import os
+import time
+from flask import request, jsonify, Response, stream_with_context
 from app import webserver
+from app.data_ingestor import rows_from_csv_text, rows_from_records
+from app.metrics import exposition
+from app.result_cache import ResultCache
+from app.task_runner import REQUEST_TYPES
 
 # Example endpoint definition
 @webserver.route('/api/post_endpoint', methods=['POST'])
@@ -26,10 +33,49 @@ def merge_ingestor():
     """ At the first GET or POST request, create a field in ThreadPool for the ingestor """
     with webserver.tasks_runner.csv_access_lock:
         if not webserver.tasks_runner.ingestor and webserver.data_ingestor:
-            webserver.tasks_runner.ingestor = webserver.data_ingestor
+            webserver.tasks_runner.set_ingestor(webserver.data_ingestor)
             # Allow the threads to start execution
             webserver.tasks_runner.merging_csv.set()
 
+def admission_error(req):
+    """ None if the server takes the job, else the 503/429 response with Retry-After """
+    rejected = webserver.tasks_runner.admission.admit(client_id(req))
+    if rejected is None:
+        return None
+    code, reason, retry_after = rejected
+    webserver.logger.info("Refused %s POST: %s", req.url_rule, reason)
+    return (jsonify({"status": "error", "reason": reason}), code,
+            {"Retry-After": str(retry_after)})
+
+def client_id(req):
+    """ Who submits the job, for fair queuing: the X-API-Key header, else the IP """
+    return req.headers.get('X-API-Key') or req.remote_addr
+
+def job_dataset(data):
+    """ (dataset name or None for the default one, error response or None) of a request body """
+    name = data.get("dataset")
+    if name is None or name == os.environ.get('DEFAULT_DATASET', 'default'):
+        return None, None
+    if name not in webserver.datasets:
+        webserver.logger.info("Refused job for unknown dataset %s", name)
+        return None, jsonify({"status": "error", "reason": f"Unknown dataset {name}"})
+    return name, None
+
+def should_run_inline(req, job):
+    """ ?sync=1 forces an inline answer, ?sync=auto inlines jobs cheaper than the threshold
+
+    Without the flag, SYNC_MODE (off by default) decides, so clients keep the job_id flow.
+    Any other value counts as auto.
+    """
+    mode = req.args.get('sync', os.environ.get('SYNC_MODE', 'off')).lower()
+    if webserver.tasks_runner.ingestor is None or mode in ('0', 'false', 'off'):
+        return False
+    if mode in ('1', 'true', 'on'):
+        return True
+    # a dataset not loaded yet costs inf: its load goes to a worker, not the request thread
+    cost = webserver.tasks_runner.estimate_cost(job)
+    return cost <= float(os.environ.get('SYNC_COST_THRESHOLD', '100'))
+
 def generate_job(req):
     """ General method to parse request, create a job and put that job in queue """
 
@@ -37,9 +83,17 @@ def generate_job(req):
     if webserver.tasks_runner.shutdown_event.is_set():
         return jsonify({"job_id": -1, "reason": "shutdown"})
 
+    start = time.monotonic()
+    metrics = webserver.tasks_runner.metrics
     # beautify the request type
     request_type = str(req.url_rule).replace('/api/', '') + "_request"
 
+    # overloaded or too many jobs from this client: fail fast
+    rejected = admission_error(req)
+    if rejected:
+        metrics.inc("jobs_submitted_total", request_type=request_type, path="rejected")
+        return rejected
+
     webserver.logger.info("Received %s POST", request_type)
     # Get request data
     data = req.json
@@ -49,32 +103,158 @@ def generate_job(req):
 
     data_dict = {}
     data_dict["request_type"] = request_type
+    data_dict["client"] = client_id(req)
     data_dict["question"] = data["question"]
     if "state" in data.keys():
         data_dict["state"] = data["state"]
-    with webserver.tasks_runner.count_lock:
-        # Increment job_id counter
-        webserver.tasks_runner.id_counter += 1
-        job_id = "job_id_" + str(webserver.tasks_runner.id_counter)
-        webserver.tasks_runner.available_job_ids[job_id] = "running"
-    data_dict["job_id"] = job_id
-
-    # Register job. Don't wait for task to finish
-    webserver.tasks_runner.add_job(data_dict)
 
-    webserver.logger.info("Exited %s POST with %s", request_type, str(data_dict))
+    # a named dataset, else the default one
+    dataset, error = job_dataset(data)
+    if error:
+        return error
+    if dataset is not None:
+        data_dict["dataset"] = dataset
+
+    # cheap job: compute it right here, no job_id, no queue, no results file
+    if should_run_inline(req, data_dict):
+        try:
+            result = webserver.tasks_runner.compute_inline(data_dict)
+        except KeyError as e:
+            webserver.logger.info("Exited %s POST inline with unknown key %s", request_type, e)
+            return jsonify({"status": "error", "reason": f"Unknown key {e}"})
+        except (OSError, ValueError) as e:
+            # a named dataset that fails to load, answered as the workers do
+            webserver.logger.info("Exited %s POST inline, dataset unavailable: %s", request_type, e)
+            return jsonify({"status": "error", "reason": f"Dataset unavailable: {e}"})
+        webserver.logger.info("Exited %s POST inline", request_type)
+        metrics.inc("jobs_submitted_total", request_type=request_type, path="inline")
+        metrics.observe("job_stage_seconds", time.monotonic() - start,
+                        request_type=request_type, stage="submit")
+        return jsonify({"status": "done", "data": result})
+
+    job_id = submit_job(data_dict)
+    metrics.observe("job_stage_seconds", time.monotonic() - start,
+                    request_type=request_type, stage="submit")
+
+    webserver.logger.info("Exited %s POST with %s", request_type, data_dict)
     # Return associated job_id
     return jsonify({"job_id": job_id, "status": "success"})
 
+def submit_job(data_dict):
+    """ Allocate a job_id for the job and get it answered, returns the job_id """
+    # next job_id, registered as running
+    job_id = webserver.tasks_runner.jobs.create()
+    data_dict["job_id"] = job_id
+
+    # Same parameters already computed: complete the job right away, skipping the queue
+    result = webserver.tasks_runner.result_cache.get(ResultCache.job_key(data_dict))
+    if result is not None:
+        webserver.tasks_runner.build_answer(data_dict, result)
+    else:
+        # Register job. Don't wait for task to finish
+        webserver.tasks_runner.add_job(data_dict)
+    webserver.tasks_runner.metrics.inc("jobs_submitted_total",
+                                       request_type=data_dict["request_type"],
+                                       path="queued" if result is None else "cached")
+    return job_id
+
+@webserver.route('/api/batch', methods=['POST'])
+def batch_request():
+    """ Announce a list of jobs computed together: {"jobs": [{request_type, question, state}]}
+
+    An optional top-level "dataset" picks the dataset of all of them.
+
+    The whole batch gets one id, its result is the list of per-job items in order.
+    """
+
+    # we previously received shutdown, return that the server is now "closed"
+    if webserver.tasks_runner.shutdown_event.is_set():
+        return jsonify({"batch_id": -1, "reason": "shutdown"})
+
+    rejected = admission_error(request)
+    if rejected:
+        webserver.tasks_runner.metrics.inc("jobs_submitted_total", request_type="batch_request",
+                                           path="rejected")
+        return rejected
+
+    webserver.logger.info("Received batch_request POST")
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get("jobs"), list) or not data["jobs"] \
+            or not all(isinstance(spec, dict) for spec in data["jobs"]):
+        webserver.logger.info("Exited batch_request POST with a malformed body")
+        return jsonify({"status": "error", "reason": "Expected {\"jobs\": [objects]}"}), 400
+    merge_ingestor()
+
+    dataset, error = job_dataset(data)
+    if error:
+        return error
+
+    jobs = []
+    for spec in data["jobs"]:
+        # accept "states_mean", "/api/states_mean" and "states_mean_request"
+        request_type = str(spec.get("request_type", "")).replace('/api/', '')
+        if not request_type.endswith("_request"):
+            request_type += "_request"
+        if request_type not in REQUEST_TYPES or "question" not in spec:
+            webserver.logger.info("Exited batch_request POST with invalid job %s", spec)
+            return jsonify({"status": "error", "reason": f"Invalid job {spec}"})
+
+        job = {"request_type": request_type, "question": spec["question"]}
+        if "state" in spec:
+            job["state"] = spec["state"]
+        jobs.append(job)
+
+    batch = {"request_type": "batch_request", "jobs": jobs, "client": client_id(request)}
+    if dataset is not None:
+        batch["dataset"] = dataset
+    batch_id = submit_job(batch)
+
+    webserver.logger.info("Exited batch_request POST with %s and %d jobs", batch_id, len(jobs))
+    return jsonify({"batch_id": batch_id, "status": "success"})
+
 @webserver.route('/api/jobs', methods=['GET'])
 def get_all_jobs():
-    """ Iterate through all entries in the dictionary and retreive job status """
+    """ Iterate through the jobs in the registry and retreive job status
+
+    Optional query arguments:
+      - status=running|done: only jobs with that status
+      - since_id=job_id_N: only jobs newer than job_id_N
+      - limit=K and cursor=C: at most K jobs per page, starting where the previous page's
+        next_cursor points; next_cursor is null on the last page
+    The response is encoded while being sent, from a snapshot of the registry.
+    """
 
     webserver.logger.info("Received /api/jobs GET")
     merge_ingestor()
-    webserver.logger.info("/api/jobs - done")
-    data = [{key: value} for key, value in webserver.tasks_runner.available_job_ids.items()]
-    return jsonify({"status" : "done", "data" : data})
+
+    status = request.args.get('status')
+    limit = request.args.get('limit', 0, type=int)
+    start = request.args.get('cursor', 1, type=int)
+    since = webserver.tasks_runner.jobs.job_number(request.args.get('since_id', ''))
+    if since is not None:
+        start = max(start, since + 1)
+
+    def stream():
+        yield '{"status": "done", "data": ['
+        count = 0
+        next_cursor = None
+        chunk = []
+        for job_id, job_status in webserver.tasks_runner.jobs.page(start, status, limit):
+            if job_id is None:
+                # there is at least one more match: the next page starts here
+                next_cursor = str(job_status)
+                break
+            chunk.append(json.dumps({job_id: job_status}))
+            count += 1
+            if len(chunk) == 1000:
+                yield (", " if count > len(chunk) else "") + ", ".join(chunk)
+                chunk = []
+        if chunk:
+            yield (", " if count > len(chunk) else "") + ", ".join(chunk)
+        yield f'], "next_cursor": {json.dumps(next_cursor)}}}'
+        webserver.logger.info("/api/jobs - done with %d jobs", count)
+
+    return Response(stream(), mimetype='application/json')
 
 @webserver.route('/api/num_jobs', methods=['GET'])
 def get_num_jobs():
@@ -82,9 +262,180 @@ def get_num_jobs():
 
     webserver.logger.info("Received /api/num_jobs GET")
     merge_ingestor()
-    res = list(filter(lambda x: x == "running", webserver.tasks_runner.available_job_ids.values()))
-    webserver.logger.info("/api/num_jobs with %d running - done", len(res))
-    return jsonify({"status" : "done", "data" : res})
+    running = webserver.tasks_runner.jobs.stats()["running"]
+    webserver.logger.info("/api/num_jobs with %d running - done", running)
+    return jsonify({"status" : "done", "data" : running})
+
+@webserver.route('/api/stats', methods=['GET'])
+def get_stats():
+    """ Counters of the server internals """
+
+    webserver.logger.info("Received /api/stats GET")
+    data = {"result_cache": webserver.tasks_runner.result_cache.stats(),
+            "result_store": webserver.tasks_runner.result_store.stats(),
+            "jobs": webserver.tasks_runner.jobs.stats(),
+            "scheduler": webserver.tasks_runner.scheduler_stats(),
+            "admission": webserver.tasks_runner.admission.stats(),
+            "coalescing": webserver.tasks_runner.coalescing_stats(),
+            "workers": webserver.tasks_runner.worker_stats(),
+            "logging": webserver.log_pipeline.stats()}
+    return jsonify({"status" : "done", "data" : data})
+
+@webserver.route('/metrics', methods=['GET'])
+def get_metrics():
+    """ The stats in the Prometheus text format, with the per-stage latency histograms """
+
+    reloaders = {os.environ.get('DEFAULT_DATASET', 'default'): webserver.dataset_reloader,
+                 **webserver.datasets.reloaders}
+    return Response(exposition(webserver.tasks_runner, reloaders),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@webserver.route('/api/ready', methods=['GET'])
+def ready():
+    """ Readiness: 200 once a dataset is loaded, 503 with the ingestion progress before """
+
+    reloader = webserver.dataset_reloader
+    if webserver.data_ingestor is None:
+        return jsonify({"status": "loading", "data": reloader.status()}), 503
+    return jsonify({"status": "ready", "data": reloader.status()})
+
+def admin_error(req):
+    """ None for an admin, else the 403 response; ADMIN_TOKEN unset closes the admin API """
+    token = os.environ.get('ADMIN_TOKEN')
+    if token and hmac.compare_digest(req.headers.get('X-Admin-Token', '').encode(),
+                                     token.encode()):
+        return None
+    webserver.logger.info("Refused admin %s %s", req.method, req.url_rule)
+    reason = "forbidden" if token else "admin API disabled, ADMIN_TOKEN is not set"
+    return jsonify({"status": "error", "reason": reason}), 403
+
+@webserver.route('/api/admin/reload', methods=['GET', 'POST'])
+def reload_dataset():
+    """ POST: rebuild the dataset in the background and swap it in, {"path": ...} optional
+
+    GET: the dataset version and how the last reload went. ?dataset= (or "dataset"
+    in the body) selects a named dataset instead of the default one.
+    """
+    forbidden = admin_error(request)
+    if forbidden:
+        return forbidden
+    data = request.get_json(silent=True) or {}
+    dataset, error = job_dataset({"dataset": data.get("dataset", request.args.get("dataset"))})
+    if error:
+        return error
+    if dataset is None:
+        reloader = webserver.dataset_reloader
+    else:
+        reloader = webserver.datasets.reloaders[dataset]
+
+    if request.method == 'GET':
+        return jsonify({"status": "done", "data": reloader.status()})
+
+    webserver.logger.info("Received /api/admin/reload POST")
+    path = data.get("path")
+    if path is not None and not reloader.path_allowed(path):
+        webserver.logger.info("Refused reload from %s", path)
+        return jsonify({"status": "error", "reason": "path outside the dataset directory"}), 403
+    if not reloader.reload(path):
+        return jsonify({"status": "error", "reason": "reload in progress"}), 409
+    webserver.logger.info("/api/admin/reload started")
+    return jsonify({"status": "reloading", "data": reloader.status()}), 202
+
+@webserver.route('/api/append', methods=['POST'])
+def append_rows():
+    """ Add rows to a loaded dataset without reloading it
+
+    The body is csv (Content-Type text/csv, header line first) or json
+    {"rows": [{"Question": ..., "LocationDesc": ..., "Data_Value": ...,
+    "Stratification1": ..., "StratificationCategory1": ...}]}. The dataset is
+    ?dataset= or "dataset" in the json, the default one otherwise.
+    """
+    forbidden = admin_error(request)
+    if forbidden:
+        return forbidden
+
+    webserver.logger.info("Received /api/append POST")
+    merge_ingestor()
+    if request.mimetype == 'text/csv':
+        data = {"dataset": request.args.get("dataset")}
+        try:
+            rows, skipped = rows_from_csv_text(request.get_data(as_text=True))
+        except ValueError as e:
+            return jsonify({"status": "error", "reason": f"Bad csv header: {e}"}), 400
+    else:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get("rows"), list) \
+                or not all(isinstance(row, dict) for row in data["rows"]):
+            return jsonify({"status": "error", "reason": "Expected {\"rows\": [objects]}"}), 400
+        rows, skipped = rows_from_records(data["rows"])
+
+    dataset, error = job_dataset(data)
+    if error:
+        return error
+    if dataset is None:
+        if webserver.tasks_runner.ingestor is None:
+            return jsonify({"status": "error", "reason": "dataset not loaded yet"}), 503
+        reloader = webserver.dataset_reloader
+    else:
+        # loads it if needed, the rows go on top of the csv
+        webserver.datasets.get(dataset)
+        reloader = webserver.datasets.reloaders[dataset]
+
+    version = reloader.append(rows) if rows else None
+    if rows and version is None:
+        return jsonify({"status": "error", "reason": "reload in progress"}), 409
+    webserver.logger.info("/api/append added %d rows, skipped %d", len(rows), skipped)
+    return jsonify({"status": "done",
+                    "data": {"appended": len(rows), "skipped": skipped, "version": version}})
+
+@webserver.route('/api/admin/profiler', methods=['GET'])
+@webserver.route('/api/admin/profiler/<action>', methods=['POST'])
+def profiler(action=None):
+    """ Sampling profiler of the workers busy on a job
+
+    POST start {"interval": seconds, "max_seconds": seconds} begins a profile, POST
+    stop ends it and returns the report: sample counts, the frames with the most
+    self samples and the folded stacks (?format=folded answers only those, as text
+    for flamegraph.pl or speedscope). GET returns the report so far.
+    """
+    forbidden = admin_error(request)
+    if forbidden:
+        return forbidden
+
+    if action is None:
+        return jsonify({"status": "done", "data": webserver.profiler.report()})
+    if action == "start":
+        data = request.get_json(silent=True) or {}
+        try:
+            if not isinstance(data, dict):
+                raise ValueError("expected a json object")
+            started = webserver.profiler.start(float(data.get("interval", 0.01)),
+                                               float(data.get("max_seconds", 300)))
+        except (TypeError, ValueError) as e:
+            return jsonify({"status": "error", "reason": f"Bad profiler settings: {e}"}), 400
+        if not started:
+            return jsonify({"status": "error", "reason": "profiler already running"}), 409
+        webserver.logger.info("Profiler started")
+        return jsonify({"status": "profiling"}), 202
+    if action != "stop":
+        return jsonify({"status": "error", "reason": f"Unknown action {action}"}), 404
+
+    report = webserver.profiler.stop()
+    if report is None:
+        return jsonify({"status": "error", "reason": "profiler never started"}), 409
+    webserver.logger.info("Profiler stopped with %d samples", report["samples"])
+    if request.args.get('format') == 'folded':
+        return Response(report["folded"], mimetype='text/plain')
+    return jsonify({"status": "done", "data": report})
+
+@webserver.route('/api/datasets', methods=['GET'])
+def get_datasets():
+    """ The named datasets, loaded or not, and their memory against the budget """
+
+    webserver.logger.info("Received /api/datasets GET")
+    data = webserver.datasets.stats()
+    data["default"] = webserver.dataset_reloader.status()
+    return jsonify({"status": "done", "data": data})
 
 @webserver.route('/api/graceful_shutdown', methods=['GET'])
 def shut():
@@ -96,24 +447,71 @@ def shut():
     return jsonify({"status" : "done", "data" : "Done shutdown"})
 
 
+@webserver.route('/api/events', methods=['GET'])
+def job_events():
+    """ Server-Sent Events stream with a "done" event for every completed job
+
+    ?job_ids=a,b only reports those jobs and closes once all of them are done.
+    Reconnecting clients resume from the Last-Event-ID header.
+    """
+
+    webserver.logger.info("Received /api/events GET")
+    merge_ingestor()
+    events = webserver.tasks_runner.job_events
+    wanted = set(filter(None, request.args.get('job_ids', '').split(',')))
+    filtered = bool(wanted)
+    last_seq = request.headers.get('Last-Event-ID', type=int)
+    if last_seq is None:
+        last_seq = events.last_seq()
+
+    def stream():
+        seq = last_seq
+        # jobs finished before the stream started
+        for job_id in list(wanted):
+            if webserver.tasks_runner.jobs.get(job_id) == "done":
+                wanted.discard(job_id)
+                yield f"event: done\ndata: {json.dumps({'job_id': job_id})}\n\n"
+        if filtered and not wanted:
+            return
+
+        while not webserver.tasks_runner.shutdown_event.is_set():
+            completed = events.wait_since(seq, 15)
+            if not completed:
+                # keep the connection alive through proxies
+                yield ": keepalive\n\n"
+                continue
+            for seq, job_id in completed:
+                if filtered and job_id not in wanted:
+                    continue
+                wanted.discard(job_id)
+                yield f"id: {seq}\nevent: done\ndata: {json.dumps({'job_id': job_id})}\n\n"
+            if filtered and not wanted:
+                return
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
 @webserver.route('/api/get_results/<job_id>', methods=['GET'])
-def get_response(job_id):
-    """ Get the results of a certain job """
+@webserver.route('/api/get_results/<job_id>/<int:index>', methods=['GET'])
+def get_response(job_id, index=None):
+    """ Get the results of a certain job, or of one item of a batch """
 
     webserver.logger.info("Received /api/get_results/%s GET", job_id)
 
     # check if we need to merge ingestor (first request)
     merge_ingestor()
-    # Check if job_id is valid
 
-    status = "error"
+    # long-poll: ?wait=<seconds> blocks until the job is done instead of answering "running"
+    wait = min(request.args.get('wait', 0, type=float),
+               float(os.environ.get('LONG_POLL_MAX_WAIT', '30')))
+    if wait > 0:
+        webserver.tasks_runner.job_events.wait_job(
+            job_id, lambda: webserver.tasks_runner.jobs.get(job_id) == "running", wait)
 
-    # get the existing status from dictionary
-    with webserver.tasks_runner.count_lock:
-        if job_id in webserver.tasks_runner.available_job_ids:
-            status = webserver.tasks_runner.available_job_ids[job_id]
+    # get the existing status from the registry, never existed or evicted = error
+    status = webserver.tasks_runner.jobs.get(job_id)
 
-    if status == "error":
+    if status is None:
         webserver.logger.info("%s - error, invalid job_id", job_id)
         return jsonify({'status': 'error', "reason": "Invalid job_id"})
 
@@ -122,11 +520,26 @@ def get_response(job_id):
         return jsonify({'status': 'running'})
 
     # the job successfully finished, read the results
-    res_file = 'results/' + str(job_id) + '.json'
-    with open(res_file, 'r', encoding="utf-8") as f:
-        res = json.load(f)
+    try:
+        res = webserver.tasks_runner.result_store.get(job_id)
+    except KeyError:
+        # evicted right after we read the status
+        webserver.logger.info("%s - error, evicted job_id", job_id)
+        return jsonify({'status': 'error', "reason": "Invalid job_id"})
+
+    # single item of a batch
+    if index is not None:
+        if not isinstance(res, list) or index >= len(res):
+            webserver.logger.info("%s - error, invalid batch index %d", job_id, index)
+            return jsonify({'status': 'error', "reason": "Invalid batch index"})
+        webserver.logger.info("%s/%d - done", job_id, index)
+        return jsonify(res[index])
 
     webserver.logger.info("%s - done", job_id)
+    # PROFILE_JOBS=1: where the time of the job went, next to its result
+    timings = webserver.tasks_runner.get_timings(job_id)
+    if timings is not None:
+        return jsonify({'status': 'done', 'data': res, 'timings': timings})
     return jsonify({'status': 'done', 'data': res})
 
 @webserver.route('/api/states_mean', methods=['POST'])
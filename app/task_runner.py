@@ -1,9 +1,258 @@
 """ Threadpool and workers definitions """
 
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from queue import Queue, Empty
-from threading import Thread, Event, Lock
-import os
+from threading import Thread, Event, Lock, Condition
+import heapq
+import itertools
 import json
+import logging
+import multiprocessing
+import os
+import time
+
+from app.admission import AdmissionController
+from app.job_events import JobEvents
+from app.job_registry import JobRegistry
+from app.metrics import Metrics
+from app.result_cache import ResultCache
+from app.result_store import create_result_store
+
+LOGGER = logging.getLogger(__name__)
+
+# every request type compute_result knows, a batch is made of these
+REQUEST_TYPES = ("global_mean_request", "state_mean_request", "states_mean_request",
+                 "best5_request", "worst5_request", "diff_from_mean_request",
+                 "state_diff_from_mean_request", "mean_by_category_request",
+                 "state_mean_by_category_request")
+
+def compute_batch(ingestor, jobs):
+    """ Compute a list of jobs in one pass, one {"status", "data"/"reason"} item per job
+
+    Per-question aggregates are computed once and shared: state_mean and
+    state_diff_from_mean are read out of states_mean and diff_from_mean, and
+    repeated jobs are answered from the batch memo.
+    """
+    memo = {}
+
+    def shared(request_type, question, state=None):
+        key = (request_type, question, state)
+        if key not in memo:
+            memo[key] = compute_result(ingestor, {"request_type": request_type,
+                                                  "question": question, "state": state})
+        return memo[key]
+
+    items = []
+    for job in jobs:
+        question, state = job["question"], job.get("state")
+        try:
+            if job["request_type"] == "state_mean_request":
+                data = {state: shared("states_mean_request", question)[state]}
+            elif job["request_type"] == "state_diff_from_mean_request":
+                data = {state: shared("diff_from_mean_request", question)[state]}
+            else:
+                data = shared(job["request_type"], question, state)
+            items.append({"status": "done", "data": data})
+        except KeyError as e:
+            items.append({"status": "error", "reason": f"Unknown key {e}"})
+    return items
+
+def compute_result(ingestor, job):
+    """ Run the ingestor method that matches the request type of the job """
+    result = {}
+    if job["request_type"] == "batch_request":
+        result = compute_batch(ingestor, job["jobs"])
+    elif job["request_type"] == "global_mean_request":
+        result = {"global_mean": ingestor.get_global_mean(job["question"])}
+    elif job["request_type"] == "state_mean_request":
+        result = ingestor.get_state_mean(job["question"], job["state"])
+        result = {job["state"]: result}
+    elif job["request_type"] == "states_mean_request":
+        result = ingestor.get_states_mean(job["question"])
+    elif job["request_type"] == "best5_request":
+        result = ingestor.get_best5(job["question"])
+    elif job["request_type"] == "worst5_request":
+        result = ingestor.get_worst5(job["question"])
+    elif job["request_type"] == "diff_from_mean_request":
+        result = ingestor.get_diff_from_mean(job["question"])
+    elif job["request_type"] == "state_diff_from_mean_request":
+        result = ingestor.get_state_diff_from_mean(job["question"], job["state"])
+    elif job["request_type"] == "mean_by_category_request":
+        result = ingestor.get_mean_by_category(job["question"])
+    elif job["request_type"] == "state_mean_by_category_request":
+        result = ingestor.get_state_mean_by_category(job["question"], job["state"])
+    return result
+
+# ingestors of the worker processes by dataset (None: the default one), inherited
+# through fork, never pickled
+_PROCESS_INGESTORS = {}
+
+def _process_job(job):
+    """ Entry point of a worker process: compute on the fork-inherited ingestor """
+    return compute_result(_PROCESS_INGESTORS[job.get("dataset")], job)
+
+def create_pool():
+    """ Build the pool selected by TP_BACKEND: thread (default) or process """
+    backend = os.environ.get('TP_BACKEND', 'thread')
+    if backend == 'process':
+        return ProcessPool()
+    if backend == 'thread':
+        return ThreadPool()
+    raise ValueError(f"Unknown pool backend {backend}")
+
+# priority classes, from the cheapest (most interactive) request types to the bulk ones
+PRIORITY_CLASSES = ("interactive", "standard", "bulk")
+REQUEST_CLASSES = {
+    "global_mean_request": "interactive",
+    "state_mean_request": "interactive",
+    "state_diff_from_mean_request": "interactive",
+    "state_mean_by_category_request": "interactive",
+    "states_mean_request": "standard",
+    "best5_request": "standard",
+    "worst5_request": "standard",
+    "diff_from_mean_request": "standard",
+    "mean_by_category_request": "bulk",
+    "batch_request": "bulk",
+}
+
+class FairScheduler:
+    """ Drop-in replacement of the job Queue: priority classes and per-client fair queuing
+
+    Every job lands in the class of its request type, inside the class in the queue
+    of its client (job["client"]: API key or IP). get() serves the classes by
+    weighted round robin (interactive gets the most turns, bulk is never starved)
+    and, inside a class, the clients one job at a time in turn, so one client with
+    50k queued jobs only delays the others by one job per round. With sjf=True the
+    queue of a client is ordered by cost_fn(job) instead of arrival.
+    """
+    def __init__(self, cost_fn, weights=(8, 4, 1), sjf=False):
+        self.cost_fn = cost_fn
+        # a class without turns would never be served
+        self.weights = {name: max(1, weight) for name, weight in zip(PRIORITY_CLASSES, weights)}
+        self.sjf = sjf
+
+        # class -> OrderedDict(client -> heap of (cost, seq, enqueue time, job)), clients in turn order
+        self.classes = {name: OrderedDict() for name in PRIORITY_CLASSES}
+        # turns left for each class in the current round
+        self.credits = dict(self.weights)
+        self.seq = itertools.count()
+        self.size = 0
+        self.closed = False
+        self.retiring = 0
+        self.cond = Condition()
+
+        # per class counters for the stats endpoint
+        self.depth = dict.fromkeys(PRIORITY_CLASSES, 0)
+        self.dispatched = dict.fromkeys(PRIORITY_CLASSES, 0)
+        self.total_wait = dict.fromkeys(PRIORITY_CLASSES, 0.0)
+        self.max_wait = dict.fromkeys(PRIORITY_CLASSES, 0.0)
+
+    def put(self, job):
+        """ Enqueue a job in its class and client queue """
+        name = REQUEST_CLASSES.get(job["request_type"], "standard")
+        cost = self.cost_fn(job) if self.sjf else 0
+        with self.cond:
+            clients = self.classes[name]
+            if job.get("client") not in clients:
+                clients[job.get("client")] = []
+            heapq.heappush(clients[job.get("client")],
+                           (cost, next(self.seq), time.monotonic(), job))
+            self.size += 1
+            self.depth[name] += 1
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        """ Next job by class turn and client turn
+
+        Blocks without polling; None once the scheduler is closed and drained or
+        when the worker is retired, Empty after timeout seconds.
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.size > 0 or self.closed or self.retiring,
+                                      timeout):
+                raise Empty
+            # a worker the autoscaler let go, or the shutdown
+            if self.retiring:
+                self.retiring -= 1
+                return None
+            if self.size == 0:
+                return None
+            name = self.next_class()
+            clients = self.classes[name]
+
+            # the client at the front gets one job and goes to the back of the line
+            client, jobs = next(iter(clients.items()))
+            _, _, enqueued, job = heapq.heappop(jobs)
+            del clients[client]
+            if jobs:
+                clients[client] = jobs
+
+            self.size -= 1
+            self.depth[name] -= 1
+            self.dispatched[name] += 1
+            wait = time.monotonic() - enqueued
+            self.total_wait[name] += wait
+            self.max_wait[name] = max(self.max_wait[name], wait)
+            return job
+
+    def next_class(self):
+        """ Weighted round robin over the non-empty classes, called with cond held """
+        for _ in range(2):
+            for name in PRIORITY_CLASSES:
+                if self.classes[name] and self.credits[name] > 0:
+                    self.credits[name] -= 1
+                    return name
+            # every waiting class used its turns: new round
+            self.credits = dict(self.weights)
+        raise Empty
+
+    def close(self):
+        """ Wake up every waiting get, they return None once the queue is empty """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def retire(self, count):
+        """ The next count calls to get return None, so count workers exit """
+        with self.cond:
+            self.retiring += count
+            self.cond.notify(count)
+
+    def drain(self):
+        """ Take out every job still waiting, in arrival order """
+        with self.cond:
+            entries = [entry for clients in self.classes.values()
+                       for jobs in clients.values() for entry in jobs]
+            for clients in self.classes.values():
+                clients.clear()
+            self.size = 0
+            self.depth = dict.fromkeys(PRIORITY_CLASSES, 0)
+        return [entry[3] for entry in sorted(entries, key=lambda entry: entry[1])]
+
+    def empty(self):
+        """ Same as Queue.empty """
+        with self.cond:
+            return self.size == 0
+
+    def qsize(self):
+        """ Same as Queue.qsize """
+        with self.cond:
+            return self.size
+
+    def task_done(self):
+        """ Nothing to account for, kept so the scheduler is a Queue drop-in """
+
+    def stats(self):
+        """ Depth, dispatched jobs and wait times per class """
+        with self.cond:
+            return {name: {"depth": self.depth[name],
+                           "clients": len(self.classes[name]),
+                           "dispatched": self.dispatched[name],
+                           "avg_wait": (self.total_wait[name] / self.dispatched[name]
+                                        if self.dispatched[name] else 0.0),
+                           "max_wait": self.max_wait[name]}
+                    for name in PRIORITY_CLASSES}
 
 class ThreadPool:
     """ ThreadPool of Taskrunners """
@@ -12,20 +261,43 @@ class ThreadPool:
 
         self.no_threads = self.get_no_threads()
 
-        # jobs queue
-        self.queue = Queue()
-        #list of workers
+        # autoscaling between TP_MIN_THREADS and TP_MAX_THREADS (default: the fixed size)
+        self.autoscale = os.environ.get('TP_AUTOSCALE', '0') == '1'
+        self.max_threads = int(os.environ.get('TP_MAX_THREADS', str(self.no_threads)))
+        # at least one worker, the autoscaler measures utilization per worker
+        self.min_threads = max(1, min(int(os.environ.get('TP_MIN_THREADS', '1')),
+                                      self.max_threads))
+        if self.autoscale:
+            self.no_threads = self.min_threads
+
+        # jobs queue: fair scheduler by default, TP_SCHEDULER=fifo for the plain Queue
+        if os.environ.get('TP_SCHEDULER', 'fair') == 'fifo':
+            self.queue = Queue()
+        else:
+            weights = os.environ.get('TP_CLASS_WEIGHTS', '8,4,1').split(',')
+            self.queue = FairScheduler(self.estimate_cost, tuple(int(w) for w in weights),
+                                       os.environ.get('TP_SCHEDULER_SJF', '0') == '1')
+        #list of workers, retired ones included; no_threads of them are active
         self.workers = []
-        # counter that retains what job_id to allocate next
-        self.id_counter = 0
-        # safety measure for incrementing counter
-        self.count_lock = Lock()
-        # save the statuses for all existent job ids
-        self.available_job_ids = {}
+        self.workers_lock = Lock()
+
+        # refuse jobs above the queue watermarks or over the per-client rate
+        high = int(os.environ.get('TP_QUEUE_HIGH_WATERMARK', '10000'))
+        rate = float(os.environ.get('TP_RATE_LIMIT', '0'))
+        self.admission = AdmissionController(
+            self.queue.qsize, high,
+            int(os.environ.get('TP_QUEUE_LOW_WATERMARK', str(high * 8 // 10))),
+            rate, float(os.environ.get('TP_RATE_BURST', str(max(10, 2 * rate)))),
+            int(os.environ.get('TP_RETRY_AFTER', '1')))
 
         # lock used for merging data ingestors
         self.csv_access_lock = Lock()
         self.ingestor = None
+        # bumped by every set_ingestor, so results of an older dataset are told apart
+        self.dataset_version = 0
+        # the other named datasets loaded, and the DatasetRegistry that loads them (set by the app)
+        self.ingestors = {}
+        self.datasets = None
 
         # event = we can actually do math, the csv is there
         self.merging_csv = Event()
@@ -33,15 +305,71 @@ class ThreadPool:
         # event = received graceful_shutdonw, merge threads
         self.shutdown_event = Event()
 
+        # identical jobs get their result from here instead of the queue
+        self.result_cache = ResultCache(int(os.environ.get('RESULT_CACHE_SIZE', '1024')),
+                                        float(os.environ.get('RESULT_CACHE_TTL', '300')))
+
+        # single-flight: key of a queued/running job -> identical jobs waiting for its result
+        self.in_flight = {}
+        self.in_flight_lock = Lock()
+        self.coalesced_jobs = 0
+
+        # completions, for long-polling get_results and the event stream
+        self.job_events = JobEvents()
+
+        # per-stage latency histograms and counters for /metrics
+        self.metrics = Metrics()
+
+        # PROFILE_JOBS=1 keeps the timing breakdown of the last jobs, returned with their
+        # results; jobs slower than SLOW_JOB_SECONDS (0 = off) are logged whole
+        self.profile_jobs = os.environ.get('PROFILE_JOBS', '0') == '1'
+        self.job_timings = OrderedDict()
+        self.job_timings_size = int(os.environ.get('PROFILE_JOBS_RETAIN', '10000'))
+        self.job_timings_lock = Lock()
+        self.slow_job_seconds = float(os.environ.get('SLOW_JOB_SECONDS', '0'))
+
+        # results of the done jobs: files, memory or segment log (RESULT_STORE)
+        self.result_store = create_result_store()
+
+        # statuses of all the job ids still retained, the results go away with them
+        self.jobs = JobRegistry(int(os.environ.get('JOB_RETENTION_COUNT', '100000')),
+                                float(os.environ.get('JOB_RETENTION_SECONDS', '3600')),
+                                self.result_store.delete)
+
+        # at shutdown, jobs that never started are saved here (if set) and requeued at startup
+        self.pending_jobs_file = os.environ.get('TP_PENDING_JOBS_FILE')
+        self.shutdown_deadline = float(os.environ.get('TP_SHUTDOWN_DEADLINE', '30'))
+        self.restore_pending_jobs()
+
         # start threads
         for i in range(self.no_threads):
             self.workers.append(TaskRunner(self, i))
             self.workers[i].start()
 
+        if self.autoscale:
+            Autoscaler(self).start()
+
     def add_job(self, job):
         """ Put a job into the queue, not actually solving it """
+
+        # an identical job is already queued or running, just wait for its result
+        job["dataset_version"] = self.dataset_version
+        # for the queue_wait stage, reset when a saved job is requeued at startup
+        job["enqueued_at"] = time.monotonic()
+        key = self.flight_key(job)
+        with self.in_flight_lock:
+            if key in self.in_flight:
+                self.in_flight[key].append(job)
+                self.coalesced_jobs += 1
+                return
+            self.in_flight[key] = []
         self.queue.put(job)
 
+    @staticmethod
+    def flight_key(job):
+        """ Coalescing key: the same parameters, submitted against the same dataset """
+        return job.get("dataset_version"), ResultCache.job_key(job)
+
     def get_no_threads(self):
         """ Get number of threads, don't be confused by no """
 
@@ -51,10 +379,344 @@ class ThreadPool:
             return int(no_threads)
         return os.cpu_count()
 
+    def set_ingestor(self, ingestor, dataset=None):
+        """ Give the workers access to the data, called under csv_access_lock
+
+        dataset is the name of a dataset other than the default one. Also used by the
+        reloads: the swap is a single reference assignment, a job keeps computing on
+        the ingestor it started with, and the cache only takes results of the new
+        version from now on.
+        """
+        self.dataset_version += 1
+        ingestor.version = self.dataset_version
+        self.result_cache.set_version(ingestor.version, dataset)
+        if dataset is None:
+            self.ingestor = ingestor
+        else:
+            self.ingestors[dataset] = ingestor
+
+    def drop_ingestor(self, dataset):
+        """ Unload a named dataset, called under csv_access_lock; running jobs keep their reference """
+        self.ingestors.pop(dataset, None)
+        self.result_cache.set_version(None, dataset)
+
+    def ingestor_for(self, job):
+        """ Ingestor of the job's dataset, loading a named dataset that is not in memory """
+        dataset = job.get("dataset")
+        if dataset is None:
+            return self.ingestor
+        return self.datasets.get(dataset)
+
+    def estimate_cost(self, job):
+        """ Cost estimate of a job from the ingestor index, for shortest-job-first
+
+        inf while the dataset is not loaded: the job pays for the whole load.
+        """
+        dataset = job.get("dataset")
+        ingestor = self.ingestor if dataset is None else self.ingestors.get(dataset)
+        if ingestor is None:
+            return float("inf")
+        if job["request_type"] == "batch_request":
+            return sum(ingestor.estimate_cost(item["request_type"], item["question"],
+                                              item.get("state")) for item in job["jobs"])
+        return ingestor.estimate_cost(job["request_type"], job["question"], job.get("state"))
+
+    def scheduler_stats(self):
+        """ Queue depth and wait times per priority class """
+        if isinstance(self.queue, FairScheduler):
+            return self.queue.stats()
+        return {"fifo": {"depth": self.queue.qsize()}}
+
+    def busy_workers(self):
+        """ {thread ident: "TaskRunner"} of the workers on a job, for the sampling profiler """
+        with self.workers_lock:
+            workers = list(self.workers)
+        return {worker.ident: "TaskRunner" for worker in workers
+                if worker.current_job is not None and worker.ident is not None}
+
+    def record_timings(self, job_id, timings):
+        """ Keep the timing breakdown of a job, the oldest ones go past PROFILE_JOBS_RETAIN """
+        with self.job_timings_lock:
+            self.job_timings[job_id] = timings
+            while len(self.job_timings) > self.job_timings_size:
+                self.job_timings.popitem(last=False)
+
+    def get_timings(self, job_id):
+        """ Timing breakdown of a job run by a worker, None if not profiled or forgotten """
+        with self.job_timings_lock:
+            return self.job_timings.get(job_id)
+
+    def worker_stats(self):
+        """ Active workers and the autoscaling bounds """
+        with self.workers_lock:
+            return {"active": self.no_threads, "autoscale": self.autoscale,
+                    "min": self.min_threads, "max": self.max_threads}
+
+    def execute(self, job, ingestor):
+        """ Compute the result of a job, here on the calling worker thread """
+        return compute_result(ingestor, job)
+
+    def compute_inline(self, job):
+        """ Answer a job on the calling (request) thread, going through the result cache """
+        key = ResultCache.job_key(job)
+        result = self.result_cache.get(key)
+        if result is None:
+            ingestor = self.ingestor_for(job)
+            result = compute_result(ingestor, job)
+            self.result_cache.put(key, result, ingestor.version)
+        return result
+
+    def grow(self, count):
+        """ Start count more workers, up to max_threads """
+        with self.workers_lock:
+            if self.shutdown_event.is_set():
+                return
+            count = min(count, self.max_threads - self.no_threads)
+            for _ in range(count):
+                worker = TaskRunner(self, len(self.workers))
+                self.workers.append(worker)
+                worker.start()
+            self.no_threads += count
+
+    def replace_worker(self, worker):
+        """ A worker ended on an exception: it no longer counts, a new one takes its place """
+        with self.workers_lock:
+            if worker.retired:
+                return
+            worker.retired = True
+            self.no_threads -= 1
+        self.grow(1)
+
+    def shrink(self, count):
+        """ Let count workers exit after their current job, down to min_threads """
+        with self.workers_lock:
+            if self.shutdown_event.is_set():
+                return
+            count = min(count, self.no_threads - self.min_threads)
+            if count <= 0:
+                return
+            self.no_threads -= count
+            if isinstance(self.queue, FairScheduler):
+                self.queue.retire(count)
+            else:
+                for _ in range(count):
+                    self.queue.put(None)
+
+    def utilization_sample(self):
+        """ (total busy seconds of the workers, dispatched jobs, their total queue wait) """
+        with self.workers_lock:
+            busy = sum(worker.busy_seconds for worker in self.workers)
+        if isinstance(self.queue, FairScheduler):
+            stats = self.queue.stats()
+            return (busy, sum(entry["dispatched"] for entry in stats.values()),
+                    sum(entry["avg_wait"] * entry["dispatched"] for entry in stats.values()))
+        return busy, 0, 0.0
+
+    def close_queue(self):
+        """ Wake up the idle workers so they exit once the queue is drained """
+        if isinstance(self.queue, FairScheduler):
+            self.queue.close()
+        else:
+            # one sentinel per worker, behind the jobs still queued
+            for _ in range(len(self.workers)):
+                self.queue.put(None)
+
+    def drain_queue(self):
+        """ Remove the jobs that never started from the queue """
+        if isinstance(self.queue, FairScheduler):
+            return self.queue.drain()
+        pending = []
+        while True:
+            try:
+                job = self.queue.get_nowait()
+            except Empty:
+                break
+            if job is not None:
+                pending.append(job)
+        self.close_queue()
+        return pending
+
     def join_workers(self):
-        """ After receiving shutdown, we can join the workers """
-        for i in range(self.no_threads):
-            self.workers[i].join()
+        """ After receiving shutdown, we can join the workers
+
+        The in-flight and queued jobs drain first. Past TP_SHUTDOWN_DEADLINE the jobs
+        that never started are dropped (or saved to TP_PENDING_JOBS_FILE) and the
+        workers only finish the job they are on.
+        """
+        deadline = time.monotonic() + self.shutdown_deadline
+
+        # without an ingestor nothing can run: keep the queued jobs for the next start
+        pending = self.drain_queue() if self.ingestor is None else []
+        # let go the workers still waiting for the first request
+        self.merging_csv.set()
+        self.close_queue()
+
+        with self.workers_lock:
+            workers = list(self.workers)
+        for worker in workers:
+            worker.join(max(0.0, deadline - time.monotonic()))
+        if any(worker.is_alive() for worker in workers):
+            pending += self.drain_queue()
+        self.save_pending_jobs(pending)
+
+    def save_pending_jobs(self, pending):
+        """ Write the jobs that never started to TP_PENDING_JOBS_FILE
+
+        The identical jobs coalesced onto a pending one are saved right behind it:
+        requeued together, they coalesce again at the next start.
+        """
+        if not pending or not self.pending_jobs_file:
+            return
+        saved = []
+        with self.in_flight_lock:
+            for job in pending:
+                saved.append(job)
+                saved += self.in_flight.pop(self.flight_key(job), [])
+        with open(self.pending_jobs_file, "w", encoding="utf-8") as f:
+            json.dump(saved, f)
+
+    def restore_pending_jobs(self):
+        """ Requeue the jobs saved by the previous shutdown, with their job ids """
+        if not self.pending_jobs_file or not os.path.exists(self.pending_jobs_file):
+            return
+        with open(self.pending_jobs_file, "r", encoding="utf-8") as f:
+            pending = json.load(f)
+        os.remove(self.pending_jobs_file)
+
+        self.jobs.restore([job["job_id"] for job in pending])
+        for job in pending:
+            self.add_job(job)
+
+    def build_answer(self, job, result):
+        """ Store the result and mark the job as complete, in exactly this order """
+        self.result_store.put(job["job_id"], result)
+        self.jobs.mark_done(job["job_id"])
+        # wake up whoever waits on this job
+        self.job_events.publish(job["job_id"])
+
+    def resolve_job(self, job, result):
+        """ Answer a computed job and every identical job that attached to it """
+        try:
+            self.build_answer(job, result)
+        finally:
+            # even if the write failed: a later identical job must not attach to this one
+            with self.in_flight_lock:
+                followers = self.in_flight.pop(self.flight_key(job), [])
+            for follower in followers:
+                self.build_answer(follower, result)
+
+    def coalescing_stats(self):
+        """ How many distinct jobs are in flight and how many requests attached to them """
+        with self.in_flight_lock:
+            return {"in_flight": len(self.in_flight),
+                    "waiting": sum(len(followers) for followers in self.in_flight.values()),
+                    "coalesced_jobs": self.coalesced_jobs}
+
+class ProcessPool(ThreadPool):
+    """ Same queue and statuses, but the math runs in forked worker processes
+
+    The TaskRunner threads only dispatch: each one hands its job to the process
+    executor and waits for the result, so up to no_threads jobs (max_threads
+    processes with autoscaling) run in parallel without the GIL. The processes are
+    forked after the ingestor is set, so they share its memory copy-on-write
+    instead of receiving it pickled with every job. A reload forks a new executor.
+    """
+    def __init__(self):
+        """ The executor is created later, once there is an ingestor to inherit """
+        self.executor = None
+        self.executor_lock = Lock()
+        super().__init__()
+
+    def set_ingestor(self, ingestor, dataset=None):
+        """ Publish the ingestor to the module and fork the workers from here
+
+        The previous executor finishes the jobs already submitted to it, then its
+        processes exit. The executor is swapped before the ingestor is published, so
+        a job labelled with the new version never runs on the previous dataset.
+        """
+        _PROCESS_INGESTORS[dataset] = ingestor
+        executor = ProcessPoolExecutor(max_workers=self.max_threads,
+                                       mp_context=multiprocessing.get_context("fork"))
+        with self.executor_lock:
+            previous, self.executor = self.executor, executor
+        super().set_ingestor(ingestor, dataset)
+        if previous is not None:
+            previous.shutdown(wait=False)
+
+    def drop_ingestor(self, dataset):
+        """ Unload a named dataset, the current processes free their copy with the next fork """
+        _PROCESS_INGESTORS.pop(dataset, None)
+        super().drop_ingestor(dataset)
+
+    def execute(self, job, ingestor):
+        """ Compute the result of a job in a worker process, on the current executor's dataset """
+        with self.executor_lock:
+            future = self.executor.submit(_process_job, job)
+        return future.result()
+
+    def join_workers(self):
+        """ Join the dispatcher threads, then stop the worker processes """
+        super().join_workers()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+class Autoscaler(Thread):
+    """ Grows and shrinks the pool from queue depth, queue wait and worker utilization
+
+    Every interval it compares a sample with the previous one. Scaling up needs
+    up_ticks bad samples in a row (queue deeper than depth_per_worker per worker,
+    or jobs waiting more than max_wait seconds), scaling down needs down_ticks
+    samples in a row of an empty queue and utilization under low_utilization, and
+    after any change the policy waits cooldown seconds: the different thresholds,
+    streaks and cooldown keep the pool from oscillating. It resizes the TaskRunner
+    set, which is the parallelism of both the thread and the process backend.
+    """
+    def __init__(self, t_pool):
+        super().__init__(daemon=True)
+        self.t_pool = t_pool
+        self.interval = float(os.environ.get('TP_AUTOSCALE_INTERVAL', '1'))
+        self.depth_per_worker = float(os.environ.get('TP_AUTOSCALE_DEPTH', '2'))
+        self.max_wait = float(os.environ.get('TP_AUTOSCALE_MAX_WAIT', '0.5'))
+        self.low_utilization = float(os.environ.get('TP_AUTOSCALE_LOW_UTIL', '0.3'))
+        self.cooldown = float(os.environ.get('TP_AUTOSCALE_COOLDOWN', '5'))
+        self.up_ticks = 2
+        self.down_ticks = 5
+
+    def run(self):
+        up_streak = down_streak = 0
+        last_change = 0.0
+        last = self.t_pool.utilization_sample()
+        last_time = time.monotonic()
+
+        while not self.t_pool.shutdown_event.wait(self.interval):
+            now = time.monotonic()
+            sample = self.t_pool.utilization_sample()
+            workers = self.t_pool.no_threads
+            # no worker between a crash and its replacement: nothing to measure
+            utilization = ((sample[0] - last[0]) / ((now - last_time) * workers)
+                           if workers else 0.0)
+            dispatched = sample[1] - last[1]
+            wait = (sample[2] - last[2]) / dispatched if dispatched else 0.0
+            depth = self.t_pool.queue.qsize()
+            last, last_time = sample, now
+
+            overloaded = depth > workers * self.depth_per_worker or wait > self.max_wait
+            idle = depth == 0 and utilization < self.low_utilization
+            up_streak = up_streak + 1 if overloaded else 0
+            down_streak = down_streak + 1 if idle else 0
+            if now - last_change < self.cooldown:
+                continue
+
+            if up_streak >= self.up_ticks:
+                # grow by half the pool, catching up fast with a burst
+                self.t_pool.grow(max(1, workers // 2))
+            elif down_streak >= self.down_ticks:
+                # shrink one at a time
+                self.t_pool.shrink(1)
+            else:
+                continue
+            up_streak = down_streak = 0
+            last_change = now
 
 class TaskRunner(Thread):
     """ Representation of workers """
@@ -64,63 +726,97 @@ class TaskRunner(Thread):
         super().__init__()
         self.t_pool = t_pool
         self.tid = tid
+        # time spent on jobs, for the autoscaler's utilization
+        self.busy_seconds = 0.0
+        # the job being worked on, None while waiting (read by the sampling profiler)
+        self.current_job = None
+        # set once the worker is no longer counted in no_threads
+        self.retired = False
 
-    def write_to_file(self, job_id, content):
-        """ Write the result of the computation of job_id """
-
-        directory = os.path.join(os.getcwd(), "results")
-        # Create the directory if it doesn't exist
-        os.makedirs(directory, exist_ok=True)
-        file_path = os.path.join(directory, job_id + ".json")
+    def build_answer(self, job, result, version):
+        """ Remember the result, write to file and mark the job (and its followers) complete """
+        self.t_pool.result_cache.put(ResultCache.job_key(job), result, version)
+        self.t_pool.resolve_job(job, result)
 
-        # Write content to the file
+    def run(self):
         try:
-            with open(file_path, "w", encoding="utf-8") as file:
-                json.dump(content, file)
-        except FileNotFoundError as e:
-            print(e)
-
-    def build_answer(self, job, result):
-        """ Write to file and mark the job as complete """
-        self.write_to_file(job["job_id"], result)
-        self.t_pool.available_job_ids[job["job_id"]] = "done"
+            self.work()
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception("Worker %d died", self.tid)
+            self.t_pool.replace_worker(self)
 
-    def run(self):
+    def work(self):
+        """ Take and answer jobs until the queue is closed or the worker retired """
         # wait until we are sure that data is there
         self.t_pool.merging_csv.wait()
         while True:
-            # Repeat until graceful_shutdown
-            if self.t_pool.shutdown_event.is_set() and self.t_pool.queue.empty():
+            # Get pending job, sleeping until there is one: no timeouts, no polling
+            job = self.t_pool.queue.get()
+
+            # graceful_shutdown: the queue is closed and drained
+            if job is None:
                 return
+
+            # Execute the job and save the result to disk, all of it on one dataset
+            # even if a reload swaps the ingestor meanwhile
+            start = time.monotonic()
+            self.current_job = job
+            metrics = self.t_pool.metrics
+            request_type = job["request_type"]
+            timings = {"queue_wait": start - job.get("enqueued_at", start)}
+            metrics.observe("job_stage_seconds", timings["queue_wait"],
+                            request_type=request_type, stage="queue_wait")
             try:
-                # Get pending job
-                job = self.t_pool.queue.get(timeout=0.2)
-            except Empty:
-                continue
-            result = {}
-
-            # Execute the job and save the result to disk
-            if job["request_type"] == "global_mean_request":
-                result = {"global_mean": self.t_pool.ingestor.get_global_mean(job["question"])}
-            elif job["request_type"] == "state_mean_request":
-                result = self.t_pool.ingestor.get_state_mean(job["question"], job["state"])
-                result = {job["state"]: result}
-            elif job["request_type"] == "states_mean_request":
-                result = self.t_pool.ingestor.get_states_mean(job["question"])
-            elif job["request_type"] == "best5_request":
-                result = self.t_pool.ingestor.get_best5(job["question"])
-            elif job["request_type"] == "worst5_request":
-                result = self.t_pool.ingestor.get_worst5(job["question"])
-            elif job["request_type"] == "diff_from_mean_request":
-                result = self.t_pool.ingestor.get_diff_from_mean(job["question"])
-            elif job["request_type"] == "state_diff_from_mean_request":
-                result = self.t_pool.ingestor.get_state_diff_from_mean(job["question"], job["state"])
-            elif job["request_type"] == "mean_by_category_request":
-                result = self.t_pool.ingestor.get_mean_by_category(job["question"])
-            elif job["request_type"] == "state_mean_by_category_request":
-                result = self.t_pool.ingestor.get_state_mean_by_category(job["question"], job["state"])
+                ingestor = self.t_pool.ingestor_for(job)
+            except (OSError, ValueError, KeyError) as e:
+                # a named dataset that fails to load: answer the job, keep the worker
+                timings["dataset_load"] = time.monotonic() - start
+                self.t_pool.resolve_job(job, {"error": f"Dataset unavailable: {e}"})
             else:
-                self.t_pool.available_job_ids[job["job_id"]] = {"ceva" : 5.0}
-
-            self.build_answer(job, result)
+                compute_start = time.monotonic()
+                # a named dataset loaded for this job
+                timings["dataset_load"] = compute_start - start
+                failed = False
+                try:
+                    result = self.t_pool.execute(job, ingestor)
+                except KeyError as e:
+                    # unknown question or state: an error answer, like the inline path
+                    result = {"error": f"Unknown key {e}"}
+                except Exception as e:  # pylint: disable=broad-except
+                    # whatever else the math or a worker process raised must not kill
+                    # the worker and leave the job and its followers running forever
+                    LOGGER.exception("Job %s failed", job["job_id"])
+                    result = {"error": f"Job failed: {e}"}
+                    failed = True
+                write_start = time.monotonic()
+                timings["compute"] = write_start - compute_start
+                metrics.observe("job_stage_seconds", timings["compute"],
+                                request_type=request_type, stage="compute")
+                if self.t_pool.profile_jobs:
+                    # there as soon as the job is done, trace_job completes it
+                    self.t_pool.record_timings(job["job_id"], dict(timings))
+                if failed:
+                    # answered, not cached: the next identical job tries again
+                    self.t_pool.resolve_job(job, result)
+                else:
+                    self.build_answer(job, result, ingestor.version)
+                timings["result_write"] = time.monotonic() - write_start
+                metrics.observe("job_stage_seconds", timings["result_write"],
+                                request_type=request_type, stage="result_write")
+            self.current_job = None
+            self.busy_seconds += time.monotonic() - start
+            self.trace_job(job, timings)
             self.t_pool.queue.task_done()
+
+    def trace_job(self, job, timings):
+        """ Keep the timing breakdown next to the result, log the whole job if it was slow
+
+        A client reading the result right away may get the breakdown without
+        result_write and total, they are added once the write is over.
+        """
+        timings["total"] = sum(timings.values())
+        if self.t_pool.profile_jobs:
+            self.t_pool.record_timings(job["job_id"], timings)
+        if self.t_pool.slow_job_seconds and timings["total"] > self.t_pool.slow_job_seconds:
+            LOGGER.warning("Slow job %s on worker %d: %s %s", job["job_id"], self.tid,
+                           {stage: round(seconds, 6) for stage, seconds in timings.items()}, job)
@@ -0,0 +1 @@
+""" Reproducible benchmarks of the server, see run_benchmarks.py """
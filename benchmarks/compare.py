@@ -0,0 +1,77 @@
+""" Compare two reports of run_benchmarks.py, flag what got slower
+
+    python -m benchmarks.compare base.json new.json --threshold 10
+
+Exits with 1 when a measure regressed by more than threshold percent, so it can
+gate a change in a script.
+"""
+
+import argparse
+import json
+import sys
+
+# suite -> fields naming a measure, the value compared (lower is better)
+MEASURES = {"micro": (("rows", "engine", "stat"), "p50_us"),
+            "ingest": (("rows", "engine", "source"), "seconds")}
+# the measures where higher is better
+HIGHER_IS_BETTER = {("throughput_rps",)}
+
+def keyed(report, suite):
+    """ {measure key: value} of a suite in a report """
+    fields, value = MEASURES[suite]
+    return {tuple(entry[field] for field in fields): entry[value]
+            for entry in report.get(suite, [])}
+
+def e2e_measures(report):
+    """ The end to end numbers compared, empty if the suite did not run """
+    e2e = report.get("e2e")
+    if not e2e:
+        return {}
+    measures = {("p50_ms",): e2e["latency_ms"].get("p50"),
+                ("p99_ms",): e2e["latency_ms"].get("p99"),
+                ("throughput_rps",): e2e["throughput_rps"]}
+    return {key: value for key, value in measures.items() if value is not None}
+
+def compare(base, new, threshold):
+    """ Rows (suite, key, base, new, change %, regressed) for the measures in both reports """
+    rows = []
+    suites = [(suite, keyed(base, suite), keyed(new, suite)) for suite in MEASURES]
+    suites.append(("e2e", e2e_measures(base), e2e_measures(new)))
+    for suite, before, after in suites:
+        for key in sorted(before.keys() & after.keys(), key=str):
+            old, current = before[key], after[key]
+            if not old:
+                continue
+            change = (current - old) / old * 100
+            if key in HIGHER_IS_BETTER:
+                regressed = -change > threshold
+            else:
+                regressed = change > threshold
+            rows.append((suite, key, old, current, change, regressed))
+    return rows
+
+def main(argv=None):
+    """ Print the comparison table, exit code 1 on a regression """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("base")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="percent of change counted as a regression")
+    args = parser.parse_args(argv)
+
+    with open(args.base, "r", encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.new, "r", encoding="utf-8") as f:
+        new = json.load(f)
+
+    rows = compare(base, new, args.threshold)
+    for suite, key, old, current, change, regressed in rows:
+        name = "/".join(str(part) for part in key)
+        print(f"{'REGRESSION' if regressed else '':10} {suite:6} {name:45} "
+              f"{old:12.3f} {current:12.3f} {change:+7.1f}%")
+    regressions = sum(row[5] for row in rows)
+    print(f"{len(rows)} measures, {regressions} regressed by more than {args.threshold}%")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
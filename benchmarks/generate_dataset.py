@@ -0,0 +1,287 @@
+""" Synthetic csv files with the schema of the CDC nutrition, physical activity and obesity extract
+
+    python -m benchmarks.generate_dataset out.csv --rows 10000000 --location-skew 0.8 \
+        --missing-rate 0.05
+    python -m benchmarks.generate_dataset out.csv --size 4G
+    python -m benchmarks.generate_dataset - --rows 1000 --columns minimal | head
+
+Rows are written in batches as they are drawn, so the memory does not grow with
+the file. The same seed and options give the same file.
+"""
+
+import argparse
+import csv
+import random
+import sys
+
+# every column of the CDC extract, in its order (the space in High_Confidence_Limit is theirs)
+FULL_COLUMNS = ["YearStart", "YearEnd", "LocationAbbr", "LocationDesc", "Datasource", "Class",
+                "Topic", "Question", "Data_Value_Unit", "Data_Value_Type", "Data_Value",
+                "Data_Value_Alt", "Data_Value_Footnote_Symbol", "Data_Value_Footnote",
+                "Low_Confidence_Limit", "High_Confidence_Limit ", "Sample_Size", "Total",
+                "Age(years)", "Education", "Gender", "Income", "Race/Ethnicity", "GeoLocation",
+                "ClassID", "TopicID", "QuestionID", "DataValueTypeID", "LocationID",
+                "StratificationCategory1", "Stratification1", "StratificationCategoryId1",
+                "StratificationID1"]
+
+# the layout of the subset the server ships with: a pandas index and the columns read
+MINIMAL_COLUMNS = ["", "LocationDesc", "Question", "Data_Value", "StratificationCategory1",
+                   "Stratification1"]
+
+# (question, QuestionID, class, topic, ClassID, TopicID, typical value)
+QUESTIONS = [
+    ("Percent of adults aged 18 years and older who have obesity", "Q036",
+     "Obesity / Weight Status", "Obesity / Weight Status", "OWS", "OWS1", 30.0),
+    ("Percent of adults aged 18 years and older who have an overweight classification", "Q037",
+     "Obesity / Weight Status", "Obesity / Weight Status", "OWS", "OWS1", 35.0),
+    ("Percent of adults who engage in no leisure-time physical activity", "Q047",
+     "Physical Activity", "Physical Activity - Behavior", "PA", "PA1", 25.0),
+    ("Percent of adults who achieve at least 150 minutes a week of moderate-intensity aerobic "
+     "physical activity or 75 minutes a week of vigorous-intensity aerobic activity (or an "
+     "equivalent combination)", "Q043",
+     "Physical Activity", "Physical Activity - Behavior", "PA", "PA1", 50.0),
+    ("Percent of adults who achieve at least 150 minutes a week of moderate-intensity aerobic "
+     "physical activity or 75 minutes a week of vigorous-intensity aerobic physical activity and "
+     "engage in muscle-strengthening activities on 2 or more days a week", "Q044",
+     "Physical Activity", "Physical Activity - Behavior", "PA", "PA1", 20.0),
+    ("Percent of adults who achieve at least 300 minutes a week of moderate-intensity aerobic "
+     "physical activity or 150 minutes a week of vigorous-intensity aerobic activity (or an "
+     "equivalent combination)", "Q045",
+     "Physical Activity", "Physical Activity - Behavior", "PA", "PA1", 32.0),
+    ("Percent of adults who engage in muscle-strengthening activities on 2 or more days a week",
+     "Q046", "Physical Activity", "Physical Activity - Behavior", "PA", "PA1", 30.0),
+    ("Percent of adults who report consuming fruit less than one time daily", "Q018",
+     "Fruits and Vegetables", "Fruits and Vegetables - Behavior", "FV", "FV1", 38.0),
+    ("Percent of adults who report consuming vegetables less than one time daily", "Q019",
+     "Fruits and Vegetables", "Fruits and Vegetables - Behavior", "FV", "FV1", 20.0),
+]
+
+# (LocationAbbr, LocationDesc, LocationID)
+LOCATIONS = [
+    ("US", "National", 59), ("AL", "Alabama", 1), ("AK", "Alaska", 2), ("AZ", "Arizona", 4),
+    ("AR", "Arkansas", 5), ("CA", "California", 6), ("CO", "Colorado", 8),
+    ("CT", "Connecticut", 9), ("DE", "Delaware", 10), ("DC", "District of Columbia", 11),
+    ("FL", "Florida", 12), ("GA", "Georgia", 13), ("HI", "Hawaii", 15), ("ID", "Idaho", 16),
+    ("IL", "Illinois", 17), ("IN", "Indiana", 18), ("IA", "Iowa", 19), ("KS", "Kansas", 20),
+    ("KY", "Kentucky", 21), ("LA", "Louisiana", 22), ("ME", "Maine", 23),
+    ("MD", "Maryland", 24), ("MA", "Massachusetts", 25), ("MI", "Michigan", 26),
+    ("MN", "Minnesota", 27), ("MS", "Mississippi", 28), ("MO", "Missouri", 29),
+    ("MT", "Montana", 30), ("NE", "Nebraska", 31), ("NV", "Nevada", 32),
+    ("NH", "New Hampshire", 33), ("NJ", "New Jersey", 34), ("NM", "New Mexico", 35),
+    ("NY", "New York", 36), ("NC", "North Carolina", 37), ("ND", "North Dakota", 38),
+    ("OH", "Ohio", 39), ("OK", "Oklahoma", 40), ("OR", "Oregon", 41),
+    ("PA", "Pennsylvania", 42), ("RI", "Rhode Island", 44), ("SC", "South Carolina", 45),
+    ("SD", "South Dakota", 46), ("TN", "Tennessee", 47), ("TX", "Texas", 48), ("UT", "Utah", 49),
+    ("VT", "Vermont", 50), ("VA", "Virginia", 51), ("WA", "Washington", 53),
+    ("WV", "West Virginia", 54), ("WI", "Wisconsin", 55), ("WY", "Wyoming", 56),
+    ("GU", "Guam", 66), ("PR", "Puerto Rico", 72), ("VI", "Virgin Islands", 78),
+]
+
+# (StratificationCategory1, its column, StratificationCategoryId1, [(Stratification1, ID)])
+STRATIFICATIONS = [
+    ("Total", "Total", "OVR", [("Total", "OVERALL")]),
+    ("Age (years)", "Age(years)", "AGEYR",
+     [("18 - 24", "AGEYR1824"), ("25 - 34", "AGEYR2534"), ("35 - 44", "AGEYR3544"),
+      ("45 - 54", "AGEYR4554"), ("55 - 64", "AGEYR5564"), ("65 or older", "AGEYR65PLUS")]),
+    ("Education", "Education", "EDU",
+     [("Less than high school", "EDUHS"), ("High school graduate", "EDUHSGRAD"),
+      ("Some college or technical school", "EDUCOTEC"), ("College graduate", "EDUCOGRAD")]),
+    ("Gender", "Gender", "GEN", [("Male", "MALE"), ("Female", "FEMALE")]),
+    ("Income", "Income", "INC",
+     [("Less than $15,000", "INCLESS15"), ("$15,000 - $24,999", "INC1525"),
+      ("$25,000 - $34,999", "INC2535"), ("$35,000 - $49,999", "INC3550"),
+      ("$50,000 - $74,999", "INC5075"), ("$75,000 or greater", "INC75PLUS"),
+      ("Data not reported", "INCNR")]),
+    ("Race/Ethnicity", "Race/Ethnicity", "RACE",
+     [("Non-Hispanic White", "RACEWHT"), ("Non-Hispanic Black", "RACEBLK"),
+      ("Hispanic", "RACEHIS"), ("Asian", "RACEASN"),
+      ("Hawaiian/Pacific Islander", "RACEHPI"),
+      ("American Indian/Alaska Native", "RACENAA"), ("2 or more races", "RACEMRC"),
+      ("Other", "RACEOTH")]),
+]
+
+DATASOURCE = "Behavioral Risk Factor Surveillance System"
+MISSING_SYMBOL = "~"
+MISSING_FOOTNOTE = "Data not available because sample size is insufficient."
+
+# rows drawn and written at once
+BATCH_ROWS = 10000
+
+def question_table(count, rng):
+    """ count questions: the CDC ones first, then made up ones of the same kind """
+    questions = QUESTIONS[:count]
+    for i in range(len(questions), count):
+        questions.append((f"Percent of adults who report synthetic behavior {i}", f"QS{i:04}",
+                          "Synthetic", "Synthetic - Behavior", "SYN", "SYN1",
+                          round(rng.uniform(10, 60), 1)))
+    return questions
+
+def location_table(count, rng):
+    """ count locations (LocationAbbr, LocationDesc, LocationID, GeoLocation) """
+    locations = LOCATIONS[:count]
+    for i in range(len(locations), count):
+        locations.append((f"L{i}", f"Location {i}", 1000 + i))
+    # the national row has no coordinates, like in the extract
+    return [(abbr, name, location_id,
+             "" if abbr == "US" else f"({rng.uniform(18, 65):.9f}, {rng.uniform(-165, -65):.9f})")
+            for abbr, name, location_id in locations]
+
+def zipf_cum_weights(count, skew):
+    """ Cumulative weights of rank i ~ 1 / (i + 1) ** skew, skew 0 being uniform """
+    total = 0.0
+    cum_weights = []
+    for i in range(count):
+        total += 1.0 / (i + 1) ** skew
+        cum_weights.append(total)
+    return cum_weights
+
+def generate_rows(rows=None, seed=0, questions=len(QUESTIONS), locations=len(LOCATIONS),
+                  years=12, question_skew=0.0, location_skew=0.0, missing_rate=0.0,
+                  columns="full"):
+    """ Yield batches of csv rows (lists of strings), forever if rows is None
+
+    questions, locations and years are the cardinalities; the skews make the first
+    ones more frequent (Zipf exponent). A value is the question's typical value
+    plus a location, a stratification and a year effect and some noise, so the
+    per-state means differ like in the real data. missing_rate of the rows have no
+    Data_Value, with the CDC footnote.
+    """
+    rng = random.Random(seed)
+    question_rows = question_table(questions, rng)
+    location_rows = location_table(locations, rng)
+    stratif_rows = [(category, column, category_id, stratif, stratif_id)
+                    for category, column, category_id, values in STRATIFICATIONS
+                    for stratif, stratif_id in values]
+    location_effects = [rng.gauss(0, 4) for _ in location_rows]
+    stratif_effects = [rng.gauss(0, 3) for _ in stratif_rows]
+    year_starts = list(range(2022 - years + 1, 2023))
+
+    question_weights = zipf_cum_weights(len(question_rows), question_skew)
+    location_weights = zipf_cum_weights(len(location_rows), location_skew)
+    question_ids = range(len(question_rows))
+    location_ids = range(len(location_rows))
+    stratif_ids = range(len(stratif_rows))
+    full = columns == "full"
+
+    index = 0
+    while rows is None or index < rows:
+        count = BATCH_ROWS if rows is None else min(BATCH_ROWS, rows - index)
+        picked_questions = rng.choices(question_ids, cum_weights=question_weights, k=count)
+        picked_locations = rng.choices(location_ids, cum_weights=location_weights, k=count)
+        picked_stratifs = rng.choices(stratif_ids, k=count)
+        batch = []
+        for q, l, s in zip(picked_questions, picked_locations, picked_stratifs):
+            question, question_id, klass, topic, class_id, topic_id, typical = question_rows[q]
+            abbr, location, location_id, geo = location_rows[l]
+            category, category_column, category_id, stratif, stratif_id = stratif_rows[s]
+            year = rng.choice(year_starts)
+            missing = missing_rate and rng.random() < missing_rate
+            if missing:
+                value = ""
+            else:
+                mean = (typical + location_effects[l] + stratif_effects[s]
+                        + (year - 2016) * 0.2 + rng.gauss(0, 2))
+                value = f"{min(max(mean, 0.5), 99.5):.1f}"
+
+            if not full:
+                batch.append([index, location, question, value, category, stratif])
+                index += 1
+                continue
+
+            if missing:
+                low = high = sample = ""
+                symbol, footnote = MISSING_SYMBOL, MISSING_FOOTNOTE
+            else:
+                margin = rng.uniform(1, 8)
+                low = f"{max(float(value) - margin, 0):.1f}"
+                high = f"{min(float(value) + margin, 100):.1f}"
+                sample = rng.randint(50, 20000)
+                symbol = footnote = ""
+            by_category = ["" if column != category_column else stratif
+                           for _, column, _, _ in STRATIFICATIONS]
+            batch.append([year, year, abbr, location, DATASOURCE, klass, topic, question, "",
+                          "Value", value, value, symbol, footnote, low, high, sample,
+                          *by_category, geo, class_id, topic_id, question_id, "VALUE",
+                          location_id, category, stratif, category_id, stratif_id])
+            index += 1
+        yield batch
+
+def write_dataset(out, rows=None, size=None, **options):
+    """ Write rows (or about size bytes) of synthetic csv to out, a path or a text file
+
+    The options are the ones of generate_rows. Returns the number of rows written.
+    """
+    if rows is None and size is None:
+        raise ValueError("rows or size is needed")
+    if isinstance(out, str):
+        with open(out, "w", newline="", encoding="utf-8") as f:
+            return write_dataset(f, rows, size, **options)
+
+    columns = options.get("columns", "full")
+    # out may not be seekable (stdout): count what goes through
+    counter = CountingWriter(out)
+    writer = csv.writer(counter, lineterminator="\n")
+    writer.writerow(FULL_COLUMNS if columns == "full" else MINIMAL_COLUMNS)
+    written = 0
+    for batch in generate_rows(rows, **options):
+        writer.writerows(batch)
+        written += len(batch)
+        if size is not None and counter.chars >= size:
+            break
+    return written
+
+class CountingWriter:
+    """ Passes the text on to a file and counts it (the generated text is ascii: chars = bytes) """
+    def __init__(self, out):
+        self.out = out
+        self.chars = 0
+
+    def write(self, text):
+        """ Forward and count """
+        self.chars += len(text)
+        return self.out.write(text)
+
+def parse_size(text):
+    """ Bytes of a size like 500M or 4G (powers of 1024) """
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def main(argv=None):
+    """ Command line: write the csv to a path, or to stdout with - """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("output", help="csv path, - for stdout")
+    parser.add_argument("--rows", type=int, help="rows to write")
+    parser.add_argument("--size", type=parse_size, help="stop after about this size, e.g. 4G")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--questions", type=int, default=len(QUESTIONS),
+                        help=f"distinct questions, the first {len(QUESTIONS)} are the CDC ones")
+    parser.add_argument("--locations", type=int, default=len(LOCATIONS),
+                        help=f"distinct locations, the first {len(LOCATIONS)} are the CDC ones")
+    parser.add_argument("--years", type=int, default=12, help="distinct years, up to 2022")
+    parser.add_argument("--question-skew", type=float, default=0.0,
+                        help="Zipf exponent of the question frequencies, 0 = uniform")
+    parser.add_argument("--location-skew", type=float, default=0.0,
+                        help="Zipf exponent of the location frequencies, 0 = uniform")
+    parser.add_argument("--missing-rate", type=float, default=0.0,
+                        help="fraction of rows without a Data_Value")
+    parser.add_argument("--columns", choices=["full", "minimal"], default="full",
+                        help="every CDC column, or only the ones the server reads")
+    args = parser.parse_args(argv)
+    if args.rows is None and args.size is None:
+        parser.error("one of --rows and --size is required")
+
+    options = {"seed": args.seed, "questions": args.questions, "locations": args.locations,
+               "years": args.years, "question_skew": args.question_skew,
+               "location_skew": args.location_skew, "missing_rate": args.missing_rate,
+               "columns": args.columns}
+    if args.output == "-":
+        written = write_dataset(sys.stdout, args.rows, args.size, **options)
+    else:
+        written = write_dataset(args.output, args.rows, args.size, **options)
+    print(f"{written} rows", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
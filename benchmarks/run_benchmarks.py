@@ -0,0 +1,299 @@
+""" Benchmarks of the statistics, the csv ingestion and the whole job pipeline
+
+    python -m benchmarks.run_benchmarks --suites micro,ingest,e2e --sizes 10000,100000,1000000 \
+        --engines dict,columnar --output bench.json
+
+Everything runs on csv files from benchmarks/generate_dataset.py written to a
+temporary directory, with a fixed seed, so two commits can be compared with
+benchmarks/compare.py on the JSON documents this writes.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from datetime import datetime, timezone
+
+from benchmarks import generate_dataset
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# seconds an e2e client waits for a job before counting it as an error
+JOB_TIMEOUT = 60
+
+# request type -> does it take a state
+STATISTICS = {"global_mean": False, "state_mean": True, "states_mean": False, "best5": False,
+              "worst5": False, "diff_from_mean": False, "state_diff_from_mean": True,
+              "mean_by_category": False, "state_mean_by_category": True}
+
+def load_data_ingestor():
+    """ app/data_ingestor.py as a module, without the app package (importing it starts the server) """
+    spec = importlib.util.spec_from_file_location(
+        "bench_data_ingestor", os.path.join(ROOT, "app", "data_ingestor.py"))
+    module = importlib.util.module_from_spec(spec)
+    # registered, so the forked ingestion workers find parse_csv_chunk by name
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def summarize(samples):
+    """ Count, mean and nearest-rank percentiles of durations in seconds, in microseconds """
+    ordered = sorted(samples)
+    count = len(ordered)
+
+    def percentile(p):
+        return ordered[max(0, -(-p * count // 100) - 1)] * 1e6
+
+    return {"count": count, "mean_us": sum(ordered) / count * 1e6, "p50_us": percentile(50),
+            "p95_us": percentile(95), "p99_us": percentile(99), "max_us": ordered[-1] * 1e6}
+
+def dataset_csv(work_dir, rows, data):
+    """ Path of the synthetic csv with rows rows, written once per run
+
+    data holds the generate_dataset options (seed, skews, missing rate, columns).
+    """
+    path = os.path.join(work_dir, f"synthetic_{rows}.csv")
+    if not os.path.exists(path):
+        generate_dataset.write_dataset(path, rows, **data)
+    return path
+
+def bench_ingest(module, work_dir, sizes, engines, data):
+    """ Time the csv parsing, then the load from the snapshot, per size and engine """
+    results = []
+    for rows in sizes:
+        path = dataset_csv(work_dir, rows, data)
+        size = os.path.getsize(path)
+        for engine in engines:
+            for use_snapshot in (False, True):
+                os.environ['INGESTOR_SNAPSHOT'] = '1' if use_snapshot else '0'
+                if use_snapshot:
+                    # the first load writes the snapshot, the timed one reads it
+                    module.create_ingestor(path, engine)
+                start = time.perf_counter()
+                ingestor = module.create_ingestor(path, engine)
+                seconds = time.perf_counter() - start
+                assert ingestor.loaded_from_snapshot == use_snapshot, \
+                    f"{engine} {'did not load from' if use_snapshot else 'loaded from'} the snapshot"
+                results.append({"rows": rows, "engine": engine, "bytes": size,
+                                "source": "snapshot" if use_snapshot else "csv",
+                                "workers": int(os.environ.get('INGESTOR_WORKERS',
+                                                              str(os.cpu_count() or 1))),
+                                "seconds": seconds, "rows_per_s": rows / seconds,
+                                "mb_per_s": size / seconds / 1e6})
+            os.environ.pop('INGESTOR_SNAPSHOT', None)
+    return results
+
+def bench_micro(module, work_dir, sizes, engines, ops, data):
+    """ Latency of every statistic called directly on the ingestor, random questions and states """
+    results = []
+    for rows in sizes:
+        path = dataset_csv(work_dir, rows, data)
+        for engine in engines:
+            ingestor = module.create_ingestor(path, engine)
+            if engine == "columnar":
+                questions = list(ingestor.questions)
+                states = ingestor.location_names
+            else:
+                questions = list(ingestor.all_questions)
+                states = sorted({state for per_state in ingestor.all_questions.values()
+                                 for state in per_state})
+            rng = random.Random(data["seed"])
+            for stat, with_state in STATISTICS.items():
+                method = getattr(ingestor, "get_" + stat)
+                samples = []
+                for _ in range(ops):
+                    args = (rng.choice(questions),)
+                    if with_state:
+                        args += (rng.choice(states),)
+                    start = time.perf_counter()
+                    try:
+                        method(*args)
+                    except KeyError:
+                        # a state without rows for that question, as a client could send
+                        pass
+                    samples.append(time.perf_counter() - start)
+                results.append({"rows": rows, "engine": engine, "stat": stat,
+                                **summarize(samples)})
+    return results
+
+def question_states(ingestor, engine):
+    """ The (question, state) pairs with rows in the loaded data, sorted """
+    questions = ingestor.questions if engine == "columnar" else ingestor.state_index
+    return [(question, state) for question in sorted(questions)
+            for state in sorted(ingestor.get_states_mean(question))]
+
+def start_server(work_dir, path, engine):
+    """ benchmarks/serve_app.py in a process of its own: (process, base url) once it is ready """
+    app_dir = os.path.join(work_dir, "app_run")
+    os.makedirs(app_dir, exist_ok=True)
+    env = dict(os.environ, DATASET_PATH=path, INGESTOR_ENGINE=engine,
+               PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+    server = subprocess.Popen([sys.executable, "-m", "benchmarks.serve_app"], cwd=app_dir,
+                              env=env, stdout=subprocess.PIPE, text=True)
+    port = server.stdout.readline().strip()
+    if not port:
+        raise RuntimeError(f"the app exited with code {server.wait()} before serving")
+    base = f"http://127.0.0.1:{port}"
+
+    deadline = time.perf_counter() + JOB_TIMEOUT
+    while True:
+        try:
+            with urllib.request.urlopen(base + "/api/ready", timeout=10):
+                return server, base
+        except OSError:
+            if time.perf_counter() > deadline:
+                server.kill()
+                raise
+            time.sleep(0.1)
+
+def bench_e2e(module, work_dir, rows, engine, requests, concurrency, data):
+    """ Submit + long-poll every job over HTTP against the real app, from concurrency clients
+
+    The app runs in a subprocess, so the clients don't share its GIL; its workers
+    are joined through /api/graceful_shutdown at the end.
+    """
+    path = dataset_csv(work_dir, rows, data)
+    # only pairs that have rows: with skew or missing values some never show up,
+    # and the clients measure answers, not unknown keys
+    pairs = question_states(module.create_ingestor(path, engine), engine)
+    server, base = start_server(work_dir, path, engine)
+
+    def call(method, url, body=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        request = urllib.request.Request(base + url, data=data, method=method,
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=60) as response:
+            return json.loads(response.read())
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def client(index, count):
+        rng = random.Random(data["seed"] + index)
+        for _ in range(count):
+            stat = rng.choice(list(STATISTICS))
+            question, state = rng.choice(pairs)
+            body = {"question": question}
+            if STATISTICS[stat]:
+                body["state"] = state
+            start = time.perf_counter()
+            deadline = start + JOB_TIMEOUT
+            try:
+                job_id = call("POST", "/api/" + stat, body)["job_id"]
+                while call("GET", f"/api/get_results/{job_id}?wait=10")["status"] == "running":
+                    if time.perf_counter() > deadline:
+                        raise TimeoutError(f"{job_id} still running after {JOB_TIMEOUT}s")
+            except OSError as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    per_client = [requests // concurrency + (i < requests % concurrency)
+                  for i in range(concurrency)]
+    clients = [threading.Thread(target=client, args=(i, count))
+               for i, count in enumerate(per_client)]
+    try:
+        start = time.perf_counter()
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        wall = time.perf_counter() - start
+
+        stats = call("GET", "/api/stats")["data"]
+        call("GET", "/api/graceful_shutdown")
+    finally:
+        server.terminate()
+        server.wait()
+        server.stdout.close()
+
+    latency = summarize(latencies) if latencies else {}
+    return {"rows": rows, "engine": engine, "requests": requests, "concurrency": concurrency,
+            "completed": len(latencies), "errors": len(errors), "seconds": wall,
+            "throughput_rps": len(latencies) / wall,
+            "latency_ms": {key.replace("_us", ""): value / 1000
+                           for key, value in latency.items() if key.endswith("_us")},
+            "result_cache": stats["result_cache"]}
+
+def metadata():
+    """ Where the numbers come from: commit, interpreter, machine """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "python": platform.python_version(),
+            "platform": platform.platform(), "cpu_count": os.cpu_count(),
+            "timestamp": datetime.now(timezone.utc).isoformat()}
+
+def main(argv=None):
+    """ Run the selected suites and write the JSON document """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--suites", default="micro,ingest,e2e",
+                        help="comma separated: micro, ingest, e2e")
+    parser.add_argument("--sizes", default="10000,100000,1000000",
+                        help="dataset rows for micro and ingest, e.g. 10000,...,10000000")
+    parser.add_argument("--engines", default="dict,columnar")
+    parser.add_argument("--ops", type=int, default=1000, help="calls per statistic (micro)")
+    parser.add_argument("--e2e-rows", type=int, default=100000)
+    parser.add_argument("--e2e-engine", default="dict")
+    parser.add_argument("--requests", type=int, default=2000, help="jobs submitted (e2e)")
+    parser.add_argument("--concurrency", type=int, default=16, help="parallel clients (e2e)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--questions", type=int, default=len(generate_dataset.QUESTIONS),
+                        help="distinct questions in the synthetic data")
+    parser.add_argument("--locations", type=int, default=len(generate_dataset.LOCATIONS),
+                        help="distinct locations in the synthetic data")
+    parser.add_argument("--years", type=int, default=12, help="distinct years, up to 2022")
+    parser.add_argument("--question-skew", type=float, default=0.0,
+                        help="Zipf exponent of the question frequencies, 0 = uniform")
+    parser.add_argument("--location-skew", type=float, default=0.0,
+                        help="Zipf exponent of the location frequencies, 0 = uniform")
+    parser.add_argument("--missing-rate", type=float, default=0.0,
+                        help="fraction of rows without a Data_Value")
+    parser.add_argument("--columns", choices=["full", "minimal"], default="full",
+                        help="every CDC column, or only the ones the server reads")
+    parser.add_argument("--output", help="JSON file, stdout if not set")
+    args = parser.parse_args(argv)
+
+    suites = args.suites.split(",")
+    sizes = [int(size) for size in args.sizes.split(",")]
+    engines = args.engines.split(",")
+    report = {"meta": metadata(), "config": vars(args)}
+    data = {"seed": args.seed, "questions": args.questions, "locations": args.locations,
+            "years": args.years, "question_skew": args.question_skew,
+            "location_skew": args.location_skew, "missing_rate": args.missing_rate,
+            "columns": args.columns}
+
+    with tempfile.TemporaryDirectory(prefix="bench_") as work_dir:
+        module = load_data_ingestor()
+        if module.np is None:
+            engines = [engine for engine in engines if engine != "columnar"]
+        if "ingest" in suites:
+            report["ingest"] = bench_ingest(module, work_dir, sizes, engines, data)
+        if "micro" in suites:
+            report["micro"] = bench_micro(module, work_dir, sizes, engines, args.ops, data)
+        if "e2e" in suites:
+            report["e2e"] = bench_e2e(module, work_dir, args.e2e_rows, args.e2e_engine,
+                                      args.requests, args.concurrency, data)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
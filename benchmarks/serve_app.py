@@ -0,0 +1,32 @@
+""" The app on a free local port, for the e2e benchmark
+
+    python -m benchmarks.serve_app
+
+Run from the directory the app should work in, with DATASET_PATH and
+INGESTOR_ENGINE set. Prints the port once the app is imported (the dataset is
+loaded by then), then serves until it is terminated.
+"""
+
+import logging
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+class QuietHandler(WSGIRequestHandler):
+    """ The werkzeug request handler without the per-request access log """
+    def log_request(self, *args, **kwargs):
+        pass
+
+def main():
+    """ Import the app, announce the port on stdout and serve """
+    from app import webserver
+
+    # the app logs every request at INFO: keep that in its log file, off the console
+    for handler in logging.getLogger().handlers:
+        handler.setLevel(logging.WARNING)
+
+    server = make_server("127.0.0.1", 0, webserver, threaded=True, request_handler=QuietHandler)
+    print(server.server_port, flush=True)
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,44 @@
 """ Unittest file for correct computations """
 
+import importlib
+import json
+import logging
+import os
+import queue
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
 import unittest
 from deepdiff import DeepDiff
-from demo_ingestor import DemoIngestor
+from flask import Flask
+from demo_ingestor import DemoIngestor, ColumnarIngestor, IngestProgress, np, parse_csv
+
+def load_app_module(name):
+    """ app.<name> without app/__init__.py, which would start the server
+
+    The package is registered bare, with only its path, so the module and the
+    app.* modules it imports load as usual.
+    """
+    if "app" not in sys.modules:
+        package = types.ModuleType("app")
+        package.__path__ = [os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")]
+        sys.modules["app"] = package
+    return importlib.import_module("app." + name)
+
+admission = load_app_module("admission")
+dataset_reloader = load_app_module("dataset_reloader")
+job_events = load_app_module("job_events")
+job_registry = load_app_module("job_registry")
+log_pipeline = load_app_module("log_pipeline")
+metrics = load_app_module("metrics")
+profiler = load_app_module("profiler")
+result_cache = load_app_module("result_cache")
+result_store = load_app_module("result_store")
+task_runner = load_app_module("task_runner")
 
 class TestWebserver(unittest.TestCase):
     """ Class that includes all tests """
@@ -90,3 +126,913 @@ class TestWebserver(unittest.TestCase):
         d = DeepDiff(res, {'Wisconsin': {"('Age (years)', '55 - 64')": 5.0,
                                          "('Age (years)', '18 - 24')": 8.0}}, math_epsilon=0.01)
         self.assertTrue(not d, str(d))
+
+    def test_unittest_aggregate_index(self):
+        """ Test the precomputed (sum, count, min, max) index - expect to pass """
+        question = "Percent of adults who engage in no leisure-time physical activity"
+        self.assertEqual(self.ingestor.state_index[question]["Wisconsin"], (26.0, 4, 4.0, 10.0))
+        self.assertEqual(self.ingestor.question_index[question][1:], (10, 3.0, 10.0))
+        self.assertEqual(self.ingestor.category_index[question]["Wisconsin"],
+                         {('Age (years)', '55 - 64'): (10.0, 2, 4.0, 6.0),
+                          ('Age (years)', '18 - 24'): (16.0, 2, 6.0, 10.0)})
+        self.assertEqual(self.ingestor.state_rankings[question][0], ('Hawaii', 5.5))
+
+
+    def test_unittest_estimate_cost(self):
+        """ Test the cost estimate used to pick the inline path - expect to pass """
+        question = "Percent of adults who engage in no leisure-time physical activity"
+        self.assertEqual(self.ingestor.estimate_cost("state_mean_request", question, "Hawaii"), 1)
+        self.assertEqual(self.ingestor.estimate_cost("states_mean_request", question), 6)
+        self.assertEqual(self.ingestor.estimate_cost("mean_by_category_request", question), 7)
+        self.assertEqual(self.ingestor.estimate_cost("best5_request", "missing"), float("inf"))
+
+    def test_unittest_best_direction_metadata(self):
+        """ The best/worst direction comes from the dataset metadata - expect to pass """
+        question = "Percent of adults who engage in no leisure-time physical activity"
+        flipped = DemoIngestor("./my_csv.csv", best_is_min=[], best_is_max=[question])
+        self.assertEqual(flipped.get_best5(question), self.ingestor.get_worst5(question))
+        self.assertEqual(flipped.get_worst5(question), self.ingestor.get_best5(question))
+
+    def test_unittest_appended(self):
+        """ Appending rows gives a new version, the old one is unchanged - expect to pass """
+        question = "Percent of adults who engage in no leisure-time physical activity"
+        old_rows = {state: list(rows)
+                    for state, rows in self.ingestor.all_questions[question].items()}
+        new = self.ingestor.appended([(question, "Hawaii", 8.5, "55 - 64", "Age (years)"),
+                                      (question, "Ohio", 4.0, "18 - 24", "Age (years)")])
+        self.assertEqual(self.ingestor.get_state_mean(question, "Hawaii"), 5.5)
+        self.assertNotIn("Ohio", self.ingestor.state_index[question])
+        self.assertEqual(self.ingestor.all_questions[question], old_rows)
+        # the raw rows are not copied, the new ones are one more shared chunk
+        self.assertIs(new.all_questions, self.ingestor.all_questions)
+        self.assertEqual(len(new.appended_rows), 1)
+        self.assertEqual(len(new.appended([]).appended_rows), 2)
+        self.assertEqual(new.rows, self.ingestor.rows + 2)
+        self.assertEqual(new.get_state_mean(question, "Hawaii"), 6.5)
+        self.assertEqual(new.get_best5(question), {"Ohio": 4.0, "Idaho": 6.0, "Hawaii": 6.5,
+                                                   "Wisconsin": 6.5, "Alaska": 7.0})
+        self.assertEqual(new.category_index[question]["Hawaii"][("Age (years)", "55 - 64")],
+                         (19.5, 3, 3.0, 8.5))
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class TestColumnar(unittest.TestCase):
+    """ The columnar engine must give the same answers as the dict engine """
+    def setUp(self):
+        """ Read the same csv with both engines """
+        self.ingestor = DemoIngestor("./my_csv.csv")
+        self.columnar = ColumnarIngestor("./my_csv.csv")
+        self.question = "Percent of adults who engage in no leisure-time physical activity"
+
+    def test_unittest_columnar_question_stats(self):
+        """ Compare every per-question statistic - expect to pass """
+        for method in ["get_global_mean", "get_states_mean", "get_best5", "get_worst5",
+                       "get_diff_from_mean", "get_mean_by_category"]:
+            res = getattr(self.columnar, method)(self.question)
+            ref = getattr(self.ingestor, method)(self.question)
+            d = DeepDiff(res, ref, math_epsilon=0.0001)
+            self.assertTrue(not d, method + str(d))
+            if isinstance(ref, dict):
+                self.assertEqual(list(res), list(ref), method)
+
+    def test_unittest_columnar_state_stats(self):
+        """ Compare every per-state statistic - expect to pass """
+        for state in self.ingestor.all_questions[self.question]:
+            for method in ["get_state_mean", "get_state_diff_from_mean",
+                           "get_state_mean_by_category"]:
+                res = getattr(self.columnar, method)(self.question, state)
+                ref = getattr(self.ingestor, method)(self.question, state)
+                d = DeepDiff(res, ref, math_epsilon=0.0001)
+                self.assertTrue(not d, method + str(d))
+
+    def test_unittest_columnar_state_without_rows(self):
+        """ A state with no rows for the question fails in both engines - expect to pass """
+        other = "Percent of adults aged 18 years and older who have obesity"
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        csv_path = os.path.join(tmp_dir, "my_csv.csv")
+        with open("./my_csv.csv", encoding="utf-8") as src, \
+                open(csv_path, "w", encoding="utf-8") as dst:
+            dst.write(src.read())
+            dst.write(f"11,Guam,{other},30.0,Age (years),55 - 64\n")
+        engines = [DemoIngestor(csv_path), ColumnarIngestor(csv_path, use_snapshot=False)]
+        for state in ["Guam", "Atlantis"]:
+            for method in ["get_state_mean", "get_state_mean_by_category"]:
+                for engine in engines:
+                    with self.assertRaises(KeyError, msg=method):
+                        getattr(engine, method)(self.question, state)
+        for engine in engines:
+            self.assertEqual(engine.get_state_mean_by_category(other, "Guam"),
+                             {"Guam": {"('Age (years)', '55 - 64')": 30.0}})
+
+
+class TestSnapshot(unittest.TestCase):
+    """ The binary snapshot must rebuild exactly what the csv gives """
+    def setUp(self):
+        """ Work on a copy of the csv, the snapshot is written next to it """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.tmp_dir, "my_csv.csv")
+        shutil.copy("./my_csv.csv", self.csv_path)
+
+    def tearDown(self):
+        """ Drop the copy and its snapshot """
+        shutil.rmtree(self.tmp_dir)
+
+    def test_unittest_snapshot_reload(self):
+        """ Second load comes from the snapshot with the same data - expect to pass """
+        first = DemoIngestor(self.csv_path)
+        second = DemoIngestor(self.csv_path)
+        self.assertFalse(first.loaded_from_snapshot)
+        self.assertTrue(second.loaded_from_snapshot)
+        self.assertEqual(first.all_questions, second.all_questions)
+        self.assertEqual(first.state_rankings, second.state_rankings)
+
+    def test_unittest_snapshot_stale(self):
+        """ A changed csv invalidates the snapshot - expect to pass """
+        DemoIngestor(self.csv_path)
+        with open(self.csv_path, "a", encoding="utf-8") as f:
+            f.write("11,Ohio,Percent of adults who engage in no leisure-time physical activity,"
+                    "1.0,Age (years),55 - 64\n")
+        ingestor = DemoIngestor(self.csv_path)
+        self.assertFalse(ingestor.loaded_from_snapshot)
+        self.assertIn("Ohio", ingestor.state_index[
+            "Percent of adults who engage in no leisure-time physical activity"])
+
+    def test_unittest_bad_values_skipped(self):
+        """ Empty or non-numeric Data_Value rows are counted, not fatal - expect to pass """
+        with open(self.csv_path, "a", encoding="utf-8") as f:
+            f.write("11,Ohio,Percent of adults who engage in no leisure-time physical activity,"
+                    ",Age (years),55 - 64\n")
+            f.write("12,Ohio,Percent of adults who engage in no leisure-time physical activity,"
+                    "n/a,Age (years),55 - 64\n")
+        ingestor = DemoIngestor(self.csv_path, use_snapshot=False)
+        self.assertEqual(ingestor.skipped_rows, 2)
+        self.assertNotIn("Ohio", ingestor.state_index[
+            "Percent of adults who engage in no leisure-time physical activity"])
+
+    def test_unittest_chunked_parse(self):
+        """ Tiny chunks parsed in parallel merge into the single chunk result - expect to pass """
+        whole = parse_csv(self.csv_path, workers=1)
+        chunked = parse_csv(self.csv_path, progress=IngestProgress(), workers=2, chunk_bytes=64)
+        self.assertEqual(whole[0], chunked[0])
+        for name in whole[1]:
+            self.assertEqual(whole[1][name], chunked[1][name])
+
+class TestJobRegistry(unittest.TestCase):
+    """ Statuses and retention of the job ids """
+    def setUp(self):
+        """ Record what the registry evicts """
+        self.evicted = []
+
+    def registry(self, max_count=0, max_age=0):
+        """ A registry reporting its evictions to self.evicted """
+        return job_registry.JobRegistry(max_count, max_age, on_evict=self.evicted.append)
+
+    def test_unittest_jobs_evicted_by_count(self):
+        """ Only the newest max_count jobs are kept - expect to pass """
+        jobs = self.registry(max_count=3)
+        ids = []
+        for _ in range(5):
+            ids.append(jobs.create())
+            jobs.mark_done(ids[-1])
+        jobs.create()
+        self.assertEqual(self.evicted, ids[:3])
+        self.assertIsNone(jobs.get(ids[2]))
+        self.assertEqual(jobs.get(ids[3]), "done")
+        self.assertEqual(jobs.stats()["done"], 2)
+
+    def test_unittest_jobs_evicted_by_age(self):
+        """ Done jobs older than max_age go at the next create - expect to pass """
+        jobs = self.registry(max_age=60)
+        old = jobs.create()
+        jobs.mark_done(old)
+        jobs.stamps[jobs.position(jobs.job_number(old))] -= 120
+        new = jobs.create()
+        self.assertEqual(self.evicted, [old])
+        self.assertIsNone(jobs.get(old))
+        self.assertEqual(jobs.get(new), "running")
+
+    def test_unittest_running_job_does_not_block_eviction(self):
+        """ A job stuck running at the front is set aside, the newer ones still go - expect to pass """
+        jobs = self.registry(max_count=2)
+        stuck = jobs.create()
+        ids = []
+        for _ in range(4):
+            ids.append(jobs.create())
+            jobs.mark_done(ids[-1])
+        self.assertEqual(self.evicted, ids[:2])
+        self.assertEqual(jobs.get(stuck), "running")
+        self.assertIn((stuck, "running"), list(jobs.items()))
+        # once done it is already more than max_count ids behind
+        jobs.mark_done(stuck)
+        self.assertEqual(self.evicted[-1], stuck)
+        self.assertIsNone(jobs.get(stuck))
+        self.assertEqual(jobs.stats()["stragglers"], 0)
+
+    def test_unittest_jobs_pages(self):
+        """ Pages of limit jobs follow each other through the cursor, filtered by status - expect to pass """
+        jobs = self.registry()
+        ids = [jobs.create() for _ in range(7)]
+        for job_id in ids[::2]:
+            jobs.mark_done(job_id)
+
+        pages, cursor = [], 1
+        while cursor is not None:
+            page = list(jobs.page(cursor, limit=3))
+            cursor = page.pop()[1] if page[-1][0] is None else None
+            pages.append([job_id for job_id, _ in page])
+        self.assertEqual(pages, [ids[0:3], ids[3:6], ids[6:]])
+
+        self.assertEqual(list(jobs.page(status="done", limit=2)),
+                         [(ids[0], "done"), (ids[2], "done"), (None, 5)])
+        self.assertEqual(list(jobs.page(5, status="done", limit=2)),
+                         [(ids[4], "done"), (ids[6], "done")])
+        self.assertEqual([job_id for job_id, _ in jobs.page(status="running")], ids[1::2])
+        self.assertEqual(list(jobs.page(8)), [])
+
+    def test_unittest_unknown_job_ids(self):
+        """ Ids never handed out or malformed have no status - expect to pass """
+        jobs = self.registry()
+        jobs.create()
+        for job_id in ["job_id_0", "job_id_2", "job_id_-1", "job_id_x", "job_1", "", None]:
+            self.assertIsNone(jobs.get(job_id), job_id)
+            jobs.mark_done(job_id)
+        self.assertEqual(jobs.stats()["running"], 1)
+
+class TestFairScheduler(unittest.TestCase):
+    """ Class turns, client turns and shortest job first of the job queue """
+    @staticmethod
+    def job(request_type, client="a", cost=0):
+        """ The fields the scheduler looks at """
+        return {"request_type": request_type + "_request", "client": client, "cost": cost}
+
+    def drain(self, scheduler):
+        """ Every job still queued, in the order get hands them out """
+        jobs = []
+        while not scheduler.empty():
+            jobs.append(scheduler.get(timeout=1))
+        return jobs
+
+    def test_unittest_scheduler_class_weights(self):
+        """ Each round serves every waiting class its weight in jobs - expect to pass """
+        scheduler = task_runner.FairScheduler(None, weights=(2, 1, 1))
+        for request_type in ["best5", "mean_by_category", "global_mean"] * 4:
+            scheduler.put(self.job(request_type))
+        order = [task_runner.REQUEST_CLASSES[job["request_type"]]
+                 for job in self.drain(scheduler)]
+        self.assertEqual(order, ["interactive", "interactive", "standard", "bulk"] * 2
+                         + ["standard", "bulk"] * 2)
+
+    def test_unittest_scheduler_client_turns(self):
+        """ Inside a class the clients get one job each in turn - expect to pass """
+        scheduler = task_runner.FairScheduler(None)
+        for client in ["a", "a", "a", "b", "c"]:
+            scheduler.put(self.job("global_mean", client))
+        self.assertEqual([job["client"] for job in self.drain(scheduler)],
+                         ["a", "b", "c", "a", "a"])
+
+    def test_unittest_scheduler_sjf(self):
+        """ With sjf a client's cheapest job goes first, else arrival order - expect to pass """
+        for sjf, expected in [(True, [1, 3, 5]), (False, [5, 1, 3])]:
+            scheduler = task_runner.FairScheduler(lambda job: job["cost"], sjf=sjf)
+            for cost in [5, 1, 3]:
+                scheduler.put(self.job("global_mean", cost=cost))
+            self.assertEqual([job["cost"] for job in self.drain(scheduler)], expected)
+
+    def test_unittest_scheduler_close_and_retire(self):
+        """ Retired workers get None at once, after close the queue drains first - expect to pass """
+        scheduler = task_runner.FairScheduler(None)
+        scheduler.put(self.job("global_mean"))
+        scheduler.retire(1)
+        self.assertIsNone(scheduler.get(timeout=1))
+        scheduler.close()
+        self.assertEqual(scheduler.get(timeout=1)["client"], "a")
+        self.assertIsNone(scheduler.get(timeout=1))
+        self.assertIsNone(scheduler.get(timeout=1))
+
+    def test_unittest_scheduler_timeout(self):
+        """ An empty open queue raises Empty after the timeout - expect to pass """
+        with self.assertRaises(queue.Empty):
+            task_runner.FairScheduler(None).get(timeout=0.01)
+
+class TestResultStore(unittest.TestCase):
+    """ Segment files and the memory store with its spill """
+    def setUp(self):
+        """ The stores write in a directory of their own """
+        self.tmp_dir = tempfile.mkdtemp()
+        # 76 bytes once serialized with an "n": two fit in 160
+        self.content = {"data": {"global_mean": "x" * 20}, "status": "done"}
+
+    def tearDown(self):
+        """ Drop the segments and spilled files """
+        shutil.rmtree(self.tmp_dir)
+
+    def test_unittest_segment_roll_and_drop(self):
+        """ Full segments roll, a segment goes with its last result - expect to pass """
+        store = result_store.SegmentLogResultStore(self.tmp_dir, 160)
+        for i in range(1, 5):
+            store.put(f"job_id_{i}", dict(self.content, n=i))
+        self.assertEqual(store.stats()["segments"], 2)
+        self.assertEqual(store.get("job_id_1")["n"], 1)
+        self.assertEqual(store.get("job_id_4")["n"], 4)
+
+        store.delete("job_id_1")
+        self.assertTrue(os.path.exists(store.segment_path(1)))
+        store.delete("job_id_2")
+        self.assertFalse(os.path.exists(store.segment_path(1)))
+        with self.assertRaises(KeyError):
+            store.get("job_id_2")
+
+        # the current segment stays until the next roll, even empty
+        store.delete("job_id_3")
+        store.delete("job_id_4")
+        self.assertTrue(os.path.exists(store.segment_path(2)))
+        for i in range(5, 8):
+            store.put(f"job_id_{i}", self.content)
+        self.assertFalse(os.path.exists(store.segment_path(2)))
+        self.assertEqual(store.stats()["entries"], 3)
+
+    def test_unittest_memory_store_spill(self):
+        """ Over the budget the oldest results spill to the files and read back - expect to pass """
+        spill = result_store.FileResultStore(self.tmp_dir)
+        store = result_store.MemoryResultStore(160, spill)
+        for i in range(1, 4):
+            store.put(f"job_id_{i}", dict(self.content, n=i))
+        self.assertEqual(store.stats()["spilled"], 1)
+        self.assertLessEqual(store.stats()["bytes_used"], 160)
+        self.assertTrue(os.path.exists(spill.path("job_id_1")))
+        for i in range(1, 4):
+            self.assertEqual(store.get(f"job_id_{i}"), dict(self.content, n=i))
+
+        store.delete("job_id_1")
+        self.assertFalse(os.path.exists(spill.path("job_id_1")))
+        with self.assertRaises(KeyError):
+            store.get("job_id_1")
+        store.delete("job_id_3")
+        self.assertEqual(store.stats()["entries"], 1)
+        self.assertEqual(store.stats()["spilling"], 0)
+
+    def test_unittest_memory_store_spilling_reads(self):
+        """ A result is readable while its spill is written, and a delete meanwhile wins - expect to pass """
+        test = self
+
+        class SlowFiles(result_store.FileResultStore):
+            """ Checks the store from inside the spill write """
+            def put(self, job_id, content):
+                test.assertEqual(store.get(job_id), content)
+                store.delete(job_id)
+                super().put(job_id, content)
+
+        spill = SlowFiles(self.tmp_dir)
+        store = result_store.MemoryResultStore(100, spill)
+        store.put("job_id_1", self.content)
+        store.put("job_id_2", self.content)
+        self.assertFalse(os.path.exists(spill.path("job_id_1")))
+        with self.assertRaises(KeyError):
+            store.get("job_id_1")
+        self.assertEqual(store.get("job_id_2"), self.content)
+
+class TestAdmission(unittest.TestCase):
+    """ Queue watermarks and the per-client token bucket """
+    def test_unittest_watermark_hysteresis(self):
+        """ Refused from the high watermark until the queue is back to the low one - expect to pass """
+        depth = [0]
+        controller = admission.AdmissionController(lambda: depth[0], 10, 5, 0, 1, 2)
+        verdicts = []
+        for queued in [9, 10, 7, 6, 5, 7, 9]:
+            depth[0] = queued
+            verdicts.append(controller.admit("a"))
+        refused = (503, "overloaded", 2)
+        self.assertEqual(verdicts, [None, refused, refused, refused, None, None, None])
+        self.assertEqual(controller.stats()["rejected_overload"], 3)
+
+    def test_unittest_token_bucket(self):
+        """ A client gets its burst, then waits for the refill; others are not affected - expect to pass """
+        bucket = admission.TokenBucket(rate=2, burst=3)
+        self.assertEqual([bucket.acquire("a") for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.acquire("a"), 0.5, places=2)
+        self.assertEqual(bucket.acquire("b"), 0)
+        # one second later: two tokens back
+        bucket.buckets["a"][1] -= 1
+        self.assertEqual([bucket.acquire("a") for _ in range(2)], [0, 0])
+        self.assertGreater(bucket.acquire("a"), 0)
+
+    def test_unittest_token_bucket_cap(self):
+        """ Busy clients past max_clients evict the least recently used ones - expect to pass """
+        bucket = admission.TokenBucket(rate=1, burst=2, max_clients=3)
+        for client in ["a", "b", "c"]:
+            self.assertEqual([bucket.acquire(client) for _ in range(2)], [0, 0])
+        self.assertGreater(bucket.acquire("a"), 0)
+        self.assertEqual(bucket.acquire("d"), 0)
+        self.assertEqual(list(bucket.buckets), ["c", "a", "d"])
+        # a refilled bucket goes before the least recently used one
+        bucket.buckets["a"][1] -= 10
+        self.assertEqual(bucket.acquire("e"), 0)
+        self.assertEqual(list(bucket.buckets), ["c", "d", "e"])
+        for client in range(100):
+            bucket.acquire(client)
+            bucket.acquire(client)
+            self.assertLessEqual(len(bucket.buckets), 3)
+
+    def test_unittest_rate_limit_answer(self):
+        """ Over the rate the controller answers 429 with a whole Retry-After - expect to pass """
+        controller = admission.AdmissionController(lambda: 0, 0, 0, 0.5, 1, 1)
+        self.assertIsNone(controller.admit("a"))
+        self.assertEqual(controller.admit("a"), (429, "rate limited", 2))
+        self.assertIsNone(controller.admit("b"))
+        self.assertEqual(controller.stats()["rejected_rate"], 1)
+
+class PoolTestCase(unittest.TestCase):
+    """ A ThreadPool on the test csv, with its results and saved jobs in a directory of its own """
+    QUESTION = "Percent of adults who engage in no leisure-time physical activity"
+    ENV = {"TP_NUM_OF_THREADS": "2", "RESULT_CACHE_SIZE": "0"}
+
+    def setUp(self):
+        """ The pool reads its settings from the environment, restored in tearDown """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.saved_env = dict(os.environ)
+        os.environ.update(self.ENV, RESULT_STORE_DIR=os.path.join(self.tmp_dir, "results"),
+                          TP_PENDING_JOBS_FILE=os.path.join(self.tmp_dir, "pending.json"))
+        self.pools = []
+
+    def tearDown(self):
+        """ Stop every pool started by the test """
+        for pool in self.pools:
+            pool.join_workers()
+        os.environ.clear()
+        os.environ.update(self.saved_env)
+        shutil.rmtree(self.tmp_dir)
+
+    def pool(self, ingestor=True):
+        """ A new pool; with ingestor its workers start on the test csv right away """
+        pool = task_runner.ThreadPool()
+        self.pools.append(pool)
+        if ingestor:
+            self.start(pool)
+        return pool
+
+    @staticmethod
+    def start(pool):
+        """ What the first request does: give the pool its dataset and let the workers go """
+        pool.set_ingestor(DemoIngestor("./my_csv.csv"))
+        pool.merging_csv.set()
+
+    def submit(self, pool, request_type="global_mean", **fields):
+        """ Queue a job as the routes do, returns its job_id """
+        job = {"request_type": request_type + "_request", "question": self.QUESTION,
+               "job_id": pool.jobs.create(), **fields}
+        pool.add_job(job)
+        return job["job_id"]
+
+    @staticmethod
+    def wait_done(pool, job_id, timeout=5):
+        """ The result of a job, once it is done """
+        pool.job_events.wait_job(job_id, lambda: pool.jobs.get(job_id) == "running", timeout)
+        return pool.result_store.get(job_id)
+
+class TestPendingJobs(PoolTestCase):
+    """ Jobs that never started survive a restart """
+    def test_unittest_pending_jobs_restored(self):
+        """ Queued jobs and the identical jobs coalesced onto them are requeued - expect to pass """
+        pool = self.pool(ingestor=False)
+        ids = [self.submit(pool) for _ in range(3)] + [self.submit(pool, "best5")]
+        self.assertEqual(pool.coalescing_stats()["waiting"], 2)
+        pool.join_workers()
+        self.pools.remove(pool)
+
+        restored = self.pool(ingestor=False)
+        self.assertEqual([restored.jobs.get(job_id) for job_id in ids], ["running"] * 4)
+        self.assertEqual(restored.coalescing_stats()["waiting"], 2)
+        self.start(restored)
+        for job_id in ids[:3]:
+            self.assertEqual(self.wait_done(restored, job_id), {"global_mean": 6.7})
+        self.assertIn("Hawaii", self.wait_done(restored, ids[3]))
+        self.assertEqual(restored.jobs.create(), "job_id_5")
+
+class TestBatch(unittest.TestCase):
+    """ A batch computed in one pass answers like the jobs one by one """
+    def setUp(self):
+        """ Read the csv """
+        self.ingestor = DemoIngestor("./my_csv.csv")
+        self.question = "Percent of adults who engage in no leisure-time physical activity"
+
+    def test_unittest_batch_items(self):
+        """ One item per job, in order, shared aggregates included - expect to pass """
+        jobs = [{"request_type": "state_mean_request", "question": self.question,
+                 "state": "Hawaii"},
+                {"request_type": "states_mean_request", "question": self.question},
+                {"request_type": "state_diff_from_mean_request", "question": self.question,
+                 "state": "Idaho"},
+                {"request_type": "global_mean_request", "question": self.question},
+                {"request_type": "state_mean_request", "question": self.question,
+                 "state": "Hawaii"}]
+        items = task_runner.compute_batch(self.ingestor, jobs)
+        self.assertEqual([item["status"] for item in items], ["done"] * 5)
+        for job, item in zip(jobs, items):
+            self.assertEqual(item["data"], task_runner.compute_result(self.ingestor, job))
+
+    def test_unittest_batch_item_errors(self):
+        """ An unknown state or question fails its own item only - expect to pass """
+        jobs = [{"request_type": "state_mean_request", "question": self.question,
+                 "state": "Atlantis"},
+                {"request_type": "best5_request", "question": "No such question"},
+                {"request_type": "global_mean_request", "question": self.question}]
+        items = task_runner.compute_batch(self.ingestor, jobs)
+        self.assertEqual([item["status"] for item in items], ["error", "error", "done"])
+        self.assertIn("Atlantis", items[0]["reason"])
+        self.assertEqual(items[2]["data"], {"global_mean": 6.7})
+
+class TestCoalescing(PoolTestCase):
+    """ Identical jobs in flight are computed once """
+    def test_unittest_single_flight(self):
+        """ Concurrent identical jobs: one computation, every job_id answered - expect to pass """
+        pool = self.pool(ingestor=False)
+        computed = []
+        execute = pool.execute
+
+        def counting_execute(job, ingestor):
+            computed.append(job["job_id"])
+            return execute(job, ingestor)
+        pool.execute = counting_execute
+
+        ids = []
+        submitters = [threading.Thread(target=lambda: ids.append(self.submit(pool)))
+                      for _ in range(8)]
+        for thread in submitters:
+            thread.start()
+        for thread in submitters:
+            thread.join()
+        self.start(pool)
+
+        for job_id in ids:
+            self.assertEqual(self.wait_done(pool, job_id), {"global_mean": 6.7})
+        self.assertEqual(len(computed), 1)
+        self.assertEqual(pool.coalescing_stats(),
+                         {"in_flight": 0, "waiting": 0, "coalesced_jobs": 7})
+
+class TestCostEstimate(PoolTestCase):
+    """ The estimate that picks inline answers and shortest jobs """
+    def test_unittest_unloaded_dataset_is_expensive(self):
+        """ A job on a dataset not in memory costs inf, a loaded one its index entries - expect to pass """
+        pool = self.pool(ingestor=False)
+        job = {"request_type": "global_mean_request", "question": self.QUESTION}
+        self.assertEqual(pool.estimate_cost(job), float("inf"))
+        self.start(pool)
+        self.assertEqual(pool.estimate_cost(job), 1)
+        self.assertEqual(pool.estimate_cost(dict(job, dataset="other")), float("inf"))
+
+def spin(seconds):
+    """ Stay on the CPU in a frame of our own, for the profiler to find """
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+
+class TestProfiler(unittest.TestCase):
+    """ The sampling profiler of the workers """
+    def test_unittest_profiler_samples(self):
+        """ The stacks of the given threads are counted, rooted at their label - expect to pass """
+        ident = threading.get_ident()
+        sampler = profiler.SamplingProfiler(lambda: {ident: "Main"})
+        self.assertIsNone(sampler.stop())
+        self.assertTrue(sampler.start(interval=0.001, max_seconds=10))
+        self.assertFalse(sampler.start())
+        spin(0.2)
+        report = sampler.stop()
+        self.assertFalse(report["running"])
+        self.assertGreater(report["samples"], 0)
+        self.assertEqual(report["samples"], report["stack_samples"])
+        stacks = report["folded"].splitlines()
+        self.assertTrue(all(line.startswith("Main;") for line in stacks))
+        self.assertTrue(any(";TestWebserver.py:spin " in line for line in stacks))
+        self.assertEqual(sum(int(line.rsplit(" ", 1)[1]) for line in stacks), report["samples"])
+
+    def test_unittest_profiler_bad_settings(self):
+        """ A zero, negative or infinite duration is refused - expect to pass """
+        sampler = profiler.SamplingProfiler(dict)
+        for interval, max_seconds in [(0, 1), (-1, 1), (0.01, 0), (float("nan"), 1),
+                                      (0.01, float("inf"))]:
+            with self.assertRaises(ValueError):
+                sampler.start(interval, max_seconds)
+        self.assertIsNone(sampler.stop())
+
+class TestJobTimings(PoolTestCase):
+    """ Per-job timing breakdowns and the slow job log """
+    ENV = dict(PoolTestCase.ENV, PROFILE_JOBS="1", SLOW_JOB_SECONDS="0.000001")
+
+    def test_unittest_job_timings(self):
+        """ Every stage is timed, total is their sum, slow jobs are logged - expect to pass """
+        pool = self.pool()
+        with self.assertLogs("app.task_runner", "WARNING") as logs:
+            job_id = self.submit(pool)
+            self.wait_done(pool, job_id)
+            deadline = time.monotonic() + 5
+            while "total" not in (pool.get_timings(job_id) or {}) and time.monotonic() < deadline:
+                time.sleep(0.01)
+        timings = pool.get_timings(job_id)
+        self.assertEqual(set(timings), {"queue_wait", "dataset_load", "compute", "result_write",
+                                        "total"})
+        self.assertAlmostEqual(timings["total"], sum(timings.values()) - timings["total"])
+        self.assertIn("Slow job " + job_id, logs.output[0])
+        self.assertIsNone(pool.get_timings("job_id_404"))
+
+class TestResultCache(unittest.TestCase):
+    """ LRU, time to live and dataset versions of the result cache """
+    @staticmethod
+    def key(state, dataset=None):
+        """ The key of a state_mean job """
+        return result_cache.ResultCache.job_key({"request_type": "state_mean_request",
+                                                 "question": "Q", "state": state,
+                                                 "dataset": dataset})
+
+    def test_unittest_cache_lru(self):
+        """ Past max_size the least recently used entry goes - expect to pass """
+        cache = result_cache.ResultCache(2, 0)
+        cache.put(self.key("A"), 1)
+        cache.put(self.key("B"), 2)
+        self.assertEqual(cache.get(self.key("A")), 1)
+        cache.put(self.key("C"), 3)
+        self.assertIsNone(cache.get(self.key("B")))
+        self.assertEqual(cache.get(self.key("A")), 1)
+        self.assertEqual(cache.get(self.key("C")), 3)
+        stats = cache.stats()
+        self.assertEqual((stats["size"], stats["evictions"], stats["hits"], stats["misses"]),
+                         (2, 1, 3, 1))
+
+    def test_unittest_cache_ttl(self):
+        """ An expired entry is a miss and is dropped - expect to pass """
+        cache = result_cache.ResultCache(10, 60)
+        cache.put(self.key("A"), 1)
+        cache.put(self.key("B"), 2)
+        expiry, result = cache.entries[self.key("A")]
+        cache.entries[self.key("A")] = (expiry - 120, result)
+        self.assertIsNone(cache.get(self.key("A")))
+        self.assertEqual(cache.get(self.key("B")), 2)
+        self.assertEqual(cache.stats()["expirations"], 1)
+        self.assertEqual(cache.stats()["size"], 1)
+
+    def test_unittest_cache_versions(self):
+        """ A new version drops the entries of its dataset only, older results are refused - expect to pass """
+        cache = result_cache.ResultCache(10, 0)
+        cache.set_version(1)
+        cache.set_version(1, "other")
+        cache.put(self.key("A"), 1, 1)
+        cache.put(self.key("A", "other"), 10, 1)
+
+        cache.set_version(2)
+        self.assertIsNone(cache.get(self.key("A")))
+        self.assertEqual(cache.get(self.key("A", "other")), 10)
+
+        # a job that started before the reload finishes after it
+        cache.put(self.key("A"), 1, 1)
+        self.assertIsNone(cache.get(self.key("A")))
+        self.assertEqual(cache.stats()["stale_puts"], 1)
+        cache.put(self.key("A"), 2, 2)
+        self.assertEqual(cache.get(self.key("A")), 2)
+
+        # unloaded: nothing is cached for it any more
+        cache.set_version(None, "other")
+        cache.put(self.key("B", "other"), 20, 1)
+        self.assertIsNone(cache.get(self.key("B", "other")))
+        self.assertEqual(cache.stats()["versions"], {"<default>": 2, "other": None})
+
+    def test_unittest_cache_disabled(self):
+        """ max_size 0 caches nothing - expect to pass """
+        cache = result_cache.ResultCache(0, 0)
+        cache.put(self.key("A"), 1)
+        self.assertIsNone(cache.get(self.key("A")))
+
+class TestJobEvents(unittest.TestCase):
+    """ Waiting for one job or for any completion """
+    def setUp(self):
+        """ Events and the set of jobs still running """
+        self.events = job_events.JobEvents(history=3)
+        self.running = {"job_id_1", "job_id_2"}
+
+    def finish_later(self, job_id, delay=0.05):
+        """ Mark a job done and publish it from another thread """
+        def finish():
+            time.sleep(delay)
+            self.running.discard(job_id)
+            self.events.publish(job_id)
+        thread = threading.Thread(target=finish)
+        thread.start()
+        self.addCleanup(thread.join)
+
+    def test_unittest_wait_job_done(self):
+        """ The waiter wakes up when its job is published - expect to pass """
+        self.finish_later("job_id_1")
+        start = time.monotonic()
+        self.events.wait_job("job_id_1", lambda: "job_id_1" in self.running, 5)
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertNotIn("job_id_1", self.running)
+        self.assertEqual(self.events.waiters, {})
+
+    def test_unittest_wait_job_timeout(self):
+        """ A job that stays running returns after the timeout, a done one at once - expect to pass """
+        start = time.monotonic()
+        self.events.wait_job("job_id_2", lambda: True, 0.05)
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+        start = time.monotonic()
+        self.events.wait_job("job_id_3", lambda: False, 5)
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_unittest_wait_since(self):
+        """ Completions after a sequence number, waking up on the next one - expect to pass """
+        self.assertEqual(self.events.wait_since(0, 0.01), [])
+        self.finish_later("job_id_2")
+        self.assertEqual(self.events.wait_since(0, 5), [(1, "job_id_2")])
+        for job_id in ["job_id_3", "job_id_4", "job_id_5"]:
+            self.events.publish(job_id)
+        # only the last history completions are kept
+        self.assertEqual(self.events.wait_since(1, 0.01),
+                         [(2, "job_id_3"), (3, "job_id_4"), (4, "job_id_5")])
+        self.assertEqual(self.events.wait_since(0, 0.01)[0], (2, "job_id_3"))
+        self.assertEqual(self.events.wait_since(self.events.last_seq(), 0.01), [])
+
+class TestPoolResize(PoolTestCase):
+    """ The autoscaler's grow and shrink """
+    ENV = dict(PoolTestCase.ENV, TP_MIN_THREADS="1", TP_MAX_THREADS="4")
+
+    @staticmethod
+    def alive(pool, count, timeout=5):
+        """ Wait until count workers run, returns how many do """
+        deadline = time.monotonic() + timeout
+        while True:
+            alive = sum(worker.is_alive() for worker in pool.workers)
+            if alive == count or time.monotonic() > deadline:
+                return alive
+
+    def test_unittest_grow(self):
+        """ Growing starts workers up to max_threads - expect to pass """
+        pool = self.pool()
+        pool.grow(5)
+        self.assertEqual(pool.worker_stats()["active"], 4)
+        self.assertEqual(self.alive(pool, 4), 4)
+        job_id = self.submit(pool)
+        self.assertEqual(self.wait_done(pool, job_id), {"global_mean": 6.7})
+
+    def test_unittest_shrink_keeps_queued_jobs(self):
+        """ Retired workers exit, the jobs queued meanwhile are all answered - expect to pass """
+        pool = self.pool(ingestor=False)
+        pool.grow(2)
+        ids = [self.submit(pool, request_type)
+               for request_type in ["global_mean", "best5", "worst5", "states_mean",
+                                    "diff_from_mean", "mean_by_category"]]
+        pool.shrink(10)
+        self.assertEqual(pool.worker_stats()["active"], 1)
+        self.start(pool)
+        for job_id in ids:
+            self.assertIsNotNone(self.wait_done(pool, job_id))
+        self.assertEqual(pool.jobs.stats()["done"], 6)
+        self.assertEqual(self.alive(pool, 1), 1)
+
+class TestPoolResizeFifo(TestPoolResize):
+    """ The same with the plain queue, where shrink queues sentinels """
+    ENV = dict(TestPoolResize.ENV, TP_SCHEDULER="fifo")
+
+class TestDatasetReloader(PoolTestCase):
+    """ Reloads: versions, cache invalidation and the allowed paths """
+    ENV = dict(PoolTestCase.ENV, RESULT_CACHE_SIZE="16")
+
+    def setUp(self):
+        """ A copy of the csv in the test directory, the allowed one """
+        super().setUp()
+        os.environ.pop("DATASET_DIR", None)
+        self.csv_path = os.path.join(self.tmp_dir, "data", "my_csv.csv")
+        os.makedirs(os.path.dirname(self.csv_path))
+        shutil.copy("./my_csv.csv", self.csv_path)
+        self.t_pool = self.pool(ingestor=False)
+        self.reloader = dataset_reloader.DatasetReloader(
+            self.csv_path, self.t_pool,
+            lambda path, progress: DemoIngestor(path, use_snapshot=False, progress=progress))
+
+    def reload(self, path=None):
+        """ Start a reload and wait for its end, returns the status """
+        self.assertTrue(self.reloader.reload(path))
+        deadline = time.monotonic() + 10
+        while self.reloader.status()["loading"] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.reloader.status()
+
+    def test_unittest_reload_versions(self):
+        """ Every reload publishes a new version and empties the cache - expect to pass """
+        self.assertEqual(self.reload()["version"], 1)
+        self.assertTrue(self.t_pool.merging_csv.is_set())
+        first = self.t_pool.ingestor
+        key = ("global_mean_request", self.QUESTION, None, None)
+        self.t_pool.result_cache.put(key, {"global_mean": 6.7}, first.version)
+        self.assertIsNotNone(self.t_pool.result_cache.get(key))
+
+        status = self.reload()
+        self.assertEqual((status["version"], status["reloads"]), (2, 2))
+        self.assertIsNot(self.t_pool.ingestor, first)
+        self.assertEqual(first.version, 1)
+        self.assertIsNone(self.t_pool.result_cache.get(key))
+        # a job that computed on the first version answers after the reload
+        self.t_pool.result_cache.put(key, {"global_mean": 6.7}, first.version)
+        self.assertIsNone(self.t_pool.result_cache.get(key))
+
+    def test_unittest_failed_reload_keeps_dataset(self):
+        """ A csv that cannot be read leaves the loaded version in place - expect to pass """
+        self.reload()
+        status = self.reload(os.path.join(self.tmp_dir, "data", "missing.csv"))
+        self.assertEqual((status["version"], status["failures"]), (1, 1))
+        self.assertIn("missing.csv", status["last_error"])
+        self.assertEqual(status["path"], self.csv_path)
+
+    def test_unittest_reload_path_allowed(self):
+        """ Only files under the dataset directory, symlinks resolved - expect to pass """
+        data_dir = os.path.dirname(self.csv_path)
+        os.symlink("/etc/hosts", os.path.join(data_dir, "escape.csv"))
+        self.assertTrue(self.reloader.path_allowed(self.csv_path))
+        self.assertTrue(self.reloader.path_allowed(os.path.join(data_dir, "other.csv")))
+        for path in ["/etc/passwd", os.path.join(data_dir, "..", "my_csv.csv"),
+                     os.path.join(data_dir, "escape.csv"), data_dir + "_x/my_csv.csv", "", None, 1]:
+            self.assertFalse(self.reloader.path_allowed(path), path)
+
+        os.environ["DATASET_DIR"] = self.tmp_dir
+        reloader = dataset_reloader.DatasetReloader(self.csv_path, self.t_pool, None)
+        self.assertTrue(reloader.path_allowed(os.path.join(self.tmp_dir, "elsewhere.csv")))
+
+class TestMetrics(unittest.TestCase):
+    """ The Prometheus text format of the recorded series """
+    def test_unittest_metrics_histogram(self):
+        """ Cumulative buckets with an inclusive le, +Inf, sum and count - expect to pass """
+        recorder = metrics.Metrics(buckets=(0.1, 1.0))
+        for seconds in [0.05, 0.1, 0.5, 2.0]:
+            recorder.observe("job_stage_seconds", seconds, stage="compute",
+                             request_type="best5_request")
+        labels = 'request_type="best5_request",stage="compute"'
+        self.assertEqual(recorder.render(), [
+            "# HELP webserver_job_stage_seconds " + metrics.HELP["job_stage_seconds"],
+            "# TYPE webserver_job_stage_seconds histogram",
+            f'webserver_job_stage_seconds_bucket{{{labels},le="0.1"}} 2',
+            f'webserver_job_stage_seconds_bucket{{{labels},le="1.0"}} 3',
+            f'webserver_job_stage_seconds_bucket{{{labels},le="+Inf"}} 4',
+            f"webserver_job_stage_seconds_sum{{{labels}}} 2.65",
+            f"webserver_job_stage_seconds_count{{{labels}}} 4"])
+
+    def test_unittest_metrics_counters(self):
+        """ Counters per label set, sorted, with escaped label values - expect to pass """
+        recorder = metrics.Metrics()
+        recorder.inc("jobs_submitted_total", path="queued")
+        recorder.inc("jobs_submitted_total", 2, path="queued")
+        recorder.inc("jobs_submitted_total", path='in"line\\\n')
+        recorder.inc("unlisted_total")
+        self.assertEqual(recorder.render(), [
+            "# HELP webserver_jobs_submitted_total " + metrics.HELP["jobs_submitted_total"],
+            "# TYPE webserver_jobs_submitted_total counter",
+            'webserver_jobs_submitted_total{path="in\\"line\\\\\\n"} 1',
+            'webserver_jobs_submitted_total{path="queued"} 3',
+            "# HELP webserver_unlisted_total unlisted_total",
+            "# TYPE webserver_unlisted_total counter",
+            "webserver_unlisted_total 1"])
+        self.assertEqual(metrics.escape('a"b\\c\nd'), 'a\\"b\\\\c\\nd')
+
+class TestLogPipeline(unittest.TestCase):
+    """ Sampling of the INFO lines and the json lines """
+    @staticmethod
+    def record(level, message="job %s", args=("job_id_1",), exc_info=None):
+        """ A log record of the app logger """
+        return logging.LogRecord("app", level, __file__, 1, message, args, exc_info)
+
+    def test_unittest_sampled_info_filter(self):
+        """ A rate of the INFO lines pass, warnings always, the drops are counted - expect to pass """
+        random.seed(0)
+        sampler = log_pipeline.SampledInfoFilter(0.25)
+        kept = sum(sampler.filter(self.record(logging.INFO)) for _ in range(4000))
+        self.assertAlmostEqual(kept / 4000, 0.25, delta=0.03)
+        self.assertEqual(sampler.dropped, 4000 - kept)
+        self.assertTrue(all(sampler.filter(self.record(level))
+                            for level in [logging.WARNING, logging.ERROR] * 100))
+        self.assertTrue(all(log_pipeline.SampledInfoFilter(1).filter(self.record(logging.DEBUG))
+                            for _ in range(100)))
+        self.assertFalse(any(log_pipeline.SampledInfoFilter(0).filter(self.record(logging.INFO))
+                             for _ in range(100)))
+
+    def test_unittest_sampled_per_request(self):
+        """ Inside a request every INFO line shares one draw - expect to pass """
+        app = Flask(__name__)
+        sampler = log_pipeline.SampledInfoFilter(0.5)
+        decisions = set()
+        for _ in range(50):
+            with app.test_request_context():
+                kept = {sampler.filter(self.record(logging.INFO)) for _ in range(10)}
+                self.assertEqual(len(kept), 1)
+                decisions |= kept
+        self.assertEqual(decisions, {True, False})
+
+    def test_unittest_json_formatter(self):
+        """ One json object per line with the formatted message and the exception - expect to pass """
+        formatter = log_pipeline.JsonFormatter()
+        entry = json.loads(formatter.format(self.record(logging.INFO)))
+        self.assertEqual({key: entry[key] for key in ["level", "logger", "message"]},
+                         {"level": "INFO", "logger": "app", "message": "job job_id_1"})
+        self.assertTrue(entry["time"].endswith("+00:00"))
+        self.assertEqual(entry["thread"], threading.current_thread().name)
+        self.assertNotIn("exception", entry)
+        try:
+            raise ValueError("bad\nvalue")
+        except ValueError:
+            line = formatter.format(self.record(logging.ERROR, "failed", (), sys.exc_info()))
+        self.assertNotIn("\n", line)
+        self.assertIn("ValueError: bad", json.loads(line)["exception"])